@@ -0,0 +1,368 @@
+import atexit
+import fcntl
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import db
+
+logger = logging.getLogger(__name__)
+module_dir = os.path.abspath(os.path.dirname(__file__))
+
+JOURNAL_DIR = module_dir + os.sep + 'ad_journal'
+LOCK_FILE = '.lock'
+# رقم ملف الـ journal (ومعه batch_id) فريد داخل العملية حتى مع أكثر من buffer
+_journal_seq = itertools.count(1)
+
+# كل (مستخدم، يوم) في الدفعة: الرصيد والعداد والنقاط والمستوى وآخر مشاهدة في جملة واحدة.
+# العداد والمقبول يُحسبان قبلها داخل نفس المعاملة (_apply)، والمستوى يرتفع كل 100 نقطة.
+# RETURNING يعطي القيم الحقيقية بعد الدفعة (مع ما كتبته الـ workers الأخرى) لتحديث الحالة المؤقتة.
+_FLUSH_SQL = '''UPDATE users SET
+    balance = balance + :reward,
+    ads_watched_today = :ads_today,
+    ads_day = :ads_day,
+    points = points + :ads,
+    level = MAX(level, (points + :ads) / 100 + 1),
+    last_ad_watch = MAX(COALESCE(last_ad_watch, ''), :last)
+WHERE id = :user_id
+RETURNING ads_day, ads_watched_today'''
+
+
+def ad_day(when=None):
+    """يوم عداد الإعلانات (بتوقيت الخادم المحلي، مثل last_ad_watch)."""
+    return (when or datetime.now()).strftime('%Y-%m-%d')
+
+
+def ads_today(ads_watched_today, ads_day_value, today=None):
+    """قيمة العداد الفعلية: العداد المخزن ليوم سابق يعني صفراً اليوم."""
+    return ads_watched_today if ads_day_value == (today or ad_day()) else 0
+
+
+class AdRewardBuffer:
+    """
+    يجمع مشاهدات الإعلانات لكل مستخدم في الذاكرة ويكتبها لقاعدة البيانات دفعة
+    واحدة كل flush_interval_ms أو كل max_events حدث: الرصيد والعداد اليومي والنقاط
+    والمستوى كلها في معاملة واحدة لكل دفعة، ولا كتابة على القاعدة أثناء الطلب.
+
+    الحالة المؤقتة هي المرجع: الحد اليومي يُفحص على عداد المستخدم في القاعدة (يُقرأ عند
+    أول مشاهدة له في هذه العملية ويُحدَّث من RETURNING بعد كل دفعة) مضافاً إليه مشاهداته
+    التي لم تُكتب بعد. المستخدم الذي لم يشاهد شيئاً طوال فترة flush كاملة تُنسى حالته
+    وتُقرأ من جديد في المرة التالية. المستوى دالة في النقاط (كل 100 نقطة)، والنقاط هي
+    المشاهدات المقبولة بالضبط، فيُحسب داخل معاملة الدفعة بنفس الجملة.
+
+    بين الـ workers: كل worker يرى مشاهدات غيره بعد كتابتها فقط، لذلك يُعاد تطبيق الحد
+    داخل معاملة الدفعة على القيم الحقيقية. إذا شاهد نفس المستخدم عبر عدة workers في
+    نفس فترة الـ flush وتجاوز المجموع الحد، تُسقط الزيادة بلا مكافأة وتُعد في dropped.
+    الحد لا يُتجاوز في القاعدة أبداً، والقبول الزائد محدود بفترة flush واحدة عند الحد.
+
+    كل مشاهدة تُكتب كسطر في journal خاص بالعملية قبل قبولها، فإذا توقفت العملية قبل
+    الـ flush يُعاد تطبيق الـ journal عند التشغيل التالي بنفس قواعد الدفعة. كل دفعة
+    لها batch_id يُسجَّل في نفس المعاملة، فإعادة التطبيق لا تضاعف شيئاً، والدفعة التي
+    فشلت كتابتها تُعاد مع الـ flush التالي.
+    """
+
+    def __init__(self, reward=0.05, daily_limit=50, flush_interval_ms=500, max_events=200,
+                 journal_dir=JOURNAL_DIR, clock=datetime.now):
+        self.reward = reward
+        self.daily_limit = daily_limit
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_events = max_events
+        self.journal_dir = journal_dir
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # user_id -> {'day', 'ads'}: عداد المستخدم كما في القاعدة، و'unflushed' عدد مشاهداته
+        # التي لم تُكتب بعد، و'touched' إذا شاهد منذ آخر flush
+        self._users = {}
+        # (user_id, day) -> مشاهدات لم تُكتب بعد (الجديدة + ما في دفعات قيد الكتابة أو فاشلة)
+        self._unflushed = {}
+        # (user_id, day) -> [ads, last_ad_watch]: الجديدة التي لم تدخل دفعة بعد
+        self._pending = {}
+        self._pending_events = 0
+        # دفعات فشلت كتابتها: [(مسار الـ journal، pending)]
+        self._failed = []
+        self._journal_fd = None
+        self._journal_path = None
+        # ملفات journal قيد الكتابة لقاعدة البيانات: path -> fd
+        self._flushing = {}
+        self._pid = None
+        self._thread = None
+        self._stopping = False
+        # مشاهدات قُبلت ثم أُسقطت عند الكتابة لأن المستخدم بلغ الحد عبر workers أخرى
+        self.dropped = 0
+
+    # ----- الواجهة العامة -----
+
+    def record(self, user_id):
+        """
+        سجّل مشاهدة إعلان.
+        يرجع True إذا قُبلت، False إذا تجاوز المستخدم الحد اليومي، None إذا لم يوجد المستخدم.
+        """
+        self._ensure_started()
+        now = self.clock()
+        today = ad_day(now)
+        ts = now.strftime('%Y-%m-%d %H:%M:%S')
+        row = None
+        while True:
+            with self._lock:
+                state = self._users.get(user_id)
+                if state is None and row is not None:
+                    state = self._users[user_id] = {
+                        'day': row['ads_day'], 'ads': row['ads_watched_today'] or 0, 'unflushed': 0, 'touched': False,
+                    }
+                if state is not None:
+                    return self._accept(user_id, state, today, ts)
+            # القراءة خارج القفل حتى لا توقف بقية المستخدمين. لا شيء لهذا المستخدم قيد الكتابة
+            # (الحالة لا تُنسى إلا بعد فترة flush كاملة بلا مشاهدات)، فقيم القاعدة دقيقة
+            row = db.get_connection().execute(
+                'SELECT ads_watched_today, ads_day FROM users WHERE id = ?', (user_id,)
+            ).fetchone()
+            if row is None:
+                return None
+
+    def flush(self):
+        """اكتب كل المشاهدات المؤقتة الآن (ومعها الدفعات الفاشلة سابقاً). تُستدعى أيضاً عند الإغلاق."""
+        with self._lock:
+            batches, self._failed = self._failed, []
+            if self._pending:
+                batches.append((self._rotate_journal(), self._pending))
+                self._pending = {}
+                self._pending_events = 0
+        applied = 0
+        for path, pending in batches:
+            batch_id = os.path.basename(path)
+            try:
+                states = self._apply(batch_id, pending)
+            except Exception:
+                # الملف يبقى مقفلاً في المجلد؛ نعيد المحاولة مع الـ flush التالي
+                logger.exception(f"Ad reward flush failed, batch {batch_id} will be retried")
+                with self._lock:
+                    self._failed.append((path, pending))
+                continue
+            with self._lock:
+                self._settle(pending, states)
+            self._release(path)
+            applied += len(pending)
+        with self._lock:
+            self._forget_idle()
+        return applied
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.flush()
+        with self._lock:
+            # الـ journal الحالي فارغ بعد flush ناجح، فلا داعي لتركه للتشغيل التالي
+            if not self._pending and not self._failed and self._journal_fd is not None:
+                os.close(self._journal_fd)
+                os.remove(self._journal_path)
+                self._journal_fd = None
+
+    # ----- التفاصيل الداخلية -----
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # بعد fork نبدأ من جديد: الحالة والـ journal للعملية الأم ليست لنا
+            self._users = {}
+            self._unflushed = {}
+            self._pending = {}
+            self._pending_events = 0
+            self._failed = []
+            self._flushing = {}
+            os.makedirs(self.journal_dir, exist_ok=True)
+            self._replay_orphans()
+            self._open_journal()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='ad-buffer-flush', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._stopping and self._pending_events < self.max_events:
+                    self._wakeup.wait(self.flush_interval)
+                if self._stopping:
+                    return
+            self.flush()
+
+    def _accept(self, user_id, state, today, ts):
+        # مع القفل: الحد اليومي على حالة المستخدم المؤقتة
+        key = (user_id, today)
+        watched = ads_today(state['ads'], state['day'], today) + self._unflushed.get(key, 0)
+        if watched >= self.daily_limit:
+            return False
+
+        # الـ journal أولاً: المشاهدة لا تُقبل قبل أن تُحفظ
+        os.write(self._journal_fd, f"{user_id}\t{ts}\n".encode())
+        pending = self._pending.setdefault(key, [0, ts])
+        pending[0] += 1
+        pending[1] = ts
+        self._unflushed[key] = self._unflushed.get(key, 0) + 1
+        state['unflushed'] += 1
+        state['touched'] = True
+        self._pending_events += 1
+        if self._pending_events >= self.max_events:
+            self._wakeup.notify()
+        return True
+
+    def _settle(self, pending, states):
+        """بعد كتابة دفعة (مع القفل): أنقص ما لم يُكتب وحدّث الحالة بالقيم الحقيقية من القاعدة."""
+        for (user_id, day), (ads, _) in pending.items():
+            key = (user_id, day)
+            left = self._unflushed.get(key, 0) - ads
+            if left > 0:
+                self._unflushed[key] = left
+            else:
+                self._unflushed.pop(key, None)
+            state = self._users.get(user_id)
+            if state is None:
+                continue
+            state['unflushed'] -= ads
+            row = states.get(user_id)
+            if row is not None:
+                state.update(day=row['ads_day'], ads=row['ads_watched_today'])
+            elif not state['unflushed']:
+                # الدفعة طُبقت سابقاً أو المستخدم حُذف: لا قيم حقيقية، نقرأ من جديد في المرة التالية
+                del self._users[user_id]
+
+    def _forget_idle(self):
+        # مع القفل: من لم يشاهد منذ الـ flush السابق وليس له شيء قيد الكتابة
+        for user_id in [u for u, s in self._users.items() if not s['touched'] and not s['unflushed']]:
+            del self._users[user_id]
+        for state in self._users.values():
+            state['touched'] = False
+
+    @contextmanager
+    def _directory_lock(self):
+        """
+        قفل على مجلد الـ journal: إنشاء ملف جديد وقفله يتمان معاً تحته، فلا يراه
+        worker آخر يبحث عن الملفات اليتيمة وهو غير مقفل بعد.
+        """
+        fd = os.open(os.path.join(self.journal_dir, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _open_journal(self):
+        path = os.path.join(self.journal_dir, f"{os.getpid()}-{int(time.time() * 1000)}-{next(_journal_seq)}.log")
+        with self._directory_lock():
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o644)
+            # القفل يعني أن العملية ما زالت حية؛ الملفات غير المقفلة يتيمة
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._journal_fd = fd
+        self._journal_path = path
+
+    def _rotate_journal(self):
+        """استبدل الـ journal بملف جديد وأرجع مسار القديم (يبقى مقفلاً حتى _release)."""
+        old_fd, old_path = self._journal_fd, self._journal_path
+        self._open_journal()
+        self._flushing[old_path] = old_fd
+        return old_path
+
+    def _release(self, path):
+        fd = self._flushing.pop(path, None)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        if fd is not None:
+            os.close(fd)
+
+    def _apply(self, batch_id, pending):
+        """
+        اكتب دفعة في معاملة واحدة ويرجع {user_id: الصف بعد الكتابة}.
+        الحد اليومي يُطبق هنا على القيم الحقيقية: ما يتجاوزه يُسقط بلا مكافأة.
+        """
+        states = {}
+        dropped = 0
+        with db.transaction() as conn:
+            if conn.execute('SELECT 1 FROM ad_reward_batches WHERE batch_id = ?', (batch_id,)).fetchone():
+                logger.info(f"Ad reward batch {batch_id} already applied, skipping")
+                return states
+            # الأيام الأقدم أولاً حتى يبدأ العداد من جديد عند الانتقال ليوم جديد
+            for (user_id, day), (ads, last) in sorted(pending.items(), key=lambda item: item[0][1]):
+                row = conn.execute(
+                    'SELECT ads_watched_today, ads_day FROM users WHERE id = ?', (user_id,)
+                ).fetchone()
+                if row is None:
+                    dropped += ads
+                    continue
+                if row['ads_day'] is not None and row['ads_day'] > day:
+                    # دفعة من يوم سابق (journal قديم): العداد الحالي ليوم أحدث فلا نلمسه
+                    accepted = min(ads, self.daily_limit)
+                    count, count_day = row['ads_watched_today'], row['ads_day']
+                else:
+                    used = ads_today(row['ads_watched_today'] or 0, row['ads_day'], day)
+                    accepted = min(ads, max(0, self.daily_limit - used))
+                    count, count_day = used + accepted, day
+                dropped += ads - accepted
+                states[user_id] = conn.execute(_FLUSH_SQL, {
+                    'reward': accepted * self.reward, 'ads': accepted, 'ads_today': count, 'ads_day': count_day,
+                    'last': last if accepted else '', 'user_id': user_id,
+                }).fetchone()
+            conn.execute(
+                'INSERT INTO ad_reward_batches (batch_id, events) VALUES (?, ?)',
+                (batch_id, sum(ads for ads, _ in pending.values()) - dropped)
+            )
+        if dropped:
+            self.dropped += dropped
+            logger.warning(f"Ad reward batch {batch_id}: dropped {dropped} views over the daily limit")
+        return states
+
+    def _replay_orphans(self):
+        """طبّق ملفات journal التي تركتها عمليات توقفت قبل الـ flush."""
+        # نحجز الملفات اليتيمة تحت قفل المجلد، ثم نطبقها بعد تحريره
+        orphans = []
+        with self._directory_lock():
+            for name in sorted(os.listdir(self.journal_dir)):
+                if name == LOCK_FILE:
+                    continue
+                path = os.path.join(self.journal_dir, name)
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                except OSError:
+                    continue
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    os.close(fd)  # عملية أخرى حية تملكه
+                    continue
+                orphans.append((name, path, fd))
+
+        for name, path, fd in orphans:
+            try:
+                pending = {}
+                with os.fdopen(os.dup(fd), encoding='utf-8') as f:
+                    for line in f:
+                        if not line.endswith('\n'):
+                            continue  # سطر ناقص من توقف مفاجئ
+                        # السطر: user_id ثم الوقت (الصيغة الأقدم فيها حقل level_up في الوسط)؛ اليوم من الوقت
+                        fields = line.rstrip('\n').split('\t')
+                        user_id, ts = int(fields[0]), fields[-1]
+                        entry = pending.setdefault((user_id, ts[:10]), [0, ts])
+                        entry[0] += 1
+                        entry[1] = max(entry[1], ts)
+                if pending:
+                    self._apply(name, pending)
+                    logger.info(f"Replayed ad reward journal {name}: {len(pending)} users")
+                os.remove(path)
+            except Exception:
+                logger.exception(f"Failed to replay ad reward journal {name}, keeping it for the next start")
+            finally:
+                os.close(fd)
+        db.execute("DELETE FROM ad_reward_batches WHERE applied_at < datetime('now', '-7 days')")
@@ -1,8 +1,6 @@
-from flask import Flask, request, jsonify, render_template_string, redirect
+from flask import Flask, request, jsonify, redirect, Response, stream_with_context
 import logging
-import sqlite3
 from datetime import datetime, timedelta
-import requests
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 import threading
@@ -14,7 +12,25 @@ import asyncio
 from flask import request
 from flask_cors import CORS
 import re
-import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import ad_buffer
+import balance
+import broadcast
+import cache
+import db
+import export
+import game_periods
+import leaderboard
+import migrations
+import outbox
+import rate_limit
+import referral_audit
+import settings_store
+import static_assets
+import stats as stats_counters
+import telegram_client
+import update_dedup
 
 
 logging.basicConfig(
@@ -30,15 +46,25 @@ load_dotenv()
 KEY = os.getenv("KEY")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
-LEADERBOARD_FILE = module_dir+os.sep+"leaderboard.json"
 WITHDRAW_LOG = module_dir+os.sep+"withdrawals.log"
 PARTNERSHIP_LOG = module_dir+os.sep+"partnerships.log"
-TASKS_FILE = module_dir+os.sep+"tasks.json"
-GAME_LOGS_FILE = module_dir+os.sep+"game_logs.json"  # ✅ ملف جديد لتسجيل نتائج الألعاب
 
-# قراءة الإعدادات من ملف settings.json
-with open(module_dir + os.sep + 'settings.json', encoding='utf-8') as f:
-    SETTINGS = json.load(f)
+# عميل Bot API مشترك (اتصالات keep-alive) لكل الرسائل والتحققات
+tg = telegram_client.TelegramClient(BOT_TOKEN, pool_size=int(os.getenv("TELEGRAM_POOL_SIZE", 32)))
+# حد الإرسال الجماعي المشترك (حد تليجرام العام ~30 رسالة/ثانية)
+tg_limiter = telegram_client.RateLimiter(rate=int(os.getenv("TELEGRAM_BROADCAST_RATE", 30)))
+# كل الإشعارات تمر عبر طابور دائم في قاعدة البيانات؛ المعالجات لا تنتظر تليجرام
+notifications = outbox.Outbox(tg, tg_limiter, workers=int(os.getenv("OUTBOX_WORKERS", 4)))
+
+# الإعدادات من settings.json كـ snapshot في الذاكرة يُعاد تحميله إذا تغير الملف (انظر settings_store.py)
+settings = settings_store.SettingsStore(
+    module_dir + os.sep + 'settings.json',
+    check_interval=float(os.getenv("SETTINGS_CHECK_INTERVAL", 1))
+)
+
+def get_settings():
+    """الإعدادات الحالية (للقراءة فقط)."""
+    return settings.current().data
 
 _file_lock = threading.Lock()
 
@@ -46,408 +72,335 @@ _file_lock = threading.Lock()
 app = Flask(__name__)
 CORS(app)  # تمكين CORS
 
-def write_json_atomic(path, data):
-    """اكتب JSON بطريقة أتمتة آمنة (كتابة إلى ملف مؤقت ثم استبدال)."""
-    tmp_fd, tmp_path = tempfile.mkstemp(dir='.', prefix='tmp_', text=True)
-    try:
-        with os.fdopen(tmp_fd, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        os.replace(tmp_path, path)
-    except Exception:
-        try:
-            os.remove(tmp_path)
-        except Exception:
-            pass
-        raise
+# حدود الطلبات لكل مسار (لكل مستخدم ولكل IP) قبل أي عمل على القاعدة أو تليجرام (انظر rate_limit.py).
+# memory: دلاء في ذاكرة كل worker، sqlite: دلاء مشتركة بين كل الـ workers
+if os.getenv("RATE_LIMIT_BACKEND", "memory") == "sqlite":
+    rate_limit_buckets = rate_limit.SQLiteBuckets()
+else:
+    rate_limit_buckets = rate_limit.MemoryBuckets(maxsize=int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000)))
+limiter = rate_limit.RouteLimiter(
+    rate_limit_buckets,
+    proxy_hops=int(os.getenv("RATE_LIMIT_PROXY_HOPS", 1)),
+    enabled=os.getenv("RATE_LIMIT_ENABLED", "1") != "0",
+)
 
 def notify_admin(text):
-    """أرسل رسالة للأدمن عبر Telegram API إن كان BOT_TOKEN معرفًا، وإلا سجلها في لوج."""
-    payload = {
-        "chat_id": ADMIN_ID,
-        "text": text
-    }
-    try:
-        requests.post(f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage", json=payload, timeout=10)
-    except Exception as e:
-        # لو فشل الإرسال، سجله
-        with _file_lock:
-            with open("admin_notify_fail.log", "a", encoding="utf-8") as f:
-                f.write(f"{datetime.now().isoformat()} | notify_admin failed: {e}\n{text}\n\n")
+    """أضف رسالة للأدمن إلى طابور الإشعارات (الإرسال وإعادة المحاولة في الخلفية)."""
+    notifications.enqueue(ADMIN_ID, text)
 
 def send_message_to_user(user_id, text, parse_mode=None):
-    try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-        payload = {"chat_id": user_id, "text": text}
-
-        if parse_mode:  # لو المستخدم مرر قيمة
-            payload["parse_mode"] = parse_mode
-
-        resp = requests.post(url, json=payload, timeout=8)
-        if resp.ok:
-            logger.info(f"Message sent successfully to user {user_id}")
-            return True
-        else:
-            error_msg = (
-                f"Failed to send message to user {user_id}. "
-                f"Status: {resp.status_code}, Response: {resp.text}"
-            )
-            logger.error(error_msg)
-            # تسجيل الخطأ في ملف منفصل لسهولة الوصول
-            with _file_lock:
-                with open("send_message_fail.log", "a", encoding="utf-8") as f:
-                    f.write(f"{datetime.now().isoformat()} | {error_msg}\n")
-            return False
-    except Exception as e:
-        error_msg = f"Exception while sending message to user {user_id}: {e}"
-        logger.error(error_msg)
-        with _file_lock:
-            with open("send_message_fail.log", "a", encoding="utf-8") as f:
-                f.write(f"{datetime.now().isoformat()} | {error_msg}\n")
-        return False
-
-def send_message_to_user_with_reply_markup(user_id, text, reply_markup):
-    try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-        payload = {
-            "chat_id": user_id,
-            "text": text,
-            "reply_markup": reply_markup.to_dict()
-        }
-        resp = requests.post(url, json=payload, timeout=8)
-        if resp.ok:
-            logger.info(f"Message with button sent successfully to user {user_id}")
-            return True
-        else:
-            error_msg = f"Failed to send message with button to user {user_id}. Status: {resp.status_code}, Response: {resp.text}"
-            logger.error(error_msg)
-            return False
-    except Exception as e:
-        error_msg = f"Exception while sending message with button to user {user_id}: {e}"
-        logger.error(error_msg)
-        return False
-
-# قاعدة البيانات
-def init_db():
-    conn = sqlite3.connect(module_dir+os.sep+'bot.db', check_same_thread=False)
-    cursor = conn.cursor()
-com # جدول المستخدمين
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY,
-        username TEXT,
-        first_name TEXT,
-        last_name TEXT,
-        balance REAL DEFAULT 0,
-        invites INTEGER DEFAULT 0,
-        ads_watched_today INTEGER DEFAULT 0,
-        level INTEGER DEFAULT 1,
-        points INTEGER DEFAULT 0,
-        is_admin BOOLEAN DEFAULT FALSE,
-        banned BOOLEAN DEFAULT FALSE,
-        last_ad_watch DATETIME,
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-
-    # جدول الإحالات
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS referrals (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        referrer_id INTEGER,
-        referred_id INTEGER,
-        reward_claimed BOOLEAN DEFAULT FALSE,
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (referrer_id) REFERENCES users (id),
-        FOREIGN KEY (referred_id) REFERENCES users (id)
-    )
-    ''')
-
-    # جدول عمليات السحب
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS withdrawals (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        amount REAL,
-        method TEXT,
-        address TEXT,
-        status TEXT DEFAULT 'pending',
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )
-    ''')
-
-    # جدول طلبات الشراكة
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS partnership_requests (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        channel_name TEXT,
-        channel_link TEXT,
-        channel_description TEXT,
-        status TEXT DEFAULT 'pending',
-        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )
-    ''')
-
-    # إضافة مستخدم مسؤول إذا لم يكن موجودًا
-    cursor.execute("SELECT * FROM users WHERE id = 6434711549")
-    admin = cursor.fetchone()
-    if not admin:
-        cursor.execute(
-            "INSERT INTO users (id, username, first_name, balance, is_admin) VALUES (?, ?, ?, ?, ?)",
-            (6434711549, "admin", "Admin", 1000, True)
-        )
+    notifications.enqueue(user_id, text, parse_mode=parse_mode)
+
+# ترحيل المخطط (فحص PRAGMA user_version فقط إذا كان ملف النشر قد شغّله).
+# استيراد ملفات JSON القديمة خطوة نشر منفصلة تعمل مرة واحدة (انظر legacy_imports.py)
+migrations.migrate()
+# أرسل ما بقي في الطابور من تشغيل سابق
+notifications.start()
+
+# مشاهدات الإعلانات تُجمع في الذاكرة (الحد اليومي عليها) وتُكتب دفعة واحدة (انظر ad_buffer.py)
+ad_rewards = ad_buffer.AdRewardBuffer(
+    reward=0.05,
+    daily_limit=50,
+    flush_interval_ms=int(os.getenv("AD_FLUSH_INTERVAL_MS", 500)),
+    max_events=int(os.getenv("AD_FLUSH_MAX_EVENTS", 200)),
+)
 
-    conn.commit()
-    conn.close()
+# قائمة المتصدرين حسب الرصيد، تُحسب في الخلفية كل LEADERBOARD_REFRESH_INTERVAL ثانية
+balance_leaderboard = leaderboard.BalanceLeaderboard(
+    limit=int(os.getenv("LEADERBOARD_SIZE", 10)),
+    refresh_interval=int(os.getenv("LEADERBOARD_REFRESH_INTERVAL", 60)),
+)
+# أول نسخة تُحسب عند التشغيل وليس في أول طلب
+balance_leaderboard.start()
+
+# الإرسال الجماعي: مهام محفوظة في broadcast_jobs تُستأنف إذا توقفت العملية (انظر broadcast.py)
+broadcaster = broadcast.Broadcaster(
+    tg, tg_limiter,
+    workers=int(os.getenv("BROADCAST_WORKERS", 16)),
+    notify=notify_admin,
+)
+broadcaster.resume_stale_jobs()
 
-init_db()
+@app.teardown_appcontext
+def release_db_connection(exc):
+    db.release_connection()
 
 # وظائف قاعدة البيانات
 def get_db_connection():
-    conn = sqlite3.connect(module_dir+os.sep+'bot.db', check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """اتصال الـ thread الحالي من db (لا يُغلق بعد الاستخدام)."""
+    return db.get_connection()
 
 def get_user(user_id):
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
-    return user
+    return get_db_connection().execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
 
 def update_user(user_id, **kwargs):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     set_clause = ', '.join([f"{key} = ?" for key in kwargs.keys()])
     values = list(kwargs.values())
     values.append(user_id)
 
-    cursor.execute(f"UPDATE users SET {set_clause} WHERE id = ?", values)
-    conn.commit()
-    conn.close()
+    db.execute(f"UPDATE users SET {set_clause} WHERE id = ?", values)
 
-def add_user(user_id, username, first_name, last_name=None, invitor=None):
-    with open(module_dir+os.sep+'temp_users.json',encoding='utf-8') as f :
-        temp_users = json.loads(f.read())
+def record_referral(referrer_id, referred_id, reward=3):
+    """
+    سجّل الإحالة وامنح المكافأة للداعي في معاملة واحدة.
+    يرجع رصيد الداعي الجديد، أو None إذا لم يوجد الداعي أو كان المدعو مُحالاً من قبل.
+    """
+    with db.transaction() as conn:
+        if not conn.execute('SELECT 1 FROM users WHERE id = ?', (referrer_id,)).fetchone():
+            return None
+        inserted = conn.execute(
+            'INSERT OR IGNORE INTO referrals (referrer_id, referred_id, reward_claimed) VALUES (?, ?, 1)',
+            (referrer_id, referred_id)
+        ).rowcount
+        if not inserted:
+            return None
+        return balance.credit(referrer_id, reward, 'referral', invites=1)
+
+def get_referrals_page(referrer_id, limit=100, before_id=None):
+    """
+    صفحة من إحالات المستخدم (الأحدث أولاً) عبر الفهرس idx_referrals_referrer.
+    يرجع (الصفوف، مؤشر الصفحة التالية أو None).
+    """
+    # LIMIT سالب في SQLite يعني بلا حد، و0 يجعل rows[limit - 1] آخر صف
+    limit = max(1, limit)
+    query = '''SELECT r.id AS ref_id, u.id, u.username
+               FROM referrals r JOIN users u ON u.id = r.referred_id
+               WHERE r.referrer_id = ?'''
+    args = [referrer_id]
+    if before_id is not None:
+        query += ' AND r.id < ?'
+        args.append(before_id)
+    query += ' ORDER BY r.id DESC LIMIT ?'
+    args.append(limit + 1)
+    rows = get_db_connection().execute(query, args).fetchall()
+    next_cursor = rows[limit - 1]['ref_id'] if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+# تسجيل مؤقت لم يُفعَّل خلال هذه المدة يُحذف
+PENDING_REGISTRATION_TTL = int(os.getenv("PENDING_REGISTRATION_TTL", 30 * 86400))
+_last_pending_purge = 0
 
-    try:
-        temp_users.pop(str(user_id))
-    except:None
-
-    with open(module_dir+os.sep+'temp_users.json','w',encoding='utf-8') as f :
-        f.write( json.dumps(temp_users,ensure_ascii=False) )
-
-    # ✅ تسجيل الإحالة في referrals.json إذا وجد داعٍ
-    if invitor:
-        invitor = int(invitor)
-        referrer = get_user(invitor)
-        if referrer and referrer['id'] != user_id:  # ✅ تصحيح الشرط هنا
-            # منح المكافأة
-            new_balance = referrer['balance'] + 3
-            new_invites = referrer['invites'] + 1
-            update_user(invitor, balance=new_balance, invites=new_invites)
-
-            # ✅ تسجيل الإحالة في referrals.json
-            referrals_file = module_dir + os.sep + 'referrals.json'
-            referrals_data = {}
-            if os.path.exists(referrals_file):
-                with open(referrals_file, 'r', encoding='utf-8') as f:
-                    referrals_data = json.load(f)
-
-            # إضافة ID المستخدم الجديد إلى قائمة المدعوين للداعي
-            if str(invitor) not in referrals_data:
-                referrals_data[str(invitor)] = []
-            referrals_data[str(invitor)].append(user_id)
-
-            # حفظ الملف
-            with open(referrals_file, 'w', encoding='utf-8') as f:
-                json.dump(referrals_data, f, ensure_ascii=False, indent=2)
-
-            # إخطار الأدمن
-            notify_admin(f"Referral applied: referrer={invitor} got +3 CMD (new_balance={new_balance})")
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # التحقق إذا كان المستخدم موجودًا بالفعل
-    existing_user = cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    if not existing_user:
-        cursor.execute(
-            "INSERT INTO users (id, username, first_name, last_name) VALUES (?, ?, ?, ?)",
+def add_user(user_id, username, first_name, last_name=None, invitor=None):
+    """
+    أنشئ المستخدم واحذف تسجيله المؤقت وسجّل إحالته (إن وجد داعٍ) في معاملة واحدة.
+    يرجع True إذا أُنشئ المستخدم الآن.
+    """
+    new_balance = None
+    with db.transaction() as conn:
+        created = conn.execute(
+            "INSERT OR IGNORE INTO users (id, username, first_name, last_name) VALUES (?, ?, ?, ?)",
             (user_id, username, first_name, last_name)
-        )
-        conn.commit()
+        ).rowcount
+        conn.execute('DELETE FROM pending_registrations WHERE user_id = ?', (user_id,))
+
+        # ✅ تسجيل الإحالة في جدول referrals إذا وجد داعٍ
+        if invitor:
+            invitor = int(invitor)
+            new_balance = record_referral(invitor, user_id) if invitor != user_id else None
 
-    conn.close()
+    if new_balance is not None:
+        # إخطار الأدمن
+        notify_admin(f"Referral applied: referrer={invitor} got +3 CMD (new_balance={new_balance})")
+    return bool(created)
 
 def add_user_temp(user_id, username, first_name, last_name=None, invitor=None):
-    with open(module_dir+os.sep+'temp_users.json',encoding='utf-8') as f :
-        temp_users = json.loads(f.read())
-    temp_users[str(user_id)] = [username, first_name, last_name, invitor]
-    with open(module_dir+os.sep+'temp_users.json','w',encoding='utf-8') as f :
-        f.write( json.dumps(temp_users,ensure_ascii=False) )
-
-with open(module_dir+os.sep+'index.html', encoding='utf-8') as f:
-    index_html = f.read()
-with open(module_dir+os.sep+'admin.html', encoding='utf-8') as f:
-    admin_html = f.read()
-with open(module_dir+os.sep+'style.css', encoding='utf-8') as f:
-    style_file = f.read()
-with open(module_dir+os.sep+'script.js', encoding='utf-8') as f:
-    script_file = f.read()
+    """احفظ بيانات /start حتى يفتح المستخدم التطبيق (صف واحد، بدون قراءة كل التسجيلات)."""
+    global _last_pending_purge
+    now = time.time()
+    db.execute(
+        '''INSERT INTO pending_registrations (user_id, username, first_name, last_name, invitor, created_at)
+           VALUES (?, ?, ?, ?, ?, ?)
+           ON CONFLICT(user_id) DO UPDATE SET
+               username = excluded.username, first_name = excluded.first_name,
+               last_name = excluded.last_name, invitor = excluded.invitor, created_at = excluded.created_at''',
+        (user_id, username, first_name, last_name, invitor, now)
+    )
+    if now - _last_pending_purge > 3600:
+        _last_pending_purge = now
+        db.execute('DELETE FROM pending_registrations WHERE created_at < ?', (now - PENDING_REGISTRATION_TTL,))
+
+def promote_pending_user(user_id):
+    """فعّل التسجيل المؤقت للمستخدم إن وجد. يرجع True إذا أصبح المستخدم موجوداً."""
+    with db.transaction() as conn:
+        pending = conn.execute(
+            'SELECT username, first_name, last_name, invitor FROM pending_registrations WHERE user_id = ? AND created_at >= ?',
+            (user_id, time.time() - PENDING_REGISTRATION_TTL)
+        ).fetchone()
+        if pending is None:
+            return False
+        add_user(user_id, pending['username'], pending['first_name'],
+                 last_name=pending['last_name'], invitor=pending['invitor'])
+    return True
+
+# الملفات الثابتة تُحمّل وتُضغط مرة واحدة عند التشغيل (انظر static_assets.py).
+# CSS و JS تُطلب من الصفحات برابط فيه hash المحتوى، فتُخزن في المتصفح سنة كاملة؛
+# الصفحات نفسها تُعاد مقارنتها بالـ ETag في كل فتح (304 بدون محتوى إذا لم تتغير).
+style_asset = static_assets.StaticAsset.from_file(module_dir+os.sep+'style.css', 'text/css; charset=utf-8')
+script_asset = static_assets.StaticAsset.from_file(module_dir+os.sep+'script.js', 'application/javascript; charset=utf-8')
+
+def _load_page(name):
+    with open(module_dir+os.sep+name, encoding='utf-8') as f:
+        page = f.read()
+    for url, asset in (('style.css', style_asset), ('script.js', script_asset)):
+        page = page.replace(f'"{url}"', f'"{asset.versioned_url(url)}"')
+        page = page.replace(f'"/{url}"', f'"/{asset.versioned_url(url)}"')
+    return static_assets.StaticAsset(page, 'text/html; charset=utf-8')
+
+index_asset = _load_page('index.html')
+admin_asset = _load_page('admin.html')
+
+ASSET_CACHE_IMMUTABLE = 'public, max-age=31536000, immutable'
+ASSET_CACHE_REVALIDATE = 'public, max-age=300'
 
 @app.route('/', methods=['GET'])
 def index ():
-    return index_html
+    return index_asset.response('no-cache')
 
 @app.route('/style.css')
 def style():
-    return style_file, 200, {'Content-Type': 'text/css; charset=utf-8'}
+    # الرابط القديم بدون ?v= يبقى يعمل لكن بمدة قصيرة
+    return style_asset.response(ASSET_CACHE_IMMUTABLE if request.args.get('v') == style_asset.digest else ASSET_CACHE_REVALIDATE)
 
 # ملف JavaScript
 @app.route('/script.js')
 def script():
-    return script_file, 200, {'Content-Type': 'application/javascript; charset=utf-8'}
+    return script_asset.response(ASSET_CACHE_IMMUTABLE if request.args.get('v') == script_asset.digest else ASSET_CACHE_REVALIDATE)
 
 # ملف JSON
 @app.route('/settings')
 def data():
-    with open(module_dir+os.sep+'settings.json', encoding='utf-8') as f:
-        settings_file = f.read()
-    return settings_file, 200, {'Content-Type': 'application/json; charset=utf-8'}
+    # الصفحة تطلبه عدة مرات؛ مع ETag يكون الرد 304 بدون محتوى ما لم تتغير الإعدادات
+    return settings.current().asset.response('no-cache')
 
 @app.route('/admin/panel', methods=['GET'])
 def admin ():
     if request.args.get('key') != KEY:
         return '',404
-    return admin_html
-
-def query_db(query, args=(), one=False):
-    con = sqlite3.connect(module_dir+os.sep+"bot.db")
-    con.row_factory = sqlite3.Row
-    cur = con.cursor()
-    cur.execute(query, args)
-    rv = cur.fetchall()
-    con.commit()
-    con.close()
-    return (rv[0] if rv else None) if one else rv
+    return admin_asset.response('private, no-cache')
+
+def export_response(name):
+    """
+    صدّر جدولاً كاملاً كـ stream (html افتراضياً، أو format=csv|ndjson) بدون
+    تحميله في الذاكرة، مع gzip أثناء الإرسال إذا قبله العميل.
+    """
+    fmt = request.args.get('format', 'html')
+    if fmt not in export.FORMATS:
+        return jsonify({'success': False, 'error': f'format must be one of {", ".join(export.FORMATS)}'}), 400
+
+    chunks = export.render(name, fmt)
+    headers = {'Cache-Control': 'no-store', 'Vary': 'Accept-Encoding'}
+    if fmt != 'html':
+        headers['Content-Disposition'] = f'attachment; filename="{name}.{fmt}"'
+    if request.accept_encodings.quality('gzip') > 0:
+        chunks = export.gzip_stream(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    else:
+        chunks = (chunk.encode('utf-8') for chunk in chunks)
+    return Response(stream_with_context(chunks), content_type=export.FORMATS[fmt], headers=headers)
 
 @app.route("/admin/users")
 def show_table():
     if request.args.get('key') != KEY:
         return '',404
+    return export_response('users')
+
+@app.route("/admin/export/<name>")
+def admin_export(name):
+    if request.args.get('key') != KEY or name not in export.EXPORTS:
+        return '',404
+    return export_response(name)
+
+# رد /start ثابت، يُبنى مرة واحدة بدل بناء كائنات telegram في كل تحديث
+WEB_APP_URL = "https://cmd-pearl.vercel.app"  # استبدل برابطك
+WELCOME_TEXT = (
+    "مرحباً بك في COMMANDO! ✨\n"
+    "الرجاء الاشتراك في القنوات أدناه لتفعيل حسابك والبدء في الربح.\n"
+    "اضغط على الزر لفتح التطبيق:"
+)
+WELCOME_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton(text="🚀 افتح التطبيق", web_app=WebAppInfo(url=WEB_APP_URL))]
+]).to_dict()
 
-    name='users'
-    rows = query_db(f"SELECT * FROM {name}")
-    return render_template_string("""
-    <h2>جدول: {{name}}</h2>
-    <table border="1" cellpadding="5">
-      <tr>
-        {% for col in rows[0].keys() %}
-          <th>{{col}}</th>
-        {% endfor %}
-      </tr>
-      {% for row in rows %}
-        <tr>
-          {% for col in row.keys() %}
-            <td>{{row[col]}}</td>
-          {% endfor %}
-        </tr>
-      {% endfor %}
-    </table>
-    """, name=name, rows=rows)
+# تليجرام يعيد إرسال التحديث إذا تأخر الرد؛ المكرر يُسقط قبل أي عمل
+update_dedup_filter = update_dedup.UpdateDeduplicator(maxsize=int(os.getenv("WEBHOOK_DEDUP_SIZE", 10000)))
+
+# معالجة التحديثات بعد الرد على تليجرام (تسجيل المستخدم المؤقت)
+_webhook_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("WEBHOOK_POOL_SIZE", 4)),
+    thread_name_prefix='webhook'
+)
+
+def webhook_reply(chat_id, text, reply_markup=None):
+    """
+    رد webhook بصيغة method: تليجرام ينفذ sendMessage بنفسه من رد الـ HTTP،
+    فلا نحتاج طلباً صادراً إضافياً.
+    """
+    payload = {'method': 'sendMessage', 'chat_id': chat_id, 'text': text}
+    if reply_markup is not None:
+        payload['reply_markup'] = reply_markup
+    return jsonify(payload)
+
+def process_update(user_id, username, first_name, last_name, text):
+    """العمل البطيء لتحديث webhook (خارج مسار الرد)."""
+    try:
+        # هل المستخدم مسجل أصلاً؟
+        if get_user(user_id):
+            return
+        invitor = None
+        # حالات ممكنة: "/start", "/start ref123", "/startref123" (نأخذ الاحتمال الأول)
+        if text.startswith('/start'):
+            parts = text.split()
+            if len(parts) > 1 and parts[1].startswith('ref'):
+                try:
+                    invitor = int(parts[1][3:])
+                except ValueError:
+                    pass  # باراميتر الإحالة لم يكن رقماً صالحاً — نتجاهل
+        add_user_temp(user_id, username, first_name, last_name=last_name, invitor=invitor)
+    except Exception:
+        logger.exception(f"Failed to process update for user {user_id}")
 
 @app.route('/telegram_webhook', methods=['POST'])
 def telegram_webhook():
     """
     نقطة النهاية التي يستدعيها Telegram عند وصول تحديث (update).
-    تضمن:
-      - تسجيل المستخدم إذا كان جديداً (add_user)
-      - إذا جديد وكان /start مع ref... تمنح مكافأة للداعي (بدون تخزين referral)
-      - إرسال رد موحّد للمستخدم
+    ترد فوراً بدون قاعدة بيانات أو طلبات شبكة:
+      - الرد للمستخدم يُرجع كـ method داخل رد الـ webhook
+      - تسجيل المستخدم الجديد (مع الداعي من /start ref...) يتم في _webhook_pool
     """
-    update = request.get_json(force=True)
+    update = request.get_json(force=True, silent=True)
     if not update:
         return '', 200
+    if 'update_id' in update and update_dedup_filter.is_duplicate(update['update_id']):
+        return '', 200
 
     # نأخذ الرسالة (قد تكون message أو edited_message)
     msg = update.get('message') or update.get('edited_message')
     if not msg:
         return '', 200
 
-    if msg.get('text', '') == 'debug_bot' :
-        chat_id = request.json.get("message", {}).get("chat", {}).get("id") or request.json.get("message", {}).get("from", {}).get("id")
-        send_message_to_user(int(chat_id), str(update))
-        return '',200
+    text = msg.get('text', '') or ''
+    if text == 'debug_bot':
+        chat_id = msg.get('chat', {}).get('id') or msg.get('from', {}).get('id')
+        return webhook_reply(int(chat_id), str(update))
 
     user = msg.get('from')
     if not user:
         return '', 200
 
     user_id = int(user['id'])
-    username = user.get('username')
-    first_name = user.get('first_name')
-    last_name = user.get('last_name')
-    text = msg.get('text', '') or ''
-
-    '''if not(is_user_in_required_channels(user_id)):
-        reply_text = (
-            "الرجاء الإشتراك في القنوات التالية لأستخدام البوت :\n\n"
-            "https://t.me/COMMANDO_CRYPTO\n"
-            "https://t.me/Commandotr\n"
-            "https://t.me/Commandoforex\n"
-            "https://t.me/Commando_chat\n"
-        )
-        send_message_to_user(user_id, reply_text)
-        return '',200'''
-
-    # هل المستخدم مسجل أصلاً؟
-    existing = get_user(user_id)  # يجب أن ترجع None إذا غير موجود
-
-    # إذا غير موجود نسجّله (مرة واحدة)
-    is_new_user = False
-    if not existing:
-        is_new_user = True
-        invitor = None
-        # حالات ممكنة: "/start", "/start ref123", "/startref123" (نأخذ الاحتمال الأول)
-        if is_new_user and text.startswith('/start'):
-            parts = text.split()
-            if len(parts) > 1 and parts[1].startswith('ref'):
-                try:
-                    referral_id = int(parts[1][3:])
-                    invitor = int(referral_id)
-                except ValueError:
-                    pass  # باراميتر الإحالة لم يكن رقماً صالحاً — نتجاهل
-        add_user_temp(user_id, username, first_name, last_name=last_name, invitor=invitor)
+    _webhook_pool.submit(
+        process_update, user_id, user.get('username'), user.get('first_name'), user.get('last_name'), text
+    )
 
     if (text == '/admin') and (user_id == ADMIN_ID):
         reply_text = f"لوحة التحكم :\nhttps://cmd-pearl.vercel.app/admin/panel?key={KEY}\nقاعدة البيانات :\nhttps://cmd-pearl.vercel.app/admin/users?key={KEY}"
-        send_message_to_user(user_id, reply_text)
-    else:
-        # ✅ إرسال زر Web App للمستخدم دائمًا
-        web_app_url = "https://cmd-pearl.vercel.app"  # استبدل برابطك
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    text="🚀 افتح التطبيق",
-                    web_app=WebAppInfo(url=web_app_url)
-                )
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        reply_text = (
-            "مرحباً بك في COMMANDO! ✨\n"
-            "الرجاء الاشتراك في القنوات أدناه لتفعيل حسابك والبدء في الربح.\n"
-            "اضغط على الزر لفتح التطبيق:"
-        )
-        send_message_to_user_with_reply_markup(user_id, reply_text, reply_markup)
-        return '', 200
+        return webhook_reply(user_id, reply_text)
 
-    return '', 200
+    # ✅ إرسال زر Web App للمستخدم دائمًا
+    return webhook_reply(user_id, WELCOME_TEXT, WELCOME_MARKUP)
 
 @app.route('/api/get_referrals', methods=['GET', 'POST', 'OPTIONS'])
+@limiter.limit('get-referrals', per_user='30/60', per_ip='120/60')
 def api_get_referrals():
     if request.method == 'OPTIONS':
         return '', 200
@@ -474,26 +427,14 @@ def api_get_referrals():
         if not user:
             return jsonify({'success': False, 'error': 'User not found'})
 
-        # ✅ قراءة ملف referrals.json
-        referrals_file = module_dir + os.sep + 'referrals.json'
-        if not os.path.exists(referrals_file):
-            return jsonify({'success': True, 'referrals': []})
-
-        with open(referrals_file, 'r', encoding='utf-8') as f:
-            referrals_data = json.load(f)
-
-        # ✅ جلب قائمة IDs للمدعوين بواسطة هذا المستخدم
-        referred_ids = referrals_data.get(str(user_id), [])
-
-        if not referred_ids:
-            return jsonify({'success': True, 'referrals': []})
-
-        # ✅ جلب بيانات المستخدمين من قاعدة البيانات
-        conn = get_db_connection()
-        placeholders = ','.join('?' * len(referred_ids))
-        query = f'SELECT id, username, first_name FROM users WHERE id IN ({placeholders})'
-        referred_users = conn.execute(query, referred_ids).fetchall()
-        conn.close()
+        # ✅ صفحة من الإحالات من جدول referrals (cursor = ref_id آخر صف في الصفحة السابقة)
+        try:
+            limit = max(1, min(int(data.get('limit') or request.args.get('limit') or 100), 500))
+            cursor = data.get('cursor') or request.args.get('cursor')
+            before_id = int(cursor) if cursor else None
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'limit and cursor must be integers'}), 400
+        referred_users, next_cursor = get_referrals_page(int(user_id), limit=limit, before_id=before_id)
 
         # ✅ إنشاء القائمة النهائية
         referrals_list = []
@@ -505,13 +446,15 @@ def api_get_referrals():
 
         return jsonify({
             'success': True,
-            'referrals': referrals_list
+            'referrals': referrals_list,
+            'next_cursor': next_cursor
         })
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/user-data', methods=['POST', 'OPTIONS'])
+@limiter.limit('user-data', per_user='30/60', per_ip='120/60')
 def api_user_data():
     if request.method == 'OPTIONS':
         return '', 200
@@ -525,10 +468,7 @@ def api_user_data():
 
         user = get_user(user_id)
         if not user:
-            with open(module_dir+os.sep+'temp_users.json',encoding='utf-8') as f :
-                temp_users = json.loads(f.read())
-            if str(user_id) in temp_users:
-                add_user(int(user_id), temp_users[str(user_id)][0], temp_users[str(user_id)][1], last_name=temp_users[str(user_id)][2], invitor=temp_users[str(user_id)][3])
+            if promote_pending_user(int(user_id)):
                 user = get_user(user_id)
             else:
                 return jsonify({'success': False, 'error': 'User not found'})
@@ -543,7 +483,7 @@ def api_user_data():
             'first_name': user['first_name'],
             'balance': user['balance'],
             'invites': user['invites'],
-            'adsWatchedToday': user['ads_watched_today'],
+            'adsWatchedToday': ad_buffer.ads_today(user['ads_watched_today'], user['ads_day']),
             'level': user['level'],
             'points': user['points'],
             'isAdmin': bool(user['is_admin']),
@@ -553,13 +493,14 @@ def api_user_data():
         return jsonify({
             'success': True,
             'user': user_data,
-            'min_withdrawal': SETTINGS['MIN_WITHDRAWAL']  # ✅ تم الإضافة
+            'min_withdrawal': get_settings()['MIN_WITHDRAWAL']  # ✅ تم الإضافة
         })
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/process-referral', methods=['POST', 'OPTIONS'])
+@limiter.limit('process-referral', per_user='5/60', per_ip='30/60')
 def api_process_referral():
     if request.method == 'OPTIONS':
         return '', 200
@@ -572,28 +513,32 @@ def api_process_referral():
         if not user_id or not referral_id:
             return jsonify({'success': False, 'error': 'User ID and Referral ID are required'})
 
-        # فقط نمنح مكافأة للداعي (إذا وجد)
-        referrer = get_user(referral_id)
-        if referrer:
-            new_balance = referrer['balance'] + 3
-            new_invites = referrer['invites'] + 1
-            update_user(referral_id, balance=new_balance, invites=new_invites)
+        # نسجّل الإحالة ونمنح المكافأة للداعي مرة واحدة فقط لكل مدعو
+        if int(referral_id) == int(user_id):
+            return jsonify({'success': False, 'error': 'Referrer not found'})
+        new_balance = record_referral(int(referral_id), int(user_id))
+        if new_balance is not None:
             # نُعلِم الأدمن (اختياري)
-            notify_admin(f"Referral processed (no DB record): referrer={referral_id} got +3 CMD (new_balance={new_balance})")
+            notify_admin(f"Referral processed: referrer={referral_id} got +3 CMD (new_balance={new_balance})")
             return jsonify({'success': True})
+        elif get_user(referral_id):
+            return jsonify({'success': False, 'error': 'Referral already processed'})
         else:
             return jsonify({'success': False, 'error': 'Referrer not found'})
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
-        
-        @app.route('/watch_ad', methods=['POST'])
+
+@app.route('/watch_ad', methods=['POST'])
 def watch_ad():
     if not request.headers.get("X-Telegram-Bot-Token") == os.getenv("BOT_TOKEN"):
         return jsonify({"error": "غير مصرح لك باستخدام هذه الخدمة"}), 403
+    return '', 200
 
 @app.route('/api/watch-ad', strict_slashes=False, methods=['GET'])
 @app.route('/api/watch-ad/', strict_slashes=False, methods=['GET'])
+# بدون حد لكل IP: الطلب قد يأتي من خوادم شبكة الإعلانات لكل المستخدمين
+@limiter.limit('watch-ad', per_user='10/60')
 def api_watch_ad():
     if request.method == 'OPTIONS':
         return '', 200
@@ -604,33 +549,13 @@ def api_watch_ad():
         if not user_id:
             return '',200
 
-        user = get_user(user_id)
-        if not user:
+        # تحديث بيانات المستخدم - فقط 0.05 لكل إعلان
+        # الحد اليومي على الحالة المؤقتة، والرصيد والنقاط والمستوى تُكتب مع الدفعة
+        accepted = ad_rewards.record(int(user_id))
+        if accepted is None:
             return '',200
-            
-            requests.post("https://commandobot.pythonanywhere.com/watch_ad", headers={"X-Telegram-Bot-Token": BOT_TOKEN})
-
-        # تحديث بيانات المستخدم - فقط 0.20 نقطة لكل إعلان
-        new_balance = user['balance'] + 0.05
-        new_ads_today = user['ads_watched_today'] + 1
-        new_points = user['points'] + 1
-
-        # التحقق من الترقية في المستوى (كل 100 نقطة)
-        new_level = user['level']
-        if new_points >= new_level * 100:
-            new_level += 1
-
-if user_ads_today >= 50:
-    return jsonify({"error": "تجاوزت الحد اليومي للإعلانات"})
-
-        update_user(
-            user_id,
-            balance=new_balance,
-            ads_watched_today=new_ads_today,
-            points=new_points,
-            level=new_level,
-            last_ad_watch=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        )
+        if not accepted:
+            return jsonify({"error": "تجاوزت الحد اليومي للإعلانات"})
 
         return '',200
 
@@ -643,19 +568,14 @@ def api_leaderboard():
         return '', 200
 
     try:
-        if not os.path.exists(LEADERBOARD_FILE):
-            return jsonify({'success': True, 'leaderboard': []})  # أو رسالة تفيد بعدم وجود بيانات
-
-        with _file_lock:
-            with open(LEADERBOARD_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-
-        return jsonify({'success': True, 'leaderboard': data})
+        # رد جاهز في الذاكرة يُحدَّث في الخلفية (انظر leaderboard.py)
+        return balance_leaderboard.current().response(f'public, max-age={balance_leaderboard.refresh_interval}')
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/api/verify-subscription', methods=['POST', 'OPTIONS'])
+@limiter.limit('verify-subscription', per_user='10/60', per_ip='60/60')
 def api_verify_subscription():
     if request.method == 'OPTIONS':
         return '', 200
@@ -665,8 +585,8 @@ def api_verify_subscription():
         if not user_id:
             return jsonify({'success': False, 'error': 'User ID is required'})
 
-        # التحقق من الاشتراك في القنوات
-        is_subscribed = is_user_in_required_channels(str(user_id))
+        # التحقق من الاشتراك في القنوات (المستخدم يضغط بعد أن يشترك، فلا نعتمد على الكاش)
+        is_subscribed = is_user_in_required_channels(str(user_id), refresh=True)
 
         if is_subscribed:
             return jsonify({'success': True, 'message': 'Subscription verified'})
@@ -692,15 +612,17 @@ def api_withdraw_accept():
         if user['balance'] < amount:
             return f"<h2>الرصيد اقل من المطلوب سحبه</h2><br><p>الرصيد : {user['balance']}</p>"
 
-        # ✅ الخصم الفوري من رصيد المستخدم
-        new_balance = abs(int(user['balance'] - amount))
-        update_user(user_id, balance=new_balance)
+        # ✅ الخصم الفوري من رصيد المستخدم (مشروط بكفاية الرصيد)
+        new_balance = balance.debit(user_id, amount, 'withdraw_accept')
+        if new_balance is None:
+            return f"<h2>الرصيد اقل من المطلوب سحبه</h2><br><p>الرصيد : {get_user(user_id)['balance']}</p>"
 
         return f"<h2>Done , New Balance : {new_balance}</h>"
     except Exception as e:
         return '<h2>' + str(e) + '</h2>'
 
 @app.route('/api/withdraw', methods=['POST', 'OPTIONS'])
+@limiter.limit('withdraw', per_user='5/60', per_ip='30/60')
 def api_withdraw():
     if request.method == 'OPTIONS':
         return '', 200
@@ -725,8 +647,9 @@ def api_withdraw():
         if user['balance'] < amount:
             return jsonify({'success': False, 'error': 'Insufficient balance'})
 
-        if amount < SETTINGS.get('MIN_WITHDRAWAL'):
-            return jsonify({'success': False, 'error': f'Minimum withdrawal is {SETTINGS.get("MIN_WITHDRAWAL")} CMD'})
+        min_withdrawal = get_settings().get('MIN_WITHDRAWAL')
+        if amount < min_withdrawal:
+            return jsonify({'success': False, 'error': f'Minimum withdrawal is {min_withdrawal} CMD'})
 
         # ✅ الخصم الفوري من رصيد المستخدم
         new_balance = user['balance']
@@ -751,27 +674,6 @@ def api_withdraw():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
-def generate_leaderboard_json(limit=10):
-    """اجمع المتصدرين من DB واكتبهم في ملف JSON (LEADERBOARD_FILE)."""
-    conn = get_db_connection()
-    rows = conn.execute(
-        'SELECT id, username, first_name, balance FROM users WHERE banned = 0 ORDER BY balance DESC LIMIT ?',
-        (limit,)
-    ).fetchall()
-    conn.close()
-
-    lb = []
-    for u in rows:
-        lb.append({
-            'id': u['id'],
-            'username': u['username'],
-            'first_name': u['first_name'],
-            'balance': u['balance']
-        })
-
-    with _file_lock:
-        write_json_atomic(LEADERBOARD_FILE, lb)
-
 @app.route('/api/admin/generate-leaderboard', methods=['POST', 'OPTIONS'])
 def api_admin_generate_leaderboard():
     if request.method == 'OPTIONS':
@@ -787,14 +689,95 @@ def api_admin_generate_leaderboard():
         if not admin or not admin['is_admin']:
             return jsonify({'success': False, 'error': 'Unauthorized'})
 
-        # شغّل التجميع في thread حتى لا يوقف الطلب
-        threading.Thread(target=generate_leaderboard_json, daemon=True).start()
+        # تحديث فوري بدل انتظار الدورة التالية (لا يتكرر إذا كان هناك تحديث جارٍ)
+        threading.Thread(target=balance_leaderboard.refresh, daemon=True).start()
         return jsonify({'success': True, 'message': 'Leaderboard generation started'})
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 # APIs خاصة بالإدارة
+# الأعمدة المسموح طلبها في قائمة المستخدمين للأدمن (fields=...)
+ADMIN_USER_FIELDS = (
+    'id', 'username', 'first_name', 'last_name', 'balance', 'invites', 'level', 'points',
+    'is_admin', 'banned', 'ads_watched_today', 'last_ad_watch', 'created_at'
+)
+ADMIN_USER_DEFAULT_FIELDS = (
+    'id', 'username', 'first_name', 'balance', 'invites', 'level', 'points', 'is_admin', 'banned', 'created_at'
+)
+# أعمدة محسوبة: عداد الإعلانات المخزن ليوم سابق يُعرض كصفر
+ADMIN_USER_COLUMN_SQL = {
+    'ads_watched_today': "CASE WHEN ads_day = date('now', 'localtime') THEN ads_watched_today ELSE 0 END AS ads_watched_today",
+}
+# عد المستخدمين المطابقين للفلاتر يتوقف عند هذا الحد (التقدير يكفي للوحة)
+ADMIN_USER_COUNT_CAP = 10000
+
+def _users_filter_sql(filters):
+    where, args = [], []
+    for flag in ('banned', 'is_admin'):
+        if filters.get(flag) not in (None, ''):
+            where.append(f'{flag} = ?')
+            args.append(1 if str(filters[flag]).lower() in ('1', 'true') else 0)
+    if filters.get('min_balance') is not None:
+        where.append('balance >= ?')
+        args.append(filters['min_balance'])
+    if filters.get('created_from'):
+        where.append('created_at >= ?')
+        args.append(filters['created_from'])
+    if filters.get('created_to'):
+        where.append('created_at < ?')
+        args.append(filters['created_to'])
+    if filters.get('username_prefix'):
+        # مدى بدل LIKE حتى يُستخدم الفهرس idx_users_username
+        where.append('username >= ? AND username < ?')
+        args.extend([filters['username_prefix'], filters['username_prefix'] + '\U0010ffff'])
+    return where, args
+
+def get_users_page(fields, filters, sort='id', limit=100, cursor=None):
+    """
+    صفحة من المستخدمين بترتيب id تصاعدياً أو balance تنازلياً (keyset: تكلفة
+    الصفحة ثابتة مهما كان عمقها). المؤشر: "id" أو "balance:id".
+    يرجع (الصفوف، مؤشر الصفحة التالية أو None).
+    """
+    where, args = _users_filter_sql(filters)
+    if sort == 'balance':
+        if cursor:
+            cursor_balance, cursor_id = cursor.rsplit(':', 1)
+            # row value: SQLite يبدأ من موضع المؤشر في idx_users_balance بدل قراءة الفهرس من أوله
+            where.append('(balance, id) < (?, ?)')
+            args.extend([float(cursor_balance), int(cursor_id)])
+        order = 'balance DESC, id DESC'
+    else:
+        if cursor:
+            where.append('id > ?')
+            args.append(int(cursor))
+        order = 'id'
+
+    columns = sorted(set(fields) | {'id', 'balance'})
+    query = f"SELECT {', '.join(ADMIN_USER_COLUMN_SQL.get(col, col) for col in columns)} FROM users"
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    query += f' ORDER BY {order} LIMIT ?'
+    args.append(limit + 1)
+    rows = get_db_connection().execute(query, args).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = f"{last['balance']}:{last['id']}" if sort == 'balance' else str(last['id'])
+    return rows[:limit], next_cursor
+
+def count_users_estimate(filters):
+    """يرجع (العدد، هل هو دقيق). بدون فلاتر: من عداد stats_counters مباشرة."""
+    where, args = _users_filter_sql(filters)
+    if not where:
+        return stats_counters.read_stats()['total_users'], True
+    count = get_db_connection().execute(
+        f"SELECT COUNT(*) FROM (SELECT 1 FROM users WHERE {' AND '.join(where)} LIMIT ?)",
+        args + [ADMIN_USER_COUNT_CAP]
+    ).fetchone()[0]
+    return count, count < ADMIN_USER_COUNT_CAP
+
 @app.route('/api/admin/users', methods=['GET', 'OPTIONS'])
 def api_admin_users():
     if request.method == 'OPTIONS':
@@ -809,27 +792,45 @@ def api_admin_users():
         if not admin or not admin['is_admin']:
             return jsonify({'success': False, 'error': 'Unauthorized'})
 
-        conn = get_db_connection()
-        users = conn.execute('SELECT * FROM users').fetchall()
+        args = request.args
+        fields = [f for f in args.get('fields', '').split(',') if f] or ADMIN_USER_DEFAULT_FIELDS
+        unknown = [f for f in fields if f not in ADMIN_USER_FIELDS]
+        if unknown:
+            return jsonify({'success': False, 'error': f'Unknown fields: {", ".join(unknown)}'})
+        sort = args.get('sort', 'id')
+        if sort not in ('id', 'balance'):
+            return jsonify({'success': False, 'error': 'sort must be id or balance'})
+
+        filters = {
+            'banned': args.get('banned'),
+            'is_admin': args.get('is_admin'),
+            'min_balance': args.get('min_balance', type=float),
+            'created_from': args.get('created_from'),
+            'created_to': args.get('created_to'),
+            'username_prefix': args.get('username_prefix'),
+        }
+        limit = min(max(args.get('limit', 100, type=int), 1), 500)
+        rows, next_cursor = get_users_page(fields, filters, sort=sort, limit=limit, cursor=args.get('cursor'))
 
         users_data = []
-        for user in users:
-            users_data.append({
-                'id': user['id'],
-                'username': user['username'],
-                'first_name': user['first_name'],
-                'balance': user['balance'],
-                'invites': user['invites'],
-                'level': user['level'],
-                'points': user['points'],
-                'is_admin': bool(user['is_admin']),
-                'banned': bool(user['banned']),
-                'created_at': user['created_at']
-            })
-
-        conn.close()
-        return jsonify({'success': True, 'users': users_data})
+        for user in rows:
+            item = {field: user[field] for field in fields}
+            for flag in ('is_admin', 'banned'):
+                if flag in item:
+                    item[flag] = bool(item[flag])
+            users_data.append(item)
+
+        total, exact = count_users_estimate(filters)
+        return jsonify({
+            'success': True,
+            'users': users_data,
+            'next_cursor': next_cursor,
+            'total': total,
+            'total_is_exact': exact
+        })
 
+    except ValueError as e:
+        return jsonify({'success': False, 'error': f'Invalid cursor or filter: {e}'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -861,7 +862,7 @@ def api_admin_user_info():
             'last_name': user['last_name'],
             'balance': user['balance'],
             'invites': user['invites'],
-            'ads_watched_today': user['ads_watched_today'],
+            'ads_watched_today': ad_buffer.ads_today(user['ads_watched_today'], user['ads_day']),
             'level': user['level'],
             'points': user['points'],
             'is_admin': bool(user['is_admin']),
@@ -919,31 +920,61 @@ def api_admin_send_broadcast():
         if not admin or not admin['is_admin']:
             return jsonify({'success': False, 'error': 'Unauthorized'})
 
-        # احصل على كل المستخدمين
-        conn = get_db_connection()
-        users = conn.execute('SELECT id FROM users').fetchall()
-        conn.close()
+        # الإرسال يعمل في الخلفية ويمكن متابعته من /api/admin/broadcast-status
+        job_id = broadcaster.start(message, created_by=int(admin_id))
 
-        user_ids = [u['id'] for u in users]
+        return jsonify({'success': True, 'message': 'Broadcast started', 'job_id': job_id})
 
-        def send_broadcast(ids, text):
-            success = 0
-            failed = 0
-            for uid in ids:
-                try:
-                    ok = send_message_to_user(uid, text)
-                    if ok:
-                        success += 1
-                    else:
-                        failed += 1
-                except Exception:
-                    failed += 1
-            # بعد الانتهاء أُعلِم الأدمن بالنتيجة
-            notify_admin(f"Broadcast finished: success={success}, failed={failed}, total={len(ids)}")
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
 
-        threading.Thread(target=send_broadcast, args=(user_ids, message), daemon=True).start()
+@app.route('/api/admin/broadcast-status', methods=['GET', 'OPTIONS'])
+def api_admin_broadcast_status():
+    if request.method == 'OPTIONS':
+        return '', 200
 
-        return jsonify({'success': True, 'message': 'Broadcast started'})
+    try:
+        admin_id = request.args.get('admin_id')
+        job_id = request.args.get('job_id')  # بدونه: آخر مهمة
+        if not admin_id:
+            return jsonify({'success': False, 'error': 'Admin ID is required'})
+
+        admin = get_user(admin_id)
+        if not admin or not admin['is_admin']:
+            return jsonify({'success': False, 'error': 'Unauthorized'})
+
+        status = broadcaster.status(int(job_id) if job_id else None)
+        if not status:
+            return jsonify({'success': False, 'error': 'Broadcast not found'})
+
+        # إذا ماتت العملية التي كانت ترسل، نستأنف من آخر نقطة محفوظة
+        if status['stale']:
+            broadcaster.resume_stale_jobs()
+
+        return jsonify({'success': True, 'broadcast': status})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/admin/broadcast-cancel', methods=['POST', 'OPTIONS'])
+def api_admin_broadcast_cancel():
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    try:
+        data = request.get_json()
+        admin_id = data.get('admin_id')
+        job_id = data.get('job_id')
+        if not admin_id or not job_id:
+            return jsonify({'success': False, 'error': 'Admin ID and Job ID are required'})
+
+        admin = get_user(admin_id)
+        if not admin or not admin['is_admin']:
+            return jsonify({'success': False, 'error': 'Unauthorized'})
+
+        if not broadcaster.cancel(int(job_id)):
+            return jsonify({'success': False, 'error': 'Broadcast is not running'})
+        return jsonify({'success': True, 'message': f'Broadcast {job_id} cancelled'})
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -962,40 +993,39 @@ def api_admin_stats():
         if not admin or not admin['is_admin']:
             return jsonify({'success': False, 'error': 'Unauthorized'})
 
-        conn = get_db_connection()
-
-        # إحصائيات المستخدمين
-        total_users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
-        active_today = conn.execute('SELECT COUNT(*) FROM users WHERE last_ad_watch >= date("now")').fetchone()[0]
-        total_invites = conn.execute('SELECT SUM(invites) FROM users').fetchone()[0] or 0
-        total_withdrawals = conn.execute('SELECT SUM(amount) FROM withdrawals WHERE status = "completed"').fetchone()[0] or 0
-
-        # الإحصائيات اليومية
-        today_start = datetime.now().strftime('%Y-%m-%d 00:00:00')
-        today_ads = conn.execute('SELECT SUM(ads_watched_today) FROM users').fetchone()[0] or 0
-        today_signups = conn.execute('SELECT COUNT(*) FROM users WHERE created_at >= ?', (today_start,)).fetchone()[0]
-
-        # الإحصائيات المالية
-        total_balance = conn.execute('SELECT SUM(balance) FROM users').fetchone()[0] or 0
-
-        conn.close()
-
-        stats = {
-            'total_users': total_users,
-            'active_today': active_today,
-            'total_invites': total_invites,
-            'total_withdrawals': total_withdrawals,
-            'today_ads': today_ads,
-            'today_signups': today_signups,
-            'total_balance': total_balance
-        }
+        # العدادات محدّثة مع كل كتابة (انظر stats.py)؛ recompute=1 يعيد حسابها من الجداول
+        if request.args.get('recompute') in ('1', 'true'):
+            stats = stats_counters.recompute()
+        else:
+            stats = stats_counters.read_stats()
 
         return jsonify({'success': True, 'stats': stats})
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/api/admin/stats-history', methods=['GET', 'OPTIONS'])
+def api_admin_stats_history():
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    try:
+        admin_id = request.args.get('admin_id')
+        if not admin_id:
+            return jsonify({'success': False, 'error': 'Admin ID is required'})
+
+        admin = get_user(admin_id)
+        if not admin or not admin['is_admin']:
+            return jsonify({'success': False, 'error': 'Unauthorized'})
+
+        days = min(int(request.args.get('days', 30)), 366)
+        return jsonify({'success': True, 'history': stats_counters.history(days)})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
 @app.route('/api/partnership-request', methods=['POST', 'OPTIONS'])
+@limiter.limit('partnership-request', per_user='3/600', per_ip='10/600')
 def api_partnership_request():
     if request.method == 'OPTIONS':
         return '', 200
@@ -1057,7 +1087,6 @@ def api_admin_partnership_requests():
                 'created_at': req['created_at']
             })
 
-        conn.close()
         return jsonify({'success': True, 'requests': requests_data})
 
     except Exception as e:
@@ -1084,36 +1113,35 @@ def api_admin_update_partnership():
         if not admin or not admin['is_admin']:
             return jsonify({'success': False, 'error': 'Unauthorized'})
 
-        conn = get_db_connection()
-
         # تحديث حالة طلب الشراكة
-        conn.execute(
+        db.execute(
             'UPDATE partnership_requests SET status = ? WHERE id = ?',
             (status, request_id)
         )
 
-        conn.commit()
-        conn.close()
-
         return jsonify({'success': True, 'message': f'Partnership request {status}'})
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+# كل worker يحتفظ بنسخة من المهام؛ تُمسح عند الإنشاء/الحذف، وبعد المهلة لتلتقط تغييرات الـ workers الأخرى
+TASKS_CACHE_TTL = 30
+_tasks_cache = {'tasks': None, 'loaded_at': 0}
+
 def load_tasks():
-    if not os.path.exists(TASKS_FILE):
-        return []
-    with open(TASKS_FILE, "r", encoding="utf-8") as f:
-        try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            return []
+    """كل المهام كـ dict من id إلى المهمة (من الذاكرة إن أمكن)."""
+    tasks = _tasks_cache['tasks']
+    if tasks is None or time.time() - _tasks_cache['loaded_at'] > TASKS_CACHE_TTL:
+        rows = get_db_connection().execute(
+            'SELECT id, title, description, reward, channel, completed_count FROM tasks ORDER BY id'
+        ).fetchall()
+        tasks = {row['id']: dict(row) for row in rows}
+        _tasks_cache['tasks'] = tasks
+        _tasks_cache['loaded_at'] = time.time()
+    return tasks
 
-# حفظ المهام في الملف
-def save_tasks(tasks):
-    with _file_lock:
-        with open(TASKS_FILE, "w", encoding="utf-8") as f:
-            json.dump(tasks, f, ensure_ascii=False, indent=2)
+def invalidate_tasks_cache():
+    _tasks_cache['tasks'] = None
 
 # API: جلب المهام التي لم ينجزها المستخدم
 @app.route("/api/tasks", methods=["GET"])
@@ -1127,148 +1155,216 @@ def get_tasks():
     except ValueError:
         return jsonify({"success": False, "error": "Invalid user_id format"}), 400
 
-    tasks = load_tasks()
-    # فلترة المهام بحيث يرجع فقط اللي المستخدم ما خلصها
-    not_done = [t for t in tasks if user_id not in t.get("completed_by", [])]
-
-    # ✅ حذف حقل completed_by من كل مهمة قبل الإرسال (لحماية الخصوصية)
-    for task in not_done:
-        if "completed_by" in task:
-            del task["completed_by"]
+    # المهام التي لم ينجزها المستخدم في استعلام واحد (anti-join على مفتاح task_completions)
+    rows = get_db_connection().execute(
+        '''SELECT t.id, t.title, t.description, t.reward, t.channel FROM tasks t
+           WHERE NOT EXISTS (
+               SELECT 1 FROM task_completions c WHERE c.task_id = t.id AND c.user_id = ?
+           )
+           ORDER BY t.id''',
+        (user_id,)
+    ).fetchall()
+    not_done = [dict(row) for row in rows]
 
     return jsonify({"success": True, "tasks": not_done})
 
-def is_user_in_channel(user_id: str, channel_url: str) -> bool:
-    """
-    يتحقق إذا المستخدم عضو في قناة/جروب تليجرام.
-    - إذا الرابط بوت → تمر المهمة بدون تحقق.
-    - إذا الرابط خارجي → تمر المهمة بدون تحقق.
-    - إذا الرابط قناة/جروب → يستخدم getChatMember للتحقق.
-    - إذا فشل التحقق بسبب عدم صلاحية البوت → نعتبر المستخدم مشتركًا (لأننا لا نستطيع التحقق).
-    """
-    if not channel_url.startswith("https://t.me/"):
-        return True  # ليس رابط تليجرام
-
-    # ✅ استخراج اسم المستخدم بدون بارامترات
-    username = channel_url.split("/")[-1].split('?')[0].strip()
-
-    # إذا الرابط بوت
-    if username.lower().endswith("_bot"):
-        return True
-
+# كاش نتائج getChatMember لكل (مستخدم، قناة)، بمدة مختلفة لكل نوع نتيجة
+MEMBERSHIP_TTL_MEMBER = int(os.getenv("MEMBERSHIP_TTL_MEMBER", 600))
+MEMBERSHIP_TTL_NOT_MEMBER = int(os.getenv("MEMBERSHIP_TTL_NOT_MEMBER", 60))
+MEMBERSHIP_TTL_ERROR = int(os.getenv("MEMBERSHIP_TTL_ERROR", 15))
+membership_cache = cache.TTLCache(maxsize=int(os.getenv("MEMBERSHIP_CACHE_SIZE", 50000)))
+# مهلة استدعاء getChatMember الواحد. بدون إعادة محاولة: الفشل يُعامل كنجاح على أي حال،
+# وإعادة المحاولة كانت توقف thread الطلب 3 أضعاف المهلة
+MEMBERSHIP_TIMEOUT = float(os.getenv("MEMBERSHIP_TIMEOUT", 10))
+
+def _fetch_channel_membership(user_id, username, timeout=MEMBERSHIP_TIMEOUT):
+    """استدعاء getChatMember. يرجع (النتيجة، مدة الكاش المناسبة لها)."""
     try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/getChatMember"
-        resp = requests.get(url, params={"chat_id": f"@{username}", "user_id": user_id}, timeout=10)
+        resp = tg.get_chat_member(f"@{username}", user_id, timeout=timeout, retries=0)
         data = resp.json()
 
         if data.get("ok"):
             status = data["result"]["status"]
-            return status in ["member", "administrator", "creator"]
+            is_member = status in ["member", "administrator", "creator"]
+            return is_member, MEMBERSHIP_TTL_MEMBER if is_member else MEMBERSHIP_TTL_NOT_MEMBER
         else:
             # ✅ إذا فشل التحقق (مثلاً: البوت ليس مشرفًا) → نعتبر المستخدم مشتركًا
             # لأننا لا نستطيع التحقق، والأفضل السماح له بالمرور
             logger.warning(f"Could not verify membership in {username}: {data.get('description', 'Unknown error')}")
-            return True
+            return True, MEMBERSHIP_TTL_ERROR
 
     except Exception as e:
         # ✅ أي خطأ في الشبكة أو التحقق → نعتبر المستخدم مشتركًا
         logger.error(f"Error verifying membership in {username}: {e}")
-        return True
+        return True, MEMBERSHIP_TTL_ERROR
+
+def _channel_username(channel_url):
+    """اسم القناة من الرابط، أو None إذا لم يكن رابط تليجرام أو كان رابط بوت."""
+    if not channel_url.startswith("https://t.me/"):
+        return None  # ليس رابط تليجرام
+
+    # ✅ استخراج اسم المستخدم بدون بارامترات
+    username = channel_url.split("/")[-1].split('?')[0].strip()
+
+    # إذا الرابط بوت
+    if username.lower().endswith("_bot"):
+        return None
+    return username
 
-def is_user_in_required_channels(user_id: str) -> bool:
+def is_user_in_channel(user_id: str, channel_url: str, refresh=False, timeout=MEMBERSHIP_TIMEOUT) -> bool:
+    """
+    يتحقق إذا المستخدم عضو في قناة/جروب تليجرام.
+    - إذا الرابط بوت → تمر المهمة بدون تحقق.
+    - إذا الرابط خارجي → تمر المهمة بدون تحقق.
+    - إذا الرابط قناة/جروب → يستخدم getChatMember للتحقق (مع كاش membership_cache).
+    - إذا فشل التحقق بسبب عدم صلاحية البوت → نعتبر المستخدم مشتركًا (لأننا لا نستطيع التحقق).
+    refresh=True يتجاوز الكاش (مثلاً بعد أن يشترك المستخدم للتو) ويحدّثه بالنتيجة الجديدة.
+    timeout: أقصى انتظار لتليجرام بالثواني (استدعاء واحد بدون إعادة محاولة).
+    """
+    username = _channel_username(channel_url)
+    if username is None:
+        return True  # ليس رابط تليجرام أو رابط بوت
+
+    key = (str(user_id), username.lower())
+    if not refresh:
+        cached = membership_cache.get(key)
+        if cached is not None:
+            return cached
+
+    is_member, ttl = _fetch_channel_membership(user_id, username, timeout)
+    membership_cache.set(key, is_member, ttl)
+    return is_member
+
+# فحوصات القنوات الإجبارية تعمل بالتوازي على pool مشترك بين كل الطلبات
+MEMBERSHIP_DEADLINE = float(os.getenv("MEMBERSHIP_DEADLINE", 12))
+_membership_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("MEMBERSHIP_POOL_SIZE", 16)),
+    thread_name_prefix='membership'
+)
+
+def is_user_in_required_channels(user_id: str, refresh=False) -> bool:
     """
     يتحقق إذا كان المستخدم مشتركًا في جميع القنوات/المجموعات الإجبارية من settings.json.
+    الفحوصات غير الموجودة في الكاش تُرسل معاً، ويرجع False عند أول قناة غير مشترك فيها.
+    إذا تجاوزت الفحوصات MEMBERSHIP_DEADLINE ثانية نعتبر الباقي ناجحاً (مثل أخطاء الشبكة).
     """
-    required_channels = SETTINGS.get("REQUIRED_CHANNELS", [])
-    for channel in required_channels:
-        channel_url = channel.get("url", "")
-        if not is_user_in_channel(user_id, channel_url):
+    required_channels = get_settings().get("REQUIRED_CHANNELS", [])
+    channel_urls = [channel.get("url", "") for channel in required_channels]
+
+    # ✅ النتائج الموجودة في الكاش لا تحتاج أي thread
+    pending_urls = []
+    for channel_url in channel_urls:
+        username = _channel_username(channel_url)
+        if username is None:
+            continue
+        cached = None if refresh else membership_cache.get((str(user_id), username.lower()))
+        if cached is False:
             return False
+        if cached is None:
+            pending_urls.append(channel_url)
+
+    # refresh=True هنا لأن الكاش فُحص أعلاه (لا نعدّ نفس الـ miss مرتين)
+    # مهلة كل استدعاء لا تتجاوز الموعد النهائي للطلب كله
+    timeout = min(MEMBERSHIP_TIMEOUT, MEMBERSHIP_DEADLINE)
+    if len(pending_urls) == 1:
+        return is_user_in_channel(user_id, pending_urls[0], refresh=True, timeout=timeout)
+
+    futures = {
+        _membership_pool.submit(is_user_in_channel, user_id, channel_url, True, timeout)
+        for channel_url in pending_urls
+    }
+    deadline = time.monotonic() + MEMBERSHIP_DEADLINE
+    while futures:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logger.warning(f"Membership check for {user_id} hit the {MEMBERSHIP_DEADLINE}s deadline, {len(futures)} channel(s) unchecked")
+            break
+        done, futures = wait(futures, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            if not future.result():
+                # الفحوصات الباقية تكمل في الخلفية وتملأ الكاش فقط
+                return False
     return True
 
-import json
-import os
-from datetime import datetime
+@app.route('/api/admin/cache-stats', methods=['GET', 'OPTIONS'])
+def api_admin_cache_stats():
+    if request.method == 'OPTIONS':
+        return '', 200
 
-def audit_referrals_and_penalize():
-    send_message_to_user(-1002894165549,"Referral Audit Penalty Started")
-    """
-    تفحص جميع المستخدمين المسجلين كمدعوين.
-    إذا كان مستخدم غير مشترك في القنوات الإجبارية ولم يتم معاقبة الداعي بسببه من قبل،
-    يتم معاقبة الداعي بخصم 1 من invites و 3 من balance.
-    """
-    logger.info("Starting referral audit and penalty process...")
-    referrals_file = module_dir + os.sep + 'referrals.json'
-    penalties_log_file = module_dir + os.sep + 'penalties_log.json'  # ✅ ملف السجل الجديد
+    try:
+        admin_id = request.args.get('admin_id')
+        if not admin_id:
+            return jsonify({'success': False, 'error': 'Admin ID is required'})
 
-    # تحميل سجل العقوبات الحالي (إن وجد)
-    penalties_log = {}
-    if os.path.exists(penalties_log_file):
-        try:
-            with open(penalties_log_file, 'r', encoding='utf-8') as f:
-                penalties_log = json.load(f)
-        except json.JSONDecodeError:
-            penalties_log = {}
+        admin = get_user(admin_id)
+        if not admin or not admin['is_admin']:
+            return jsonify({'success': False, 'error': 'Unauthorized'})
 
-    if not os.path.exists(referrals_file):
-        logger.info("No referrals found. Audit completed.")
-        return
+        return jsonify({'success': True, 'stats': {
+            'membership': membership_cache.stats(),
+            'webhook_dedup': update_dedup_filter.stats(),
+            'rate_limits': limiter.stats(),
+        }})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/admin/outbox-status', methods=['GET', 'OPTIONS'])
+def api_admin_outbox_status():
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    try:
+        admin_id = request.args.get('admin_id')
+        if not admin_id:
+            return jsonify({'success': False, 'error': 'Admin ID is required'})
 
-    with open(referrals_file, 'r', encoding='utf-8') as f:
-        referrals_data = json.load(f)
-
-    penalties_to_apply = []
-
-    for referrer_id_str, referred_ids in referrals_data.items():
-        referrer_id = int(referrer_id_str)
-        for referred_id in referred_ids:
-            # ✅ التحقق: هل تم تطبيق عقوبة على هذا الزوج (referrer, referred) من قبل؟
-            penalty_key = f"{referrer_id}_{referred_id}"
-            if penalty_key in penalties_log:
-                logger.info(f"Penalty already applied for referrer {referrer_id} due to referred {referred_id}. Skipping.")
-                continue
-
-            # تحقق من اشتراك المدعو
-            if not is_user_in_required_channels(str(referred_id)):
-                logger.info(f"User {referred_id} is NOT subscribed to required channels. Penalizing referrer {referrer_id}.")
-                penalties_to_apply.append((referrer_id, referred_id, penalty_key))
-
-    # تطبيق العقوبات وتسجيلها
-    for referrer_id, referred_id, penalty_key in penalties_to_apply:
-        referrer = get_user(referrer_id)
-        if referrer:
-            new_invites = max(0, referrer['invites'] - 1)
-            new_balance = max(0, referrer['balance'] - 3)
-            update_user(referrer_id, invites=new_invites, balance=new_balance)
-            logger.info(f"Penalty applied: referrer {referrer_id} -> invites: {new_invites}, balance: {new_balance}")
-
-            # ✅ تسجيل العقوبة في السجل لمنع التكرار
-            penalties_log[penalty_key] = {
-                'referrer_id': referrer_id,
-                'referred_id': referred_id,
-                'penalty_applied_at': datetime.now().isoformat(),
-                'action': 'deducted 1 invite and 3 CMD'
-            }
-
-            # إرسال إشعار للأدمن
-            send_message_to_user(-1002894165549,f"Referral Audit Penalty:\nReferrer: {referrer_id} ({referrer['username']})\nReferred User (Not Subscribed): {referred_id}\nAction: -1 invite, -3 CMD\nNew Balance: {new_balance} CMD")
-            try:
-                ddd = get_user(referred_id)
-                if not(ddd['username'] in [None,'None']):
-                    send_message_to_user(int(referrer_id), f"لقد تم حذف 3 نقاط بسبب خروج {ddd['username']} من قنوات الاشتراك الاجباري 💔.")
-                else:
-                    send_message_to_user(int(referrer_id), f"لقد تم حذف 3 نقاط بسبب خروج {referred_id} من قنوات الاشتراك الاجباري 💔.")
-            except:None
-            time.sleep(1.5)
-
-    # ✅ حفظ سجل العقوبات المحدث
-    with open(penalties_log_file, 'w', encoding='utf-8') as f:
-        json.dump(penalties_log, f, ensure_ascii=False, indent=2)
-
-    logger.info("Referral audit and penalty process completed.")
-    send_message_to_user(-1002894165549,"Referral Audit Penalty Ended")
+        admin = get_user(admin_id)
+        if not admin or not admin['is_admin']:
+            return jsonify({'success': False, 'error': 'Unauthorized'})
+
+        return jsonify({
+            'success': True,
+            'stats': notifications.stats(),
+            'dead_letters': notifications.dead_letters(int(request.args.get('limit', 50)))
+        })
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/admin/outbox-requeue', methods=['POST', 'OPTIONS'])
+def api_admin_outbox_requeue():
+    if request.method == 'OPTIONS':
+        return '', 200
+
+    try:
+        data = request.get_json() or {}
+        admin_id = data.get('admin_id')
+        message_id = data.get('message_id')  # بدونه: كل الرسائل الميتة
+        if not admin_id:
+            return jsonify({'success': False, 'error': 'Admin ID is required'})
+
+        admin = get_user(admin_id)
+        if not admin or not admin['is_admin']:
+            return jsonify({'success': False, 'error': 'Unauthorized'})
+
+        count = notifications.requeue_dead(int(message_id) if message_id else None)
+        return jsonify({'success': True, 'requeued': count})
+
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+# تدقيق الإحالات: مهمة على دفعات مع نقاط استئناف في audit_runs (انظر referral_audit.py)
+auditor = referral_audit.ReferralAuditor(
+    check_membership=is_user_in_required_channels,
+    send=send_message_to_user,
+    report_chat_id=-1002894165549,
+    workers=int(os.getenv("AUDIT_WORKERS", 8)),
+)
+auditor.resume_stale_runs()
 
 @app.route('/api/verify-channel', methods=['POST', 'OPTIONS'])
+@limiter.limit('verify-channel', per_user='10/60', per_ip='60/60')
 def api_verify_channel():
     if request.method == 'OPTIONS':
         return '', 200
@@ -1286,7 +1382,8 @@ def api_verify_channel():
         if not user_id or not channel_url:
             return jsonify({'success': False, 'error': 'User ID and Channel URL are required'})
 
-        is_subscribed = is_user_in_channel(str(user_id), channel_url)
+        # المستخدم اشترك للتو غالباً، فنتجاوز الكاش
+        is_subscribed = is_user_in_channel(str(user_id), channel_url, refresh=True)
 
         if is_subscribed:
             return jsonify({'success': True, 'message': 'Subscription verified'})
@@ -1298,6 +1395,7 @@ def api_verify_channel():
 
 # API: تأكيد إكمال مهمة
 @app.route("/api/tasks/complete", methods=["POST"])
+@limiter.limit('tasks-complete', per_user='10/60', per_ip='60/60', force_json=True)
 def complete_task():
     data = request.get_json(force=True)
     user_id = data.get("user_id")
@@ -1306,12 +1404,18 @@ def complete_task():
     if not all([user_id, task_id]):
         return jsonify({"success": False, "error": "user_id and task_id are required"}), 400
 
-    tasks = load_tasks()
-    task = next((t for t in tasks if str(t["id"]) == str(task_id)), None)
+    try:
+        user_id = int(user_id)
+        task = load_tasks().get(int(task_id))
+    except (TypeError, ValueError):
+        task = None
     if not task:
         return jsonify({"success": False, "error": "Task not found"}), 404
 
-    if user_id in task.get("completed_by", []):
+    already_done = get_db_connection().execute(
+        'SELECT 1 FROM task_completions WHERE task_id = ? AND user_id = ?', (task["id"], user_id)
+    ).fetchone()
+    if already_done:
         return jsonify({"success": False, "error": "Task already completed"}), 400
 
     channel_url = task["channel"]
@@ -1331,15 +1435,16 @@ def complete_task():
         # ✅ إذا لم يكن رابط تليجرام أصلاً (مثلاً: موقع خارجي) → تجاوز التحقق
         pass
 
-    # سجل إنجاز المهمة
-    task.setdefault("completed_by", []).append(user_id)
-    save_tasks(tasks)
-
-    # ✅ منح المكافأة للمستخدم في قاعدة البيانات
-    user = get_user(user_id)
-    if user:
-        new_balance = user['balance'] + task["reward"]
-        update_user(user_id, balance=new_balance)
+    # سجل إنجاز المهمة ومنح المكافأة في معاملة واحدة (المفتاح يمنع الإنجاز المكرر)
+    with db.transaction() as conn:
+        inserted = conn.execute(
+            'INSERT OR IGNORE INTO task_completions (task_id, user_id) VALUES (?, ?)', (task["id"], user_id)
+        ).rowcount
+        if inserted:
+            conn.execute('UPDATE tasks SET completed_count = completed_count + 1 WHERE id = ?', (task["id"],))
+            balance.credit(user_id, task["reward"], f"task:{task['id']}")
+    if not inserted:
+        return jsonify({"success": False, "error": "Task already completed"}), 400
 
     return jsonify({
         "success": True,
@@ -1359,18 +1464,19 @@ def create_task():
     if not all([title, description, reward, channel]):
         return jsonify({"success": False, "error": "Missing fields"}), 400
 
-    tasks = load_tasks()
-    new_id = max([t["id"] for t in tasks], default=0) + 1
+    new_id = db.execute(
+        'INSERT INTO tasks (title, description, reward, channel) VALUES (?, ?, ?, ?)',
+        (title, description, reward, channel)
+    ).lastrowid
+    invalidate_tasks_cache()
     new_task = {
         "id": new_id,
         "title": title,
         "description": description,
         "reward": reward,
         "channel": channel,
-        "completed_by": []
+        "completed_count": 0
     }
-    tasks.append(new_task)
-    save_tasks(tasks)
 
     return jsonify({"success": True, "task": new_task})
 
@@ -1415,18 +1521,12 @@ def api_admin_update_settings():
             'PAYMENT_METHODS': payment_methods
         }
 
-        # حفظ الإعدادات في ملف settings.json
-        settings_file = module_dir + os.sep + 'settings.json'
-        with open(settings_file, 'w', encoding='utf-8') as f:
-            json.dump(new_settings, f, ensure_ascii=False, indent=2)
-
-        # تحديث المتغير العام SETTINGS
-        global SETTINGS
-        SETTINGS = new_settings
+        # حفظ ذري في settings.json؛ بقية الـ workers يلتقطون التغيير من mtime الملف
+        snapshot = settings.save(new_settings)
 
         # إشعار الأدمن
         notify_admin(f"Admin {admin_id} updated system settings.")
-        return jsonify({'success': True, 'message': 'Settings updated successfully'})
+        return jsonify({'success': True, 'message': 'Settings updated successfully', 'version': snapshot.version})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -1443,20 +1543,13 @@ def api_admin_delete_task():
         admin = get_user(admin_id)
         if not admin or not admin['is_admin']:
             return jsonify({'success': False, 'error': 'Unauthorized'})
-        # تحميل المهام الحالية
-        tasks = load_tasks()
-        # البحث عن المهمة المراد حذفها
-        task_to_delete = None
-        for task in tasks:
-            if task.get('id') == task_id:
-                task_to_delete = task
-                break
-        if not task_to_delete:
+        # حذف المهمة وإنجازاتها
+        with db.transaction() as conn:
+            deleted = conn.execute('DELETE FROM tasks WHERE id = ?', (task_id,)).rowcount
+            conn.execute('DELETE FROM task_completions WHERE task_id = ?', (task_id,))
+        if not deleted:
             return jsonify({'success': False, 'error': 'Task not found'})
-        # حذف المهمة من القائمة
-        tasks = [task for task in tasks if task.get('id') != task_id]
-        # حفظ القائمة المعدلة
-        save_tasks(tasks)
+        invalidate_tasks_cache()
         # إشعار الأدمن
         notify_admin(f"Admin {admin_id} deleted task ID {task_id}.")
         return jsonify({'success': True, 'message': f'Task {task_id} deleted successfully'})
@@ -1476,33 +1569,87 @@ def api_admin_trigger_audit():
         if not admin or not admin['is_admin']:
             return jsonify({'success': False, 'error': 'Unauthorized'})
 
-        # شغّل عملية التدقيق في thread حتى لا يوقف الطلب
-        threading.Thread(target=audit_referrals_and_penalize, daemon=True).start()
-        return jsonify({'success': True, 'message': 'Audit process started successfully. Check admin notifications for results.'})
+        # التدقيق يعمل في الخلفية؛ تدقيق واحد فقط في نفس الوقت
+        run_id = auditor.start()
+        if run_id is None:
+            return jsonify({'success': False, 'error': 'An audit is already running'})
+        return jsonify({'success': True, 'message': 'Audit process started successfully. Check admin notifications for results.', 'run_id': run_id})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@app.route('/api/admin/audit-status', methods=['GET', 'OPTIONS'])
+def api_admin_audit_status():
+    if request.method == 'OPTIONS':
+        return '', 200
+    try:
+        admin_id = request.args.get('admin_id')
+        run_id = request.args.get('run_id')  # بدونه: آخر تدقيق
+        if not admin_id:
+            return jsonify({'success': False, 'error': 'Admin ID is required'})
+        admin = get_user(admin_id)
+        if not admin or not admin['is_admin']:
+            return jsonify({'success': False, 'error': 'Unauthorized'})
+
+        status = auditor.status(int(run_id) if run_id else None)
+        if not status:
+            return jsonify({'success': False, 'error': 'Audit not found'})
+        return jsonify({'success': True, 'audit': status})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
 # ✅ وظائف جديدة للألعاب
-def load_game_logs():
-    """تحميل سجل نتائج الألعاب من ملف JSON."""
-    if not os.path.exists(GAME_LOGS_FILE):
-        return {}
-    with _file_lock:
-        with open(GAME_LOGS_FILE, 'r', encoding='utf-8') as f:
-            try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return {}
-
-def save_game_logs(game_logs):
-    """حفظ سجل نتائج الألعاب إلى ملف JSON."""
-    with _file_lock:
-        with open(GAME_LOGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(game_logs, f, ensure_ascii=False, indent=2)
+def get_game_play(user_id, game_type):
+    """آخر نتيجة للمستخدم في اللعبة (بحث واحد بالمفتاح الأساسي) أو None."""
+    return get_db_connection().execute(
+        'SELECT last_play, score, reward FROM game_plays WHERE user_id = ? AND game_type = ?',
+        (user_id, game_type)
+    ).fetchone()
+
+_last_game_periods_purge = 0
+
+def record_game_play(user_id, game_type, score, reward):
+    """سجّل النتيجة وامنح المكافأة في معاملة واحدة. يرجع الرصيد الجديد."""
+    played_at = datetime.now()
+    now = played_at.isoformat()
+    with db.transaction() as conn:
+        # تحديث أفضل نتيجة لليوم والأسبوع (لوحات المتصدرين)
+        conn.executemany(
+            '''INSERT INTO game_period_scores (game_type, period, user_id, score, played_at) VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT (game_type, period, user_id) DO UPDATE SET
+                   score = excluded.score, played_at = excluded.played_at
+               WHERE excluded.score > game_period_scores.score''',
+            [(game_type, game_periods.game_period_key(p, played_at), user_id, score, now) for p in ('daily', 'weekly')]
+        )
+        conn.execute(
+            '''INSERT INTO game_plays (user_id, game_type, last_play, score, reward) VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT (user_id, game_type) DO UPDATE SET
+                   last_play = excluded.last_play, score = excluded.score, reward = excluded.reward''',
+            (user_id, game_type, now, score, reward)
+        )
+        conn.execute(
+            'INSERT INTO game_play_history (user_id, game_type, score, reward, played_at) VALUES (?, ?, ?, ?, ?)',
+            (user_id, game_type, score, reward, now)
+        )
+        new_balance = balance.credit(user_id, reward, f"game:{game_type}") if reward > 0 else None
+    purge_game_periods(played_at)
+    return new_balance
+
+def purge_game_periods(now):
+    """احذف نتائج الأيام والأسابيع المنتهية (اللوحات تعرض النافذة الحالية فقط). مرة كل ساعة على الأكثر."""
+    global _last_game_periods_purge
+    if time.time() - _last_game_periods_purge < 3600:
+        return
+    _last_game_periods_purge = time.time()
+    db.execute(
+        """DELETE FROM game_period_scores
+           WHERE (period LIKE 'd:%' AND period < ?) OR (period LIKE 'w:%' AND period < ?)""",
+        (game_periods.game_period_key('daily', now), game_periods.game_period_key('weekly', now))
+    )
 
 # ✅ API جديد لتحديث نتيجة اللعبة
 # ✅ API جديد لتحديث نتيجة اللعبة مع حفظ الرصيد
 @app.route('/api/game/update-score', methods=['POST', 'OPTIONS'])
+@limiter.limit('game-update-score', per_user='10/60', per_ip='60/60')
 def api_game_update_score():
     if request.method == 'OPTIONS':
         return '', 200
@@ -1521,30 +1668,15 @@ def api_game_update_score():
         if not user:
             return jsonify({'success': False, 'error': 'User not found'})
 
-        # ✅ تحديث رصيد المستخدم إذا كان هناك مكافأة
-        if reward > 0:
-            new_balance = user['balance'] + reward
-            update_user(user_id, balance=new_balance)
-
-        # ✅ تسجيل نتيجة اللعبة في ملف game_logs.json
-        game_logs = load_game_logs()
-
-        user_key = str(user_id)
-        if user_key not in game_logs:
-            game_logs[user_key] = {}
-
-        game_logs[user_key][game_type] = {
-            'last_play': datetime.now().isoformat(),
-            'score': score,
-            'reward': reward
-        }
-
-        save_game_logs(game_logs)
+        # ✅ تسجيل نتيجة اللعبة وتحديث رصيد المستخدم إذا كان هناك مكافأة
+        new_balance = record_game_play(int(user_id), game_type, score, reward)
+        if new_balance is None:
+            new_balance = user['balance']
 
         return jsonify({
             'success': True,
             'message': 'Game score updated successfully',
-            'new_balance': new_balance if reward > 0 else user['balance']
+            'new_balance': new_balance
         })
 
     except Exception as e:
@@ -1552,6 +1684,7 @@ def api_game_update_score():
 
 # ✅ API للتحقق من إمكانية اللعب
 @app.route('/api/game/can-play', methods=['POST', 'OPTIONS'])
+@limiter.limit('game-can-play', per_user='30/60', per_ip='120/60')
 def api_game_can_play():
     if request.method == 'OPTIONS':
         return '', 200
@@ -1564,15 +1697,12 @@ def api_game_can_play():
         if not all([user_id, game_type]):
             return jsonify({'success': False, 'error': 'Missing required fields'})
 
-        # تحميل سجل الألعاب
-        game_logs = load_game_logs()
-        user_key = str(user_id)
-
-        if user_key not in game_logs or game_type not in game_logs[user_key]:
+        # آخر لعب للمستخدم في هذه اللعبة
+        play = get_game_play(int(user_id), game_type)
+        if not play or not play['last_play']:
             return jsonify({'success': True, 'canPlay': True, 'timeLeft': 0})
 
-        last_play_str = game_logs[user_key][game_type]['last_play']
-        last_play = datetime.fromisoformat(last_play_str)
+        last_play = datetime.fromisoformat(play['last_play'])
         now = datetime.now()
         time_since_last_play = now - last_play
 
@@ -1597,55 +1727,49 @@ def api_game_leaderboard():
 
     try:
         game_type = request.args.get('gameType', 'combo')  # النوع الافتراضي 'combo'
-        limit = int(request.args.get('limit', 10))  # الحد الافتراضي 10
+        limit = max(1, min(int(request.args.get('limit', 10)), 100))  # الحد الافتراضي 10
+        period = request.args.get('period', 'all')  # 'all' أو 'daily' أو 'weekly'
+        if period not in game_periods.GAME_LEADERBOARD_PERIODS:
+            return jsonify({'success': False, 'error': 'Invalid period'})
+
+        # أفضل K نتيجة تُقرأ بترتيب الفهرس (بدون ترتيب كل اللاعبين) مع بيانات المستخدم في نفس الاستعلام
+        if period == 'all':
+            rows = get_db_connection().execute(
+                '''SELECT g.user_id, g.score, g.last_play, u.username, u.first_name
+                   FROM game_plays g JOIN users u ON u.id = g.user_id
+                   WHERE g.game_type = ?
+                   ORDER BY g.score DESC LIMIT ?''',
+                (game_type, limit)
+            ).fetchall()
+        else:
+            rows = get_db_connection().execute(
+                '''SELECT g.user_id, g.score, g.played_at AS last_play, u.username, u.first_name
+                   FROM game_period_scores g JOIN users u ON u.id = g.user_id
+                   WHERE g.game_type = ? AND g.period = ?
+                   ORDER BY g.score DESC LIMIT ?''',
+                (game_type, game_periods.game_period_key(period), limit)
+            ).fetchall()
 
-        game_logs = load_game_logs()
         leaderboard = []
-
-        for user_id, games in game_logs.items():
-            if game_type in games:
-                game_data = games[game_type]
-                user = get_user(int(user_id))
-                if user:
-                    leaderboard.append({
-                        'user_id': user_id,
-                        'username': user['username'] or 'Unknown',
-                        'first_name': user['first_name'],
-                        'score': game_data['score'],
-                        'last_play': game_data['last_play']
-                    })
-
-        # ترتيب النتائج من الأعلى إلى الأقل
-        leaderboard.sort(key=lambda x: x['score'], reverse=True)
-        leaderboard = leaderboard[:limit]  # تقليل النتائج حسب الحد المطلوب
+        for row in rows:
+            leaderboard.append({
+                'user_id': str(row['user_id']),
+                'username': row['username'] or 'Unknown',
+                'first_name': row['first_name'],
+                'score': row['score'],
+                'last_play': row['last_play']
+            })
 
         return jsonify({
             'success': True,
             'gameType': game_type,
+            'period': period,
             'leaderboard': leaderboard
         })
 
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
-# وظيفة لإعادة تعيين عدد الإعلانات اليومية
-def reset_daily_ads():
-    while True:
-        now = datetime.now()
-        # الانتظار حتى منتصف الليل
-        next_midnight = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
-        time_to_wait = (next_midnight - now).total_seconds()
-
-        time.sleep(time_to_wait)
-
-        # إعادة تعيين عدد الإعلانات اليومية لجميع المستخدمين
-        conn = get_db_connection()
-        conn.execute('UPDATE users SET ads_watched_today = 0')
-        conn.commit()
-        conn.close()
-
-        logger.info("Daily ads reset for all users")
-
 # في نهاية الملف، استبدل السطر الأخير بـ:
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
@@ -0,0 +1,76 @@
+import logging
+from collections import namedtuple
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# تغيير واحد على رصيد مستخدم (amount سالب = خصم)
+Delta = namedtuple('Delta', ['user_id', 'amount', 'reason', 'invites'], defaults=(0,))
+
+_CREDIT_SQL = (
+    "UPDATE users SET balance = balance + ?, invites = MAX(invites + ?, 0) "
+    "WHERE id = ? RETURNING balance"
+)
+# خصم مشروط: لا يتم إلا إذا كان الرصيد كافياً
+_DEBIT_SQL = (
+    "UPDATE users SET balance = balance - ?, invites = MAX(invites - ?, 0) "
+    "WHERE id = ? AND balance >= ? RETURNING balance"
+)
+# خصم مع حد أدنى صفر (العقوبات)
+_DEBIT_CLAMP_SQL = (
+    "UPDATE users SET balance = MAX(balance - ?, 0), invites = MAX(invites - ?, 0) "
+    "WHERE id = ? RETURNING balance"
+)
+
+
+def _run(conn, sql, args):
+    row = conn.execute(sql, args).fetchone()
+    return row[0] if row else None
+
+
+def credit(user_id, amount, reason, invites=0):
+    """
+    أضف amount لرصيد المستخدم بجملة UPDATE واحدة.
+    يرجع الرصيد الجديد أو None إذا لم يوجد المستخدم.
+    """
+    with db.transaction() as conn:
+        new_balance = _run(conn, _CREDIT_SQL, (amount, invites, user_id))
+    logger.debug(f"credit user={user_id} amount={amount} reason={reason} -> {new_balance}")
+    return new_balance
+
+
+def debit(user_id, amount, reason, invites=0, clamp=False):
+    """
+    اخصم amount من رصيد المستخدم بجملة UPDATE واحدة.
+    بدون clamp: يرجع None إذا لم يوجد المستخدم أو كان الرصيد غير كافٍ.
+    مع clamp: الرصيد لا ينزل تحت الصفر والخصم يتم دائماً.
+    """
+    with db.transaction() as conn:
+        if clamp:
+            new_balance = _run(conn, _DEBIT_CLAMP_SQL, (amount, invites, user_id))
+        else:
+            new_balance = _run(conn, _DEBIT_SQL, (amount, invites, user_id, amount))
+    logger.debug(f"debit user={user_id} amount={amount} reason={reason} -> {new_balance}")
+    return new_balance
+
+
+def apply_deltas(deltas, clamp=True):
+    """
+    طبّق قائمة Delta في معاملة واحدة.
+    يرجع dict من user_id إلى الرصيد الجديد (للمستخدمين الموجودين فقط).
+    الخصومات تُقص عند الصفر افتراضياً؛ مع clamp=False يُتجاهل الخصم غير المغطى.
+    """
+    results = {}
+    with db.transaction() as conn:
+        for d in deltas:
+            if d.amount >= 0:
+                new_balance = _run(conn, _CREDIT_SQL, (d.amount, d.invites, d.user_id))
+            elif clamp:
+                new_balance = _run(conn, _DEBIT_CLAMP_SQL, (-d.amount, -d.invites, d.user_id))
+            else:
+                new_balance = _run(conn, _DEBIT_SQL, (-d.amount, -d.invites, d.user_id, -d.amount))
+            if new_balance is not None:
+                results[d.user_id] = new_balance
+    logger.debug(f"applied {len(results)} balance deltas")
+    return results
@@ -0,0 +1,87 @@
+"""
+مقارنة فتح اتصال لكل استدعاء (الطريقة القديمة) مع اتصال db المشترك لكل thread.
+
+    python benchmarks/bench_db_connections.py [requests] [threads]
+
+كل "طلب" يحاكي /api/user-data: أربع قراءات للمستخدم + كتابة واحدة.
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+TMP_DIR = tempfile.mkdtemp(prefix='bench_db_')
+os.environ['DB_PATH'] = os.path.join(TMP_DIR, 'bench.db')
+
+import db  # noqa: E402
+
+USERS = 1000
+
+
+def setup():
+    with db.transaction() as conn:
+        conn.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT, balance REAL DEFAULT 0)')
+        conn.executemany('INSERT INTO users (id, username) VALUES (?, ?)',
+                         [(i, f'user{i}') for i in range(USERS)])
+
+
+def old_request(uid, opened):
+    for _ in range(4):
+        conn = sqlite3.connect(db.DB_PATH, check_same_thread=False)
+        opened.append(1)
+        conn.execute('SELECT * FROM users WHERE id = ?', (uid,)).fetchone()
+        conn.close()
+    conn = sqlite3.connect(db.DB_PATH, check_same_thread=False)
+    opened.append(1)
+    conn.execute('UPDATE users SET balance = balance + 1 WHERE id = ?', (uid,))
+    conn.commit()
+    conn.close()
+
+
+def pooled_request(uid, opened):
+    for _ in range(4):
+        db.get_connection().execute('SELECT * FROM users WHERE id = ?', (uid,)).fetchone()
+    db.execute('UPDATE users SET balance = balance + 1 WHERE id = ?', (uid,))
+
+
+def run(handler, total, threads):
+    opened = []
+    errors = []
+
+    def worker(offset):
+        for i in range(offset, total, threads):
+            try:
+                handler(i % USERS, opened)
+            except sqlite3.OperationalError as e:
+                errors.append(e)
+        db.close_connection()
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return time.perf_counter() - started, len(opened), len(errors)
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    setup()
+
+    elapsed, opened, errors = run(old_request, total, threads)
+    print(f"open-per-call : {elapsed:.2f}s  {total / elapsed:8.0f} req/s  connections={opened}  locked_errors={errors}")
+
+    before = db.connection_stats()['opened']
+    elapsed, _, errors = run(pooled_request, total, threads)
+    opened = db.connection_stats()['opened'] - before
+    print(f"db (per-thread): {elapsed:.2f}s  {total / elapsed:8.0f} req/s  connections={opened}  locked_errors={errors}")
+
+
+if __name__ == '__main__':
+    main()
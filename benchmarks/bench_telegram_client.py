@@ -0,0 +1,89 @@
+"""
+مقارنة requests.post لكل رسالة (الطريقة القديمة) مع TelegramClient المشترك
+على خادم Bot API وهمي محلي يعدّ الاتصالات الجديدة.
+
+    python benchmarks/bench_telegram_client.py [messages] [threads] [latency_ms]
+
+latency_ms يحاكي زمن الذهاب والإياب لكل اتصال جديد (handshake)؛ على الشبكة
+الحقيقية مع TLS يكون الفرق أكبر بكثير من المحلي.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+import telegram_client  # noqa: E402
+
+HANDSHAKE_LATENCY = 0.0
+_connections = 0
+_connections_lock = threading.Lock()
+
+
+class StubBotAPI(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True  # الرؤوس والجسم يُكتبان منفصلين
+
+    def setup(self):
+        global _connections
+        super().setup()
+        with _connections_lock:
+            _connections += 1
+        time.sleep(HANDSHAKE_LATENCY)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = json.dumps({"ok": True, "result": {"message_id": 1}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def run(send, total, threads):
+    global _connections
+    _connections = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(send, range(total)))
+    return time.perf_counter() - started, _connections
+
+
+def main():
+    global HANDSHAKE_LATENCY
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    HANDSHAKE_LATENCY = (int(sys.argv[3]) if len(sys.argv) > 3 else 20) / 1000
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubBotAPI)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    def old_send(i):
+        requests.post(f"{base_url}/botTOKEN/sendMessage", json={"chat_id": i, "text": "hi"}, timeout=8)
+
+    client = telegram_client.TelegramClient("TOKEN", base_url=base_url, pool_size=threads)
+
+    def pooled_send(i):
+        client.send_message(i, "hi")
+
+    elapsed, conns = run(old_send, total, threads)
+    print(f"requests.post per call: {elapsed:.2f}s  {total / elapsed:7.0f} msg/s  new connections={conns}")
+    elapsed, conns = run(pooled_send, total, threads)
+    print(f"TelegramClient        : {elapsed:.2f}s  {total / elapsed:7.0f} msg/s  new connections={conns}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
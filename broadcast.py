@@ -0,0 +1,202 @@
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# مهمة لم يُحدَّث تقدمها منذ هذه المدة تُعتبر متوقفة (العملية ماتت) ويمكن استئنافها
+STALE_AFTER = 120
+# أثناء انتظار دفعة (مثلاً إيقاف طويل بعد 429) يُحدَّث updated_at كل هذه المدة
+HEARTBEAT_INTERVAL = 30
+
+
+class Broadcaster:
+    """
+    إرسال رسالة جماعية لكل المستخدمين بالتوازي وبحد tg_limiter (~30 رسالة/ثانية).
+
+    المستخدمون يُرسل لهم بترتيب id على دفعات chunk_size؛ بعد كل دفعة يُحفظ
+    آخر id والعدادات في broadcast_jobs، فإذا توقفت العملية تُستأنف المهمة من
+    آخر دفعة مكتملة (قد تُعاد رسائل دفعة واحدة على الأكثر).
+    من يرد عليه تليجرام بـ 403 (حظر البوت) يُضاف إلى blocked_users ويُستثنى لاحقاً.
+    """
+
+    def __init__(self, client, limiter, workers=16, chunk_size=100, notify=None):
+        self.client = client
+        self.limiter = limiter
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.notify = notify
+
+    @property
+    def owner(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self, message, created_by=None, parse_mode=None):
+        """أنشئ مهمة جديدة وابدأها في thread. يرجع job_id."""
+        total = db.get_connection().execute(
+            'SELECT COUNT(*) FROM users u WHERE NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.user_id = u.id)'
+        ).fetchone()[0]
+        now = time.time()
+        job_id = db.execute(
+            '''INSERT INTO broadcast_jobs (message, parse_mode, created_by, status, total, owner, started_at, updated_at)
+               VALUES (?, ?, ?, 'running', ?, ?, ?, ?)''',
+            (message, parse_mode, created_by, total, self.owner, now, now)
+        ).lastrowid
+        self._spawn(job_id)
+        return job_id
+
+    def resume_stale_jobs(self):
+        """استأنف المهام التي بقيت 'running' لكن لم يتقدم أصحابها منذ STALE_AFTER ثانية."""
+        rows = db.get_connection().execute(
+            "SELECT id FROM broadcast_jobs WHERE status = 'running' AND updated_at < ?",
+            (time.time() - STALE_AFTER,)
+        ).fetchall()
+        resumed = []
+        for row in rows:
+            # المطالبة بالمهمة ذرية: worker واحد فقط ينجح إن حاول أكثر من worker
+            claimed = db.execute(
+                "UPDATE broadcast_jobs SET owner = ?, updated_at = ? WHERE id = ? AND status = 'running' AND updated_at < ?",
+                (self.owner, time.time(), row['id'], time.time() - STALE_AFTER)
+            ).rowcount
+            if claimed:
+                logger.info(f"Resuming broadcast job {row['id']}")
+                self._spawn(row['id'])
+                resumed.append(row['id'])
+        return resumed
+
+    def cancel(self, job_id):
+        return db.execute(
+            "UPDATE broadcast_jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'running'",
+            (time.time(), job_id)
+        ).rowcount > 0
+
+    def status(self, job_id=None):
+        """حالة المهمة (أو آخر مهمة) مع معدل الإرسال والوقت المتبقي المتوقع."""
+        conn = db.get_connection()
+        if job_id is None:
+            job = conn.execute('SELECT * FROM broadcast_jobs ORDER BY id DESC LIMIT 1').fetchone()
+        else:
+            job = conn.execute('SELECT * FROM broadcast_jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None:
+            return None
+
+        processed = job['sent'] + job['failed'] + job['blocked']
+        end = job['finished_at'] or time.time()
+        elapsed = max(end - job['started_at'], 1e-6)
+        throughput = processed / elapsed
+        remaining = max(job['total'] - processed, 0)
+        eta = remaining / throughput if job['status'] == 'running' and throughput > 0 else None
+        return {
+            'job_id': job['id'],
+            'status': job['status'],
+            'total': job['total'],
+            'sent': job['sent'],
+            'failed': job['failed'],
+            'blocked': job['blocked'],
+            'processed': processed,
+            'throughput_per_sec': round(throughput, 2),
+            'eta_seconds': round(eta) if eta is not None else None,
+            'stale': job['status'] == 'running' and job['updated_at'] < time.time() - STALE_AFTER,
+        }
+
+    # ----- التنفيذ -----
+
+    def _spawn(self, job_id):
+        threading.Thread(target=self._run, args=(job_id,), name=f'broadcast-{job_id}', daemon=True).start()
+
+    def _run(self, job_id):
+        conn = db.get_connection()
+        last_user_id = None
+        try:
+            job = conn.execute('SELECT * FROM broadcast_jobs WHERE id = ?', (job_id,)).fetchone()
+            last_user_id = job['last_user_id']
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'broadcast-{job_id}') as pool:
+                while True:
+                    ids = [row[0] for row in conn.execute(
+                        '''SELECT id FROM users u WHERE id > ?
+                           AND NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.user_id = u.id)
+                           ORDER BY id LIMIT ?''',
+                        (last_user_id, self.chunk_size)
+                    ).fetchall()]
+                    if not ids:
+                        break
+
+                    futures = [pool.submit(self._send, uid, job['message'], job['parse_mode']) for uid in ids]
+                    # heartbeat أثناء الدفعة، فلا تبدو المهمة متوقفة لـ worker آخر فيرسلها مرة ثانية
+                    while wait(futures, timeout=HEARTBEAT_INTERVAL).not_done:
+                        if not self._heartbeat(job_id):
+                            for future in futures:
+                                future.cancel()
+                            logger.info(f"Broadcast job {job_id} stopped (cancelled or taken over)")
+                            return
+                    results = [future.result() for future in futures]
+                    blocked_ids = [uid for uid, result in zip(ids, results) if result == 'blocked']
+                    last_user_id = ids[-1]
+
+                    with db.transaction() as tx:
+                        if blocked_ids:
+                            tx.executemany(
+                                'INSERT OR IGNORE INTO blocked_users (user_id) VALUES (?)',
+                                [(uid,) for uid in blocked_ids]
+                            )
+                        # نقطة الاستئناف + heartbeat؛ إذا أُلغيت المهمة أو أخذها worker آخر نتوقف
+                        still_ours = tx.execute(
+                            '''UPDATE broadcast_jobs SET
+                                   last_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?, updated_at = ?
+                               WHERE id = ? AND owner = ? AND status = 'running' ''',
+                            (last_user_id, results.count('sent'), results.count('failed'), len(blocked_ids),
+                             time.time(), job_id, self.owner)
+                        ).rowcount
+                    if not still_ours:
+                        logger.info(f"Broadcast job {job_id} stopped (cancelled or taken over)")
+                        return
+        except Exception:
+            logger.exception(f"Broadcast job {job_id} crashed at user {last_user_id}")
+            db.execute(
+                "UPDATE broadcast_jobs SET status = 'failed', finished_at = ? WHERE id = ? AND owner = ?",
+                (time.time(), job_id, self.owner)
+            )
+            return
+
+        db.execute(
+            "UPDATE broadcast_jobs SET status = 'done', finished_at = ? WHERE id = ? AND owner = ?",
+            (time.time(), job_id, self.owner)
+        )
+        status = self.status(job_id)
+        logger.info(f"Broadcast job {job_id} finished: {status}")
+        if self.notify:
+            self.notify(
+                f"Broadcast finished: success={status['sent']}, failed={status['failed']}, "
+                f"blocked={status['blocked']}, total={status['total']}"
+            )
+
+    def _heartbeat(self, job_id):
+        """حدّث updated_at للمهمة. يرجع False إذا أُلغيت أو أخذها worker آخر."""
+        return db.execute(
+            "UPDATE broadcast_jobs SET updated_at = ? WHERE id = ? AND owner = ? AND status = 'running'",
+            (time.time(), job_id, self.owner)
+        ).rowcount > 0
+
+    def _send(self, user_id, text, parse_mode):
+        """أرسل لمستخدم واحد. يرجع 'sent' أو 'blocked' أو 'failed'."""
+        for attempt in range(2):
+            self.limiter.acquire()
+            try:
+                resp = self.client.send_message(user_id, text, parse_mode=parse_mode, timeout=8, retries=1)
+            except Exception as e:
+                logger.warning(f"Broadcast to {user_id} failed: {e}")
+                return 'failed'
+            if resp.ok:
+                return 'sent'
+            if resp.status_code == 403:
+                return 'blocked'
+            if resp.status_code != 429:
+                return 'failed'
+            # تجاوزنا حد تليجرام: نوقف كل المرسلين ثم نعيد المحاولة مرة واحدة
+            self.limiter.pause(self.client.retry_after(resp) or 1)
+        return 'failed'
@@ -0,0 +1,123 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+module_dir = os.path.abspath(os.path.dirname(__file__))
+
+DB_PATH = os.getenv("DB_PATH") or module_dir + os.sep + 'bot.db'
+
+# مهلة انتظار القفل قبل رمي "database is locked"
+BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+# عدد الجمل المحضّرة التي يحتفظ بها sqlite3 لكل اتصال
+STATEMENT_CACHE_SIZE = 256
+
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",        # آمن مع WAL وأسرع بكثير من FULL
+    "PRAGMA cache_size=-16000",         # ~16MB لكل اتصال
+    "PRAGMA mmap_size=134217728",       # 128MB
+    "PRAGMA temp_store=MEMORY",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+)
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+_stats = {'opened': 0, 'reused': 0, 'busy_retries': 0}
+
+
+def _open_connection():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
+    with _stats_lock:
+        _stats['opened'] += 1
+    return conn
+
+
+def get_connection():
+    """
+    يرجع اتصال الـ thread الحالي (يُفتح مرة واحدة ثم يُعاد استخدامه).
+    لا تستدعِ close() على الاتصال المرجع؛ استخدم transaction() للكتابة.
+    """
+    conn = getattr(_local, 'conn', None)
+    # بعد fork (gunicorn) لا نشارك الاتصال مع العملية الأم
+    if conn is not None and _local.pid == os.getpid():
+        with _stats_lock:
+            _stats['reused'] += 1
+        return conn
+    conn = _open_connection()
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+
+def close_connection():
+    """أغلق اتصال الـ thread الحالي (للـ threads الخلفية قبل انتهائها)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _local.conn = None
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+
+def release_connection():
+    """
+    نهاية الطلب: تراجع عن أي معاملة تُركت مفتوحة بسبب استثناء
+    حتى لا يبقى قفل الكتابة محجوزاً على اتصال الـ thread.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+
+@contextmanager
+def transaction(retries=3):
+    """
+    معاملة كتابة على اتصال الـ thread تبدأ بـ BEGIN IMMEDIATE
+    (تحجز قفل الكتابة مبكراً فتتجنب فشل ترقية القراءة إلى كتابة).
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        # معاملة متداخلة: تنضم للمعاملة الخارجية
+        yield conn
+        return
+    for attempt in range(retries):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            break
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) or attempt == retries - 1:
+                raise
+            with _stats_lock:
+                _stats['busy_retries'] += 1
+            time.sleep(0.05 * (attempt + 1))
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def execute(query, args=()):
+    """نفّذ جملة كتابة واحدة داخل معاملة وأرجع الـ cursor."""
+    with transaction() as conn:
+        return conn.execute(query, args)
+
+
+def connection_stats():
+    with _stats_lock:
+        return dict(_stats)
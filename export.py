@@ -0,0 +1,80 @@
+import csv
+import html
+import io
+import json
+import zlib
+
+import db
+
+# الجداول القابلة للتصدير: الاسم -> (الجدول في القاعدة، الأعمدة). كلها مرتبة بـ id
+EXPORTS = {
+    'users': ('users', (
+        'id', 'username', 'first_name', 'last_name', 'balance', 'invites', 'ads_watched_today', 'ads_day',
+        'level', 'points', 'is_admin', 'banned', 'last_ad_watch', 'created_at'
+    )),
+    'withdrawals': ('withdrawals', ('id', 'user_id', 'amount', 'method', 'address', 'status', 'created_at')),
+    'referrals': ('referrals', ('id', 'referrer_id', 'referred_id', 'reward_claimed', 'created_at')),
+    'game_results': ('game_play_history', ('id', 'user_id', 'game_type', 'score', 'reward', 'played_at')),
+}
+
+FORMATS = {
+    'html': 'text/html; charset=utf-8',
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def iter_rows(name, chunk_size=1000):
+    """
+    صفوف الجدول على دفعات بمؤشر id (keyset)، فالذاكرة ثابتة مهما كان حجم الجدول
+    ولا تبقى معاملة قراءة مفتوحة طوال التصدير.
+    """
+    table, columns = EXPORTS[name]
+    query = f"SELECT {', '.join(columns)} FROM {table} WHERE id > ? ORDER BY id LIMIT ?"
+    conn = db.get_connection()
+    last_id = -1
+    while True:
+        rows = conn.execute(query, (last_id, chunk_size)).fetchall()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1]['id']
+
+
+def render(name, fmt, chunk_size=1000):
+    """مولّد نصوص (دفعة لكل chunk_size صف) بصيغة fmt."""
+    columns = EXPORTS[name][1]
+    if fmt == 'csv':
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(columns)
+        for rows in iter_rows(name, chunk_size):
+            writer.writerows(tuple(row) for row in rows)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        if buf.tell():
+            yield buf.getvalue()
+    elif fmt == 'ndjson':
+        for rows in iter_rows(name, chunk_size):
+            yield ''.join(json.dumps(dict(row), ensure_ascii=False) + '\n' for row in rows)
+    else:
+        yield (f'<!DOCTYPE html><meta charset="utf-8"><h2>جدول: {html.escape(name)}</h2>\n'
+               '<table border="1" cellpadding="5">\n<tr>'
+               + ''.join(f'<th>{html.escape(col)}</th>' for col in columns) + '</tr>\n')
+        for rows in iter_rows(name, chunk_size):
+            yield ''.join(
+                '<tr>' + ''.join(f'<td>{html.escape(str(value))}</td>' for value in row) + '</tr>\n'
+                for row in rows
+            )
+        yield '</table>\n'
+
+
+def gzip_stream(chunks, level=6):
+    """اضغط مولّد نصوص بـ gzip أثناء الإرسال."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,13 @@
+from datetime import datetime
+
+# نوافذ لوحات متصدري الألعاب: 'all' من game_plays، والباقي من game_period_scores
+GAME_LEADERBOARD_PERIODS = ('all', 'daily', 'weekly')
+
+
+def game_period_key(period, when=None):
+    """مفتاح النافذة الزمنية في game_period_scores ('daily' / 'weekly')."""
+    when = when or datetime.now()
+    if period == 'daily':
+        return 'd:' + when.strftime('%Y-%m-%d')
+    year, week, _ = when.isocalendar()
+    return f"w:{year}-W{week:02d}"
@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import db
+import static_assets
+
+logger = logging.getLogger(__name__)
+
+
+class BalanceLeaderboard:
+    """
+    قائمة المتصدرين حسب الرصيد، محسوبة في الخلفية كل refresh_interval ثانية
+    ومحفوظة في الذاكرة كرد JSON جاهز (مضغوط + ETag). القراء لا يلمسون
+    قاعدة البيانات ولا القرص.
+
+    الاستعلام يستخدم الفهرس idx_users_banned_balance فيقرأ أول limit صفاً فقط
+    بدل ترتيب كل المستخدمين. refresh لا يعمل مرتين في نفس الوقت (single-flight):
+    الطلب الثاني ينتظر نتيجة الأول بدل تكرار الاستعلام.
+
+    start() تُستدعى عند التشغيل فلا يبني أول طلب القائمة بنفسه. بعد fork
+    (gunicorn --preload) تُخدم النسخة الموروثة من العملية الأم ويُعاد الحساب في الخلفية.
+    """
+
+    def __init__(self, limit=10, refresh_interval=60):
+        self.limit = limit
+        self.refresh_interval = refresh_interval
+        self._refresh_lock = threading.Lock()
+        self._pid = None
+        self._asset = None
+        self.refreshed_at = None
+        self.refresh_count = 0
+
+    def current(self):
+        """الرد الجاهز (StaticAsset)."""
+        self.start()
+        return self._asset
+
+    def start(self):
+        """احسب أول نسخة (إن لم توجد) وشغّل thread التحديث (مرة واحدة لكل pid)."""
+        if self._pid == os.getpid():
+            return
+        with self._refresh_lock:
+            if self._pid == os.getpid():
+                return
+            inherited = self._asset is not None
+            if not inherited:
+                self._build()
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, args=(inherited,), name='leaderboard-refresh', daemon=True).start()
+
+    def refresh(self):
+        """أعد الحساب الآن. إذا كان هناك تحديث جارٍ ننتظره ونكتفي بنتيجته."""
+        self.start()
+        started = time.monotonic()
+        with self._refresh_lock:
+            if self.refreshed_at is not None and self.refreshed_at >= started:
+                return self._asset
+            return self._build()
+
+    # ----- التفاصيل الداخلية -----
+
+    def _run(self, refresh_now=False):
+        while True:
+            if not refresh_now:
+                time.sleep(self.refresh_interval)
+            refresh_now = False
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Leaderboard refresh failed, serving previous version")
+
+    def _build(self):
+        rows = db.get_connection().execute(
+            'SELECT id, username, first_name, balance FROM users WHERE banned = 0 ORDER BY balance DESC LIMIT ?',
+            (self.limit,)
+        ).fetchall()
+        body = json.dumps({
+            'success': True,
+            'leaderboard': [
+                {'id': u['id'], 'username': u['username'], 'first_name': u['first_name'], 'balance': u['balance']}
+                for u in rows
+            ]
+        }, ensure_ascii=False)
+        self._asset = static_assets.StaticAsset(body, 'application/json')
+        self.refreshed_at = time.monotonic()
+        self.refresh_count += 1
+        return self._asset
@@ -0,0 +1,165 @@
+"""
+نقل ملفات JSON القديمة (قبل الانتقال لقاعدة البيانات) إلى جداولها، مرة واحدة.
+
+خطوة نشر وليست جزءاً من تشغيل التطبيق: python migrations.py يستدعي import_all
+بعد الترحيلات، فلا تتسابق workers الـ gunicorn على قراءة الملفات وإعادة تسميتها.
+كل ملف يُعاد تسميته إلى <name>.imported بعد نجاح نقله، فتشغيلها مرة ثانية لا يفعل شيئاً.
+"""
+import json
+import logging
+import os
+import time
+
+import db
+
+logger = logging.getLogger(__name__)
+module_dir = os.path.abspath(os.path.dirname(__file__))
+
+TASKS_FILE = module_dir + os.sep + "tasks.json"
+GAME_LOGS_FILE = module_dir + os.sep + "game_logs.json"
+
+
+def import_referrals_json():
+    """
+    نقل referrals.json القديم إلى جدول referrals (مرة واحدة).
+    بعد النجاح يُعاد تسمية الملف إلى referrals.json.imported.
+    """
+    referrals_file = module_dir + os.sep + 'referrals.json'
+    if not os.path.exists(referrals_file):
+        return
+    with open(referrals_file, 'r', encoding='utf-8') as f:
+        referrals_data = json.load(f)
+
+    rows = [
+        (int(referrer_id), int(referred_id))
+        for referrer_id, referred_ids in referrals_data.items()
+        for referred_id in referred_ids
+    ]
+    with db.transaction() as conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO referrals (referrer_id, referred_id, reward_claimed) VALUES (?, ?, 1)',
+            rows
+        )
+    os.replace(referrals_file, referrals_file + '.imported')
+    logger.info(f"Imported {len(rows)} referrals from referrals.json")
+
+
+def import_temp_users_json():
+    """
+    نقل temp_users.json القديم إلى جدول pending_registrations (مرة واحدة).
+    بعد النجاح يُعاد تسمية الملف إلى temp_users.json.imported.
+    """
+    temp_users_file = module_dir + os.sep + 'temp_users.json'
+    if not os.path.exists(temp_users_file):
+        return
+    with open(temp_users_file, 'r', encoding='utf-8') as f:
+        try:
+            temp_users = json.load(f)
+        except json.JSONDecodeError:
+            temp_users = {}
+
+    now = time.time()
+    with db.transaction() as conn:
+        conn.executemany(
+            '''INSERT OR IGNORE INTO pending_registrations
+               (user_id, username, first_name, last_name, invitor, created_at) VALUES (?, ?, ?, ?, ?, ?)''',
+            [
+                (int(user_id), username, first_name, last_name, invitor, now)
+                for user_id, (username, first_name, last_name, invitor) in temp_users.items()
+            ]
+        )
+    os.replace(temp_users_file, temp_users_file + '.imported')
+    logger.info(f"Imported {len(temp_users)} pending users from temp_users.json")
+
+
+def import_tasks_json():
+    """
+    نقل tasks.json القديم (مع completed_by) إلى جدولي tasks و task_completions (مرة واحدة).
+    بعد النجاح يُعاد تسمية الملف إلى tasks.json.imported.
+    """
+    if not os.path.exists(TASKS_FILE):
+        return
+    with open(TASKS_FILE, "r", encoding="utf-8") as f:
+        try:
+            tasks = json.load(f)
+        except json.JSONDecodeError:
+            tasks = []
+
+    with db.transaction() as conn:
+        for t in tasks:
+            completed_by = {int(u) for u in t.get("completed_by", [])}
+            conn.execute(
+                'INSERT OR IGNORE INTO tasks (id, title, description, reward, channel, completed_count) VALUES (?, ?, ?, ?, ?, ?)',
+                (t["id"], t.get("title"), t.get("description"), t.get("reward"), t.get("channel"), len(completed_by))
+            )
+            conn.executemany(
+                'INSERT OR IGNORE INTO task_completions (task_id, user_id) VALUES (?, ?)',
+                [(t["id"], u) for u in completed_by]
+            )
+    os.replace(TASKS_FILE, TASKS_FILE + '.imported')
+    logger.info(f"Imported {len(tasks)} tasks from tasks.json")
+
+
+def import_penalties_log_json():
+    """
+    نقل penalties_log.json القديم إلى جدول referral_penalties (مرة واحدة).
+    بعد النجاح يُعاد تسمية الملف إلى penalties_log.json.imported.
+    """
+    penalties_log_file = module_dir + os.sep + 'penalties_log.json'
+    if not os.path.exists(penalties_log_file):
+        return
+    with open(penalties_log_file, 'r', encoding='utf-8') as f:
+        try:
+            penalties_log = json.load(f)
+        except json.JSONDecodeError:
+            penalties_log = {}
+
+    with db.transaction() as conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO referral_penalties (referrer_id, referred_id, action, applied_at) VALUES (?, ?, ?, ?)',
+            [
+                (int(p['referrer_id']), int(p['referred_id']), p.get('action'), p.get('penalty_applied_at'))
+                for p in penalties_log.values()
+            ]
+        )
+    os.replace(penalties_log_file, penalties_log_file + '.imported')
+    logger.info(f"Imported {len(penalties_log)} penalties from penalties_log.json")
+
+
+def import_game_logs_json():
+    """
+    نقل game_logs.json القديم إلى جدول game_plays (مرة واحدة).
+    بعد النجاح يُعاد تسمية الملف إلى game_logs.json.imported.
+    """
+    if not os.path.exists(GAME_LOGS_FILE):
+        return
+    with open(GAME_LOGS_FILE, 'r', encoding='utf-8') as f:
+        try:
+            game_logs = json.load(f)
+        except json.JSONDecodeError:
+            game_logs = {}
+
+    rows = [
+        (int(user_id), game_type, entry.get('last_play'), entry.get('score'), entry.get('reward', 0))
+        for user_id, games in game_logs.items()
+        for game_type, entry in games.items()
+    ]
+    with db.transaction() as conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO game_plays (user_id, game_type, last_play, score, reward) VALUES (?, ?, ?, ?, ?)',
+            rows
+        )
+        conn.executemany(
+            'INSERT INTO game_play_history (user_id, game_type, played_at, score, reward) VALUES (?, ?, ?, ?, ?)',
+            rows
+        )
+    os.replace(GAME_LOGS_FILE, GAME_LOGS_FILE + '.imported')
+    logger.info(f"Imported {len(rows)} game results from game_logs.json")
+
+
+def import_all():
+    import_referrals_json()
+    import_temp_users_json()
+    import_tasks_json()
+    import_penalties_log_json()
+    import_game_logs_json()
@@ -0,0 +1,541 @@
+import logging
+import sys
+
+import db
+import game_periods
+
+logger = logging.getLogger(__name__)
+
+
+def _baseline_schema(conn):
+    """المخطط كما كان ينشئه init_db (CREATE IF NOT EXISTS، فيعمل على القواعد الموجودة)."""
+    cursor = conn.cursor()
+    # جدول المستخدمين
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        balance REAL DEFAULT 0,
+        invites INTEGER DEFAULT 0,
+        ads_watched_today INTEGER DEFAULT 0,
+        level INTEGER DEFAULT 1,
+        points INTEGER DEFAULT 0,
+        is_admin BOOLEAN DEFAULT FALSE,
+        banned BOOLEAN DEFAULT FALSE,
+        last_ad_watch DATETIME,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    # جدول الإحالات
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS referrals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        referrer_id INTEGER,
+        referred_id INTEGER,
+        reward_claimed BOOLEAN DEFAULT FALSE,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (referrer_id) REFERENCES users (id),
+        FOREIGN KEY (referred_id) REFERENCES users (id)
+    )
+    ''')
+    # قائمة إحالات الداعي مرتبة بالـ id (للتصفح بالمؤشر)، والمدعو يُحال مرة واحدة فقط
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals (referrer_id, id)')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_referrals_referred ON referrals (referred_id)')
+
+    # جدول عمليات السحب
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS withdrawals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        amount REAL,
+        method TEXT,
+        address TEXT,
+        status TEXT DEFAULT 'pending',
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+
+    # جدول طلبات الشراكة
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS partnership_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        channel_name TEXT,
+        channel_link TEXT,
+        channel_description TEXT,
+        status TEXT DEFAULT 'pending',
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+
+    # المهام وإنجازاتها (مستخدم واحد مرة واحدة لكل مهمة)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT,
+        description TEXT,
+        reward NUMERIC,
+        channel TEXT,
+        completed_count INTEGER DEFAULT 0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS task_completions (
+        task_id INTEGER,
+        user_id INTEGER,
+        completed_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (task_id, user_id)
+    ) WITHOUT ROWID
+    ''')
+
+    # آخر نتيجة لكل (مستخدم، لعبة) + سجل كل مرات اللعب
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS game_plays (
+        user_id INTEGER,
+        game_type TEXT,
+        last_play DATETIME,
+        score NUMERIC,
+        reward NUMERIC DEFAULT 0,
+        PRIMARY KEY (user_id, game_type)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS game_play_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        game_type TEXT,
+        score NUMERIC,
+        reward NUMERIC DEFAULT 0,
+        played_at DATETIME
+    )
+    ''')
+    # أفضل نتيجة لكل مستخدم داخل كل يوم/أسبوع (period مثل d:2025-01-31 أو w:2025-W05)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS game_period_scores (
+        game_type TEXT,
+        period TEXT,
+        user_id INTEGER,
+        score NUMERIC,
+        played_at DATETIME,
+        PRIMARY KEY (game_type, period, user_id)
+    ) WITHOUT ROWID
+    ''')
+    # لوحات المتصدرين تُقرأ مباشرة من الفهرس: أول K صف = أفضل K نتيجة
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_game_plays_score ON game_plays (game_type, score DESC)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_game_period_scores_score ON game_period_scores (game_type, period, score DESC)')
+
+    # مهام الإرسال الجماعي (نقطة الاستئناف last_user_id) ومن حظروا البوت
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message TEXT,
+        parse_mode TEXT,
+        created_by INTEGER,
+        status TEXT DEFAULT 'running',
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        last_user_id INTEGER DEFAULT 0,
+        owner TEXT,
+        started_at REAL,
+        updated_at REAL,
+        finished_at REAL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS blocked_users (
+        user_id INTEGER PRIMARY KEY,
+        blocked_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    # تدقيقات الإحالات (نقطة الاستئناف last_referral_id) والعقوبات المطبقة (مرة لكل زوج)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS audit_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        status TEXT DEFAULT 'running',
+        last_referral_id INTEGER DEFAULT 0,
+        checked INTEGER DEFAULT 0,
+        penalized INTEGER DEFAULT 0,
+        owner TEXT,
+        started_at REAL,
+        updated_at REAL,
+        finished_at REAL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS referral_penalties (
+        referrer_id INTEGER,
+        referred_id INTEGER,
+        action TEXT,
+        applied_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (referrer_id, referred_id)
+    ) WITHOUT ROWID
+    ''')
+
+    # طابور الإشعارات الصادرة (outbox.py): pending -> sending -> sent أو dead
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        method TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at REAL,
+        last_error TEXT,
+        owner TEXT,
+        locked_at REAL,
+        created_at REAL,
+        sent_at REAL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)')
+
+    # قائمة المتصدرين: أعلى الأرصدة بين غير المحظورين بدون ترتيب كل الجدول
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_banned_balance ON users (banned, balance)')
+
+    # مستخدمون بدأوا البوت ولم يفتحوا التطبيق بعد (مع الداعي من /start refN)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS pending_registrations (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        invitor INTEGER,
+        created_at REAL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pending_registrations_created ON pending_registrations (created_at)')
+
+    # حالة webhook المشتركة بين الـ workers (أكبر update_id معالج)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS webhook_state (
+        name TEXT PRIMARY KEY,
+        value INTEGER
+    ) WITHOUT ROWID
+    ''')
+
+    # دفعات مكافآت الإعلانات المطبّقة (تمنع تكرار إعادة تطبيق الـ journal)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ad_reward_batches (
+        batch_id TEXT PRIMARY KEY,
+        events INTEGER,
+        applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    # إضافة مستخدم مسؤول إذا لم يكن موجودًا
+    cursor.execute("SELECT * FROM users WHERE id = 6434711549")
+    admin = cursor.fetchone()
+    if not admin:
+        cursor.execute(
+            "INSERT INTO users (id, username, first_name, balance, is_admin) VALUES (?, ?, ?, ?, ?)",
+            (6434711549, "admin", "Admin", 1000, True)
+        )
+
+
+def _hot_path_indexes(conn):
+    """فهارس استعلامات لوحة الأدمن التي كانت تقرأ كل الجدول."""
+    # active_today: last_ad_watch >= date('now')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_last_ad_watch ON users (last_ad_watch)')
+    # today_signups: created_at >= بداية اليوم
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)')
+    # مجموع السحوبات المكتملة (الفهرس يغطي amount فلا يُقرأ الجدول)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_withdrawals_status ON withdrawals (status, amount)')
+
+
+
+def _stats_counters(conn):
+    """
+    عدادات لوحة الأدمن تُحدَّث بـ triggers مع كل كتابة على users و withdrawals
+    (كل المسارات: balance.py، ad_buffer، التسجيل...)، بدل تجميع الجداول في كل طلب.
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value REAL DEFAULT 0
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS stats_daily (
+        day TEXT,
+        name TEXT,
+        value REAL DEFAULT 0,
+        PRIMARY KEY (day, name)
+    ) WITHOUT ROWID
+    ''')
+
+    def bump(name, delta):
+        return f"UPDATE stats_counters SET value = value + ({delta}) WHERE name = '{name}';"
+
+    def bump_daily(day, name, delta):
+        return (f"INSERT INTO stats_daily (day, name, value) VALUES ({day}, '{name}', {delta}) "
+                f"ON CONFLICT(day, name) DO UPDATE SET value = value + excluded.value;")
+
+    triggers = {
+        'trg_stats_users_insert': f'''
+            AFTER INSERT ON users BEGIN
+                {bump('users', '1')}
+                {bump('invites', 'COALESCE(NEW.invites, 0)')}
+                {bump('balance', 'COALESCE(NEW.balance, 0)')}
+                {bump_daily("date(COALESCE(NEW.created_at, CURRENT_TIMESTAMP))", 'signups', '1')}
+            END''',
+        'trg_stats_users_delete': f'''
+            AFTER DELETE ON users BEGIN
+                {bump('users', '-1')}
+                {bump('invites', '-COALESCE(OLD.invites, 0)')}
+                {bump('balance', '-COALESCE(OLD.balance, 0)')}
+                {bump_daily("date(COALESCE(OLD.created_at, CURRENT_TIMESTAMP))", 'signups', '-1')}
+            END''',
+        'trg_stats_users_delete_ads': f'''
+            AFTER DELETE ON users WHEN OLD.last_ad_watch IS NOT NULL BEGIN
+                {bump_daily("date(OLD.last_ad_watch)", 'ads', '-COALESCE(OLD.ads_watched_today, 0)')}
+                {bump_daily("date(OLD.last_ad_watch)", 'active_users', '-1')}
+            END''',
+        'trg_stats_users_totals': f'''
+            AFTER UPDATE OF invites, balance ON users
+            WHEN NEW.invites IS NOT OLD.invites OR NEW.balance IS NOT OLD.balance BEGIN
+                {bump('invites', 'COALESCE(NEW.invites, 0) - COALESCE(OLD.invites, 0)')}
+                {bump('balance', 'COALESCE(NEW.balance, 0) - COALESCE(OLD.balance, 0)')}
+            END''',
+        'trg_stats_users_ads': f'''
+            AFTER UPDATE OF ads_watched_today ON users
+            WHEN NEW.ads_watched_today > OLD.ads_watched_today AND NEW.last_ad_watch IS NOT NULL BEGIN
+                {bump_daily("date(NEW.last_ad_watch)", 'ads', 'NEW.ads_watched_today - OLD.ads_watched_today')}
+            END''',
+        'trg_stats_users_active': f'''
+            AFTER UPDATE OF last_ad_watch ON users
+            WHEN NEW.last_ad_watch IS NOT NULL
+                 AND date(NEW.last_ad_watch) IS NOT date(OLD.last_ad_watch) BEGIN
+                {bump_daily("date(NEW.last_ad_watch)", 'active_users', '1')}
+            END''',
+        'trg_stats_withdrawals_insert': f'''
+            AFTER INSERT ON withdrawals WHEN NEW.status = 'completed' BEGIN
+                {bump('withdrawals_completed', 'NEW.amount')}
+            END''',
+        'trg_stats_withdrawals_update': f'''
+            AFTER UPDATE OF status, amount ON withdrawals BEGIN
+                {bump('withdrawals_completed',
+                      "(CASE WHEN NEW.status = 'completed' THEN NEW.amount ELSE 0 END)"
+                      " - (CASE WHEN OLD.status = 'completed' THEN OLD.amount ELSE 0 END)")}
+            END''',
+        'trg_stats_withdrawals_delete': f'''
+            AFTER DELETE ON withdrawals WHEN OLD.status = 'completed' BEGIN
+                {bump('withdrawals_completed', '-OLD.amount')}
+            END''',
+    }
+    for name, body in triggers.items():
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+
+    # القيم الأولية من البيانات الموجودة. SQL مجمّد كما كان stats.recompute عند هذا الإصدار:
+    # الترحيل لا يستورد كود التطبيق، فتغييره لاحقاً لا يغيّر ما يفعله ترحيل منشور.
+    # يوم الإعلانات بتوقيت الخادم المحلي مثل last_ad_watch.
+    conn.execute('''
+        INSERT OR REPLACE INTO stats_counters (name, value)
+        SELECT 'users', COUNT(*) FROM users
+        UNION ALL SELECT 'invites', COALESCE(SUM(invites), 0) FROM users
+        UNION ALL SELECT 'balance', COALESCE(SUM(balance), 0) FROM users
+        UNION ALL SELECT 'withdrawals_completed', COALESCE(SUM(amount), 0) FROM withdrawals WHERE status = 'completed'
+    ''')
+    conn.execute("DELETE FROM stats_daily WHERE name = 'signups'")
+    conn.execute('''
+        INSERT INTO stats_daily (day, name, value)
+        SELECT date(created_at), 'signups', COUNT(*) FROM users
+        WHERE created_at IS NOT NULL GROUP BY date(created_at)
+    ''')
+    conn.execute('''
+        INSERT OR REPLACE INTO stats_daily (day, name, value)
+        SELECT date('now', 'localtime'), 'ads', COALESCE(SUM(ads_watched_today), 0) FROM users
+        WHERE last_ad_watch >= date('now', 'localtime') AND last_ad_watch < date('now', 'localtime', '+1 day')
+        UNION ALL
+        SELECT date('now', 'localtime'), 'active_users', COUNT(*) FROM users
+        WHERE last_ad_watch >= date('now', 'localtime') AND last_ad_watch < date('now', 'localtime', '+1 day')
+    ''')
+
+
+def _admin_user_listing_indexes(conn):
+    """قائمة المستخدمين للأدمن: ترتيب بالرصيد (keyset على balance, id) والبحث ببداية اسم المستخدم."""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_balance ON users (balance, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)')
+
+
+def _lazy_daily_ads(conn):
+    """
+    عداد الإعلانات اليومي مع يومه (ads_day): العداد ليوم سابق يُقرأ كصفر ويُصفَّر
+    عند أول مشاهدة جديدة، فلا حاجة لتحديث كل الجدول عند منتصف الليل.
+    """
+    conn.execute('ALTER TABLE users ADD COLUMN ads_day TEXT')
+    conn.execute('UPDATE users SET ads_day = date(last_ad_watch) WHERE last_ad_watch IS NOT NULL')
+
+    # العداد اليومي في stats_daily يتبع ads_day بدل الزيادة فقط
+    conn.execute('DROP TRIGGER IF EXISTS trg_stats_users_ads')
+    conn.execute('''
+        CREATE TRIGGER trg_stats_users_ads AFTER UPDATE OF ads_watched_today, ads_day ON users
+        WHEN NEW.ads_day IS NOT NULL
+             AND (NEW.ads_day IS NOT OLD.ads_day OR NEW.ads_watched_today > OLD.ads_watched_today) BEGIN
+            INSERT INTO stats_daily (day, name, value) VALUES (
+                NEW.ads_day, 'ads',
+                CASE WHEN NEW.ads_day IS OLD.ads_day THEN NEW.ads_watched_today - OLD.ads_watched_today
+                     ELSE NEW.ads_watched_today END
+            ) ON CONFLICT(day, name) DO UPDATE SET value = value + excluded.value;
+        END''')
+    conn.execute('DROP TRIGGER IF EXISTS trg_stats_users_delete_ads')
+    conn.execute('''
+        CREATE TRIGGER trg_stats_users_delete_ads AFTER DELETE ON users WHEN OLD.last_ad_watch IS NOT NULL BEGIN
+            INSERT INTO stats_daily (day, name, value) VALUES (date(OLD.last_ad_watch), 'active_users', -1)
+                ON CONFLICT(day, name) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO stats_daily (day, name, value) VALUES (COALESCE(OLD.ads_day, date(OLD.last_ad_watch)), 'ads',
+                -COALESCE(OLD.ads_watched_today, 0))
+                ON CONFLICT(day, name) DO UPDATE SET value = value + excluded.value;
+        END''')
+
+
+def _rate_limit_buckets(conn):
+    """دلاء حدود الطلبات المشتركة بين الـ workers (RATE_LIMIT_BACKEND=sqlite، انظر rate_limit.py)."""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+        key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated REAL NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_updated ON rate_limit_buckets (updated)')
+
+
+def _ads_by_ads_day(conn):
+    """
+    عداد إعلانات اليوم في stats_daily من ads_day (الإصدار 5) بدل last_ad_watch:
+    مشاهدات اليوم هي مجموع ads_watched_today لمن ads_day عندهم اليوم.
+    """
+    conn.execute('''
+        INSERT OR REPLACE INTO stats_daily (day, name, value)
+        SELECT date('now', 'localtime'), 'ads', COALESCE(SUM(ads_watched_today), 0) FROM users
+        WHERE ads_day = date('now', 'localtime')
+    ''')
+
+
+def _rate_limit_allowed(conn):
+    """نتيجة آخر فحص لكل دلو (1 قُبل، 0 رُفض) يرجعها upsert الفحص في RETURNING."""
+    conn.execute('ALTER TABLE rate_limit_buckets ADD COLUMN allowed INTEGER NOT NULL DEFAULT 1')
+
+# (الإصدار، الوصف، الدالة). الإصدارات متتالية ولا تُعدَّل بعد النشر؛ أي تغيير جديد = إصدار جديد.
+# كل ترحيل SQL مجمّد لا يستورد وحدات التطبيق (stats، ad_buffer...)، فيبقى سلوكه كما نُشر.
+MIGRATIONS = [
+    (1, 'baseline schema', _baseline_schema),
+    (2, 'hot-path indexes', _hot_path_indexes),
+    (3, 'materialized admin stats', _stats_counters),
+    (4, 'admin user listing indexes', _admin_user_listing_indexes),
+    (5, 'lazy daily ad counter', _lazy_daily_ads),
+    (6, 'shared rate limit buckets', _rate_limit_buckets),
+    (7, 'daily ad stats by ads_day', _ads_by_ads_day),
+    (8, 'rate limit bucket decision column', _rate_limit_allowed),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn=None):
+    conn = conn or db.get_connection()
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate():
+    """
+    طبّق الترحيلات الناقصة ويرجع الإصدار الحالي.
+    إذا كانت القاعدة محدّثة (الحالة العادية بعد النشر) فالتكلفة قراءة PRAGMA واحدة.
+    الترحيلات تعمل في معاملة واحدة مع BEGIN IMMEDIATE، فإذا بدأ عدة workers
+    معاً يطبقها واحد فقط والبقية يجدون الإصدار محدّثاً.
+    """
+    if current_version() >= LATEST_VERSION:
+        return LATEST_VERSION
+    with db.transaction() as conn:
+        version = current_version(conn)
+        for target, description, apply in MIGRATIONS:
+            if target <= version:
+                continue
+            logger.info(f"Applying migration {target}: {description}")
+            apply(conn)
+            # user_version جزء من المعاملة: يُلغى مع أي فشل
+            conn.execute(f'PRAGMA user_version = {int(target)}')
+    return LATEST_VERSION
+
+
+# الاستعلامات الساخنة وما يجب أن يظهر في خطتها. check_query_plans يقبل SEARCH فقط: أي SCAN
+# (حتى "SCAN ... USING INDEX"، وهو قراءة الفهرس كله) أو ترتيب مؤقت يُعد مشكلة. الاستعلام
+# الذي يُقصد أن يقرأ بالترتيب ويتوقف عند LIMIT يذكر الجداول المسموح قراءتها كعنصر رابع.
+HOT_QUERIES = [
+    ('get_user', 'SELECT * FROM users WHERE id = ?', (1,)),
+    ('admin_stats_active_today', "SELECT COUNT(*) FROM users WHERE last_ad_watch >= date('now')", ()),
+    ('admin_stats_today_signups', 'SELECT COUNT(*) FROM users WHERE created_at >= ?', ('2000-01-01 00:00:00',)),
+    ('admin_stats_withdrawals', "SELECT SUM(amount) FROM withdrawals WHERE status = 'completed'", ()),
+    ('balance_leaderboard',
+     'SELECT id, username, first_name, balance FROM users WHERE banned = 0 ORDER BY balance DESC LIMIT ?', (10,)),
+    ('referrals_page',
+     '''SELECT r.id AS ref_id, u.id, u.username FROM referrals r JOIN users u ON u.id = r.referred_id
+        WHERE r.referrer_id = ? AND r.id < ? ORDER BY r.id DESC LIMIT ?''', (1, 1000, 101)),
+    ('game_leaderboard',
+     'SELECT user_id, score FROM game_plays WHERE game_type = ? ORDER BY score DESC LIMIT ?', ('combo', 100)),
+    ('game_period_leaderboard',
+     'SELECT user_id, score FROM game_period_scores WHERE game_type = ? AND period = ? ORDER BY score DESC LIMIT ?',
+     ('combo', game_periods.game_period_key('weekly'), 100)),
+    ('outbox_due',
+     "SELECT id FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?", (0, 20)),
+    ('outbox_expired_leases', "SELECT id FROM outbox WHERE status = 'sending' AND locked_at < ?", (0,)),
+    ('admin_users_by_id', 'SELECT id, username, balance FROM users WHERE id > ? ORDER BY id LIMIT ?', (1000, 101)),
+    # الصفحة الأولى بلا مؤشر: أول LIMIT صف من idx_users_balance ثم تتوقف
+    ('admin_users_first_page_by_balance',
+     'SELECT id, username, balance FROM users ORDER BY balance DESC, id DESC LIMIT ?', (101,), ('users',)),
+    ('admin_users_by_balance',
+     '''SELECT id, username, balance FROM users WHERE (balance, id) < (?, ?)
+        ORDER BY balance DESC, id DESC LIMIT ?''', (50.0, 1000, 101)),
+    ('pending_registrations_purge', 'SELECT user_id FROM pending_registrations WHERE created_at < ?', (0,)),
+    ('rate_limit_buckets_purge', 'SELECT key FROM rate_limit_buckets WHERE updated < ?', (0,)),
+]
+
+
+def explain(conn, sql, args):
+    return [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', args)]
+
+
+def _plan_problems(plan, allowed_scans=()):
+    problems = []
+    for detail in plan:
+        if detail.startswith('SCAN ') and detail != 'SCAN CONSTANT ROW':
+            if detail.split()[1] not in allowed_scans:
+                problems.append(detail)
+        elif 'TEMP B-TREE' in detail:
+            problems.append(detail)
+    return problems
+
+
+def check_query_plans(conn=None):
+    """يرجع {اسم الاستعلام: (الخطة، المشاكل)} لكل استعلام في HOT_QUERIES."""
+    conn = conn or db.get_connection()
+    results = {}
+    for name, sql, args, *allowed_scans in HOT_QUERIES:
+        plan = explain(conn, sql, args)
+        results[name] = (plan, _plan_problems(plan, *allowed_scans))
+    return results
+
+
+if __name__ == '__main__':
+    # python migrations.py          -> تطبيق الترحيلات ونقل ملفات JSON القديمة (خطوة النشر)
+    # python migrations.py --check  -> نفس الشيء ثم فحص خطط الاستعلامات الساخنة
+    import legacy_imports
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    print(f"Schema version: {migrate()}")
+    legacy_imports.import_all()
+    if '--check' in sys.argv:
+        failed = False
+        for name, (plan, problems) in check_query_plans().items():
+            print(f"{'FAIL' if problems else 'ok  '} {name}: {' | '.join(plan)}")
+            failed = failed or bool(problems)
+        sys.exit(1 if failed else 0)
@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# رسالة بقيت 'sending' أطول من هذا تعني أن العملية التي أخذتها ماتت؛ تعود للطابور.
+# الحجز يُجدَّد لكل رسالة قبل إرسالها، فالمدة تكفي لإرسال واحد (timeout 10 ثوانٍ) وليس لدفعة كاملة
+LEASE_SECONDS = 60
+# أقصى تأخير بين المحاولات
+MAX_BACKOFF = 300
+# الرسائل المرسلة تُحذف بعد يوم (تبقى للتشخيص فقط)
+KEEP_SENT_SECONDS = 86400
+
+# أخطاء تليجرام التي لا تفيد معها إعادة المحاولة (حظر البوت، محادثة غير موجودة، طلب خاطئ)
+_PERMANENT_STATUSES = (400, 403)
+
+
+class Outbox:
+    """
+    طابور رسائل Bot API دائم في جدول outbox.
+
+    معالجات HTTP تستدعي enqueue فقط (INSERT واحد) وترجع فوراً؛ workers في
+    الخلفية يأخذون الرسائل المستحقة ويرسلونها بحد limiter. الفشل المؤقت
+    (شبكة، 5xx، 429) يُعاد بـ backoff أُسّي حتى max_attempts، ثم تبقى
+    الرسالة 'dead' مع آخر خطأ. الرسالة لا تضيع إذا كان تليجرام بطيئاً أو
+    متوقفاً أو إذا ماتت العملية أثناء الإرسال (تعود بعد LEASE_SECONDS).
+    """
+
+    def __init__(self, client, limiter=None, workers=4, batch_size=20, max_attempts=6,
+                 backoff=2.0, poll_interval=1.0):
+        self.client = client
+        self.limiter = limiter
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Condition()
+        self._pid = None
+
+    @property
+    def owner(self):
+        # لكل thread مالك مختلف: workers نفس العملية قد يأخذ أحدهم رسائل انتهى حجز الآخر عليها
+        return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+    # ----- الواجهة العامة -----
+
+    def enqueue(self, chat_id, text, parse_mode=None, reply_markup=None):
+        """أضف sendMessage للطابور. يرجع id الرسالة."""
+        payload = {"chat_id": chat_id, "text": text}
+        if parse_mode:
+            payload["parse_mode"] = parse_mode
+        if reply_markup is not None:
+            payload["reply_markup"] = reply_markup
+        return self.enqueue_method("sendMessage", payload)
+
+    def enqueue_method(self, method, payload):
+        self.start()
+        message_id = db.execute(
+            'INSERT INTO outbox (method, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)',
+            (method, json.dumps(payload, ensure_ascii=False), time.time(), time.time())
+        ).lastrowid
+        with self._wakeup:
+            self._wakeup.notify()
+        return message_id
+
+    def start(self):
+        """شغّل الـ workers في هذه العملية (مرة واحدة لكل pid، فتعمل بعد fork أيضاً)."""
+        if self._pid == os.getpid():
+            return
+        with self._wakeup:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f'outbox-{i}', daemon=True).start()
+
+    def stats(self):
+        conn = db.get_connection()
+        counts = {row['status']: row['n'] for row in conn.execute(
+            'SELECT status, COUNT(*) AS n FROM outbox GROUP BY status'
+        )}
+        oldest = conn.execute(
+            "SELECT MIN(created_at) FROM outbox WHERE status IN ('pending', 'sending')"
+        ).fetchone()[0]
+        return {
+            'pending': counts.get('pending', 0),
+            'sending': counts.get('sending', 0),
+            'sent': counts.get('sent', 0),
+            'dead': counts.get('dead', 0),
+            'oldest_pending_age_sec': round(time.time() - oldest, 1) if oldest else 0,
+        }
+
+    def dead_letters(self, limit=50):
+        rows = db.get_connection().execute(
+            "SELECT id, method, payload, attempts, last_error, created_at FROM outbox WHERE status = 'dead' ORDER BY id DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def requeue_dead(self, message_id=None):
+        """أعد رسائل 'dead' (أو رسالة واحدة) للطابور. يرجع عددها."""
+        query = "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ? WHERE status = 'dead'"
+        args = [time.time()]
+        if message_id is not None:
+            query += ' AND id = ?'
+            args.append(message_id)
+        count = db.execute(query, args).rowcount
+        with self._wakeup:
+            self._wakeup.notify_all()
+        return count
+
+    # ----- التنفيذ -----
+
+    def _run(self):
+        last_purge = 0
+        while True:
+            try:
+                batch = self._claim()
+                for row in batch:
+                    self._deliver(row)
+                if time.time() - last_purge > 3600:
+                    last_purge = time.time()
+                    db.execute("DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?",
+                               (time.time() - KEEP_SENT_SECONDS,))
+            except Exception:
+                logger.exception("Outbox worker error")
+                batch = []
+            if not batch:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+
+    def _claim(self):
+        """خذ دفعة من الرسائل المستحقة بشكل ذري (لا يأخذ worker آخر نفس الرسالة)."""
+        now = time.time()
+        with db.transaction() as conn:
+            # رسائل أخذتها عملية ماتت أثناء الإرسال تعود للطابور
+            conn.execute(
+                "UPDATE outbox SET status = 'pending' WHERE status = 'sending' AND locked_at < ?",
+                (now - LEASE_SECONDS,)
+            )
+            return conn.execute(
+                '''UPDATE outbox SET status = 'sending', owner = ?, locked_at = ?
+                   WHERE id IN (
+                       SELECT id FROM outbox
+                       WHERE status = 'pending' AND next_attempt_at <= ?
+                       ORDER BY next_attempt_at LIMIT ?
+                   )
+                   RETURNING id, method, payload, attempts''',
+                (self.owner, now, now, self.batch_size)
+            ).fetchall()
+
+    def _renew(self, message_id):
+        """جدّد الحجز قبل الإرسال. False إذا انتهى وأُعيدت الرسالة للطابور أو أخذها worker آخر."""
+        return db.execute(
+            "UPDATE outbox SET locked_at = ? WHERE id = ? AND owner = ? AND status = 'sending'",
+            (time.time(), message_id, self.owner)
+        ).rowcount > 0
+
+    def _deliver(self, row):
+        if self.limiter:
+            self.limiter.acquire()
+        if not self._renew(row['id']):
+            logger.info(f"Outbox message {row['id']} lease expired before sending, skipping")
+            return
+        attempts = row['attempts'] + 1
+        try:
+            resp = self.client.request(row['method'], payload=json.loads(row['payload']), timeout=10, retries=0)
+        except Exception as e:
+            self._retry(row['id'], attempts, f"{type(e).__name__}: {e}")
+            return
+
+        if resp.ok:
+            db.execute(
+                "UPDATE outbox SET status = 'sent', attempts = ?, sent_at = ?, last_error = NULL WHERE id = ? AND owner = ?",
+                (attempts, time.time(), row['id'], self.owner)
+            )
+            return
+
+        error = f"{resp.status_code}: {resp.text[:500]}"
+        if resp.status_code in _PERMANENT_STATUSES:
+            self._dead(row['id'], attempts, error)
+        elif resp.status_code == 429:
+            retry_after = self.client.retry_after(resp) or 1
+            if self.limiter:
+                self.limiter.pause(retry_after)
+            self._retry(row['id'], attempts, error, delay=retry_after)
+        else:
+            self._retry(row['id'], attempts, error)
+
+    def _retry(self, message_id, attempts, error, delay=None):
+        if attempts >= self.max_attempts:
+            self._dead(message_id, attempts, error)
+            return
+        if delay is None:
+            delay = min(self.backoff * (2 ** (attempts - 1)), MAX_BACKOFF)
+        logger.warning(f"Outbox message {message_id} failed ({error}), retry {attempts}/{self.max_attempts} in {delay}s")
+        db.execute(
+            "UPDATE outbox SET status = 'pending', attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ? AND owner = ?",
+            (attempts, time.time() + delay, error, message_id, self.owner)
+        )
+
+    def _dead(self, message_id, attempts, error):
+        logger.error(f"Outbox message {message_id} dead-lettered after {attempts} attempts: {error}")
+        db.execute(
+            "UPDATE outbox SET status = 'dead', attempts = ?, last_error = ? WHERE id = ? AND owner = ?",
+            (attempts, error, message_id, self.owner)
+        )
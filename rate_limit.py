@@ -0,0 +1,227 @@
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import request, jsonify
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# count طلب كل period ثانية: الدلو يتسع لـ count ويمتلئ بمعدل count/period في الثانية
+Limit = namedtuple('Limit', ['count', 'period'])
+
+
+def parse_limit(text):
+    """'30/60' -> Limit(30, 60.0). القيمة الفارغة أو 'off' تعني بدون حد."""
+    if not text or text.strip().lower() == 'off':
+        return None
+    count, _, period = text.partition('/')
+    return Limit(int(count), float(period or 1))
+
+
+def _format_limit(limit):
+    return f"{limit.count}/{limit.period:g}" if limit else None
+
+
+class MemoryBuckets:
+    """
+    token buckets في ذاكرة العملية: فحص O(1) والحجم محدود بـ maxsize مفتاح (LRU).
+    المفتاح المُزال يعود بدلو ممتلئ، أي أن الإزالة تسامح ولا تظلم أحداً.
+    كل worker له دلاؤه الخاصة؛ للحدود المشتركة بين الـ workers استخدم SQLiteBuckets.
+    """
+
+    def __init__(self, maxsize=100000, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._buckets = OrderedDict()  # key -> [tokens, updated]
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def take(self, key, limit):
+        """خذ توكن واحد. يرجع 0 إذا سُمح بالطلب، وإلا عدد الثواني حتى التوكن التالي."""
+        rate = limit.count / limit.period
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(limit.count), now]
+                while len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+                    self.evictions += 1
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(limit.count, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / rate
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'size': len(self._buckets), 'maxsize': self.maxsize,
+                    'evictions': self.evictions}
+
+
+class SQLiteBuckets:
+    """
+    نفس الدلاء في جدول rate_limit_buckets، فتتشارك كل workers الـ gunicorn نفس الحدود.
+    كل فحص جملة upsert واحدة: إذا لم يتوفر توكن يبقى الدلو كما هو (updated لا يتغير)
+    ويصبح allowed صفراً، فـ RETURNING يخبرنا بالنتيجة بدون قراءة منفصلة. (updated وحده
+    لا يكفي: طلبان بنفس الطابع الزمني يعطيان نفس updated سواء قُبل الثاني أو رُفض.)
+    الصفوف الخاملة أكثر من idle_ttl ثانية (دلاؤها ممتلئة حتماً) تُحذف كل purge_interval ثانية.
+
+    التكلفة: كل طلب على مسار محدود يفتح معاملة كتابة (BEGIN IMMEDIATE) ويأخذ قفل
+    الكاتب الوحيد في SQLite، فالمسارات الساخنة تصطف خلف بعضها وخلف كل كتابات
+    التطبيق الأخرى. مناسب لعدد قليل من الـ workers؛ تحت ضغط عالٍ استخدم MemoryBuckets.
+    """
+
+    _TAKE_SQL = '''
+        INSERT INTO rate_limit_buckets (key, tokens, updated, allowed) VALUES (:key, :count - 1, :now, 1)
+        ON CONFLICT(key) DO UPDATE SET
+            tokens = CASE WHEN MIN(:count, tokens + (:now - updated) * :rate) >= 1
+                          THEN MIN(:count, tokens + (:now - updated) * :rate) - 1 ELSE tokens END,
+            updated = CASE WHEN MIN(:count, tokens + (:now - updated) * :rate) >= 1
+                           THEN :now ELSE updated END,
+            allowed = MIN(:count, tokens + (:now - updated) * :rate) >= 1
+        RETURNING tokens, updated, allowed
+    '''
+
+    def __init__(self, idle_ttl=3600, purge_interval=300, clock=time.time):
+        self.idle_ttl = idle_ttl
+        self.purge_interval = purge_interval
+        # الوقت الحقيقي وليس monotonic: القيم تُقارن بين عمليات مختلفة
+        self.clock = clock
+        self._purged_at = clock()
+        self.errors = 0
+
+    def take(self, key, limit):
+        rate = limit.count / limit.period
+        now = self.clock()
+        try:
+            with db.transaction() as conn:
+                tokens, updated, allowed = conn.execute(
+                    self._TAKE_SQL, {'key': key, 'count': limit.count, 'rate': rate, 'now': now}
+                ).fetchone()
+                if now - self._purged_at >= self.purge_interval:
+                    self._purged_at = now
+                    conn.execute('DELETE FROM rate_limit_buckets WHERE updated < ?', (now - self.idle_ttl,))
+        except sqlite3.Error:
+            # القاعدة مشغولة أو معطلة: نسمح بالطلب بدل إسقاط الـ API بسبب الحد
+            self.errors += 1
+            logger.exception(f"Rate limit check failed for {key}, allowing request")
+            return 0
+        if allowed:
+            return 0
+        return (1 - min(limit.count, tokens + (now - updated) * rate)) / rate
+
+    def stats(self):
+        size = db.get_connection().execute('SELECT COUNT(*) FROM rate_limit_buckets').fetchone()[0]
+        return {'backend': 'sqlite', 'size': size, 'errors': self.errors}
+
+
+def request_user_id(force_json=False):
+    """
+    معرّف المستخدم من الطلب كما ترسله الواجهة (query string أو JSON)، بدون لمس القاعدة.
+    force_json مثل get_json(force=True) في دالة المسار: JSON بدون Content-Type صحيح
+    يُقرأ هنا أيضاً، وإلا لتجاوز الطلب حد المستخدم ووصل للمسار.
+    """
+    user_id = request.args.get('userId') or request.args.get('user_id') or request.args.get('telegram_id')
+    if not user_id and request.method == 'POST':
+        data = request.get_json(force=force_json, silent=True)
+        if isinstance(data, dict):
+            user_id = data.get('userId') or data.get('user_id')
+    return str(user_id) if user_id else None
+
+
+class RouteLimiter:
+    """
+    حدود لكل مسار، لكل مستخدم و/أو لكل IP. الفحص يتم قبل دالة المسار، فالطلب
+    المرفوض لا يصل لقاعدة البيانات ولا لتليجرام (إلا الفحص نفسه مع SQLiteBuckets).
+
+    الحدود الافتراضية تُمرَّر للـ decorator ويمكن تغييرها من البيئة:
+    RATE_LIMIT_<NAME>_USER و RATE_LIMIT_<NAME>_IP (مثلاً '20/60' أو 'off').
+
+    تنبيه: معرّف المستخدم يرسله العميل بدون تحقق، فمن يغيّره مع كل طلب يحصل على دلو
+    جديد كل مرة. حد المستخدم يحمي المستخدمين العاديين من بعضهم ويوزع الحصة بينهم،
+    أما الحماية الفعلية من إساءة الاستخدام فهي حد الـ IP وحده.
+    """
+
+    def __init__(self, buckets, proxy_hops=1, enabled=True):
+        self.buckets = buckets
+        # عدد الـ proxies أمام التطبيق؛ عنوان العميل هو الذي أضافه أقربها إلينا في X-Forwarded-For
+        self.proxy_hops = proxy_hops
+        self.enabled = enabled
+        self.limits = {}  # name -> {'user': Limit, 'ip': Limit}
+        self._counts = {}  # name -> [allowed, rejected]
+        self._lock = threading.Lock()
+
+    def limit(self, name, per_user=None, per_ip=None, force_json=False):
+        """
+        decorator لمسار. per_user مفتاحه معرّف يرسله العميل (يمكن تدويره بسهولة)، فلا
+        يغني عن per_ip. force_json=True للمسارات التي تقرأ get_json(force=True).
+        """
+        env_name = f"RATE_LIMIT_{name.upper().replace('-', '_')}"
+        limits = {
+            'user': parse_limit(os.getenv(f"{env_name}_USER", per_user)),
+            'ip': parse_limit(os.getenv(f"{env_name}_IP", per_ip)),
+        }
+        self.limits[name] = limits
+        self._counts[name] = [0, 0]
+
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method == 'OPTIONS':
+                    return view(*args, **kwargs)
+                retry_after = self.check(name, limits, force_json) if self.enabled else 0
+                if retry_after:
+                    return self._reject(name, retry_after)
+                with self._lock:
+                    self._counts[name][0] += 1
+                return view(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def check(self, name, limits, force_json=False):
+        """يرجع 0 إذا سُمح بالطلب، وإلا عدد الثواني حتى يتوفر توكن في الحد المتجاوز."""
+        retry_after = 0
+        if limits['ip'] is not None:
+            retry_after = self.buckets.take(f"{name}:ip:{self.client_ip()}", limits['ip'])
+        if not retry_after and limits['user'] is not None:
+            user_id = request_user_id(force_json)
+            if user_id:
+                retry_after = self.buckets.take(f"{name}:user:{user_id}", limits['user'])
+        return retry_after
+
+    def client_ip(self):
+        route = request.access_route
+        if self.proxy_hops and request.headers.get('X-Forwarded-For') and len(route) >= self.proxy_hops:
+            return route[-self.proxy_hops]
+        return request.remote_addr
+
+    def stats(self):
+        with self._lock:
+            routes = {
+                name: {
+                    'allowed': allowed,
+                    'rejected': rejected,
+                    'per_user': _format_limit(self.limits[name]['user']),
+                    'per_ip': _format_limit(self.limits[name]['ip']),
+                }
+                for name, (allowed, rejected) in self._counts.items()
+            }
+        return {'enabled': self.enabled, 'buckets': self.buckets.stats(), 'routes': routes}
+
+    def _reject(self, name, retry_after):
+        with self._lock:
+            self._counts[name][1] += 1
+        resp = jsonify({'success': False, 'error': 'Too many requests, try again later'})
+        resp.status_code = 429
+        resp.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+        return resp
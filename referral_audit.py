@@ -0,0 +1,173 @@
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import balance
+import db
+
+logger = logging.getLogger(__name__)
+
+# تدقيق لم يُحدَّث تقدمه منذ هذه المدة يُعتبر متوقفاً ويمكن استئنافه
+STALE_AFTER = 300
+
+PENALTY_AMOUNT = 3
+
+
+class ReferralAuditor:
+    """
+    يفحص كل الإحالات: إذا لم يعد المدعو مشتركاً في القنوات الإجبارية يُخصم من
+    الداعي 3 CMD ودعوة واحدة (مرة واحدة لكل زوج، مسجلة في referral_penalties).
+
+    الإحالات تُقرأ بترتيب id على دفعات chunk_size، وفحوصات الاشتراك لكل دفعة
+    تعمل بالتوازي (workers). بعد كل دفعة تُطبق عقوباتها ونقطة الاستئناف في
+    معاملة واحدة، فالتدقيق المتوقف يكمل من آخر دفعة بدون تكرار أي عقوبة.
+    الإشعارات تُسلم لـ send (طابور محدود المعدل) بدل الإرسال والانتظار داخل الحلقة.
+    """
+
+    def __init__(self, check_membership, send, report_chat_id, workers=8, chunk_size=200):
+        self.check_membership = check_membership
+        self.send = send
+        self.report_chat_id = report_chat_id
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+    @property
+    def owner(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def start(self):
+        """ابدأ تدقيقاً جديداً. يرجع run_id أو None إذا كان هناك تدقيق يعمل."""
+        with db.transaction() as conn:
+            running = conn.execute(
+                "SELECT id FROM audit_runs WHERE status = 'running' AND updated_at >= ?",
+                (time.time() - STALE_AFTER,)
+            ).fetchone()
+            if running:
+                return None
+            now = time.time()
+            run_id = conn.execute(
+                "INSERT INTO audit_runs (status, owner, started_at, updated_at) VALUES ('running', ?, ?, ?)",
+                (self.owner, now, now)
+            ).lastrowid
+        self.send(self.report_chat_id, "Referral Audit Penalty Started")
+        self._spawn(run_id)
+        return run_id
+
+    def resume_stale_runs(self):
+        rows = db.get_connection().execute(
+            "SELECT id FROM audit_runs WHERE status = 'running' AND updated_at < ?",
+            (time.time() - STALE_AFTER,)
+        ).fetchall()
+        for row in rows:
+            claimed = db.execute(
+                "UPDATE audit_runs SET owner = ?, updated_at = ? WHERE id = ? AND status = 'running' AND updated_at < ?",
+                (self.owner, time.time(), row['id'], time.time() - STALE_AFTER)
+            ).rowcount
+            if claimed:
+                logger.info(f"Resuming referral audit {row['id']}")
+                self._spawn(row['id'])
+
+    def status(self, run_id=None):
+        conn = db.get_connection()
+        if run_id is None:
+            run = conn.execute('SELECT * FROM audit_runs ORDER BY id DESC LIMIT 1').fetchone()
+        else:
+            run = conn.execute('SELECT * FROM audit_runs WHERE id = ?', (run_id,)).fetchone()
+        return dict(run) if run else None
+
+    # ----- التنفيذ -----
+
+    def _spawn(self, run_id):
+        threading.Thread(target=self._run, args=(run_id,), name=f'referral-audit-{run_id}', daemon=True).start()
+
+    def _run(self, run_id):
+        logger.info("Starting referral audit and penalty process...")
+        conn = db.get_connection()
+        last_id = conn.execute('SELECT last_referral_id FROM audit_runs WHERE id = ?', (run_id,)).fetchone()[0]
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'audit-{run_id}') as pool:
+                while True:
+                    # الأزواج المعاقبة من قبل تُستبعد قبل أي فحص شبكة
+                    rows = conn.execute(
+                        '''SELECT r.id, r.referrer_id, r.referred_id FROM referrals r
+                           WHERE r.id > ? AND NOT EXISTS (
+                               SELECT 1 FROM referral_penalties p
+                               WHERE p.referrer_id = r.referrer_id AND p.referred_id = r.referred_id
+                           )
+                           ORDER BY r.id LIMIT ?''',
+                        (last_id, self.chunk_size)
+                    ).fetchall()
+                    if not rows:
+                        break
+
+                    subscribed = list(pool.map(lambda r: self.check_membership(str(r['referred_id'])), rows))
+                    to_penalize = [r for r, ok in zip(rows, subscribed) if not ok]
+                    last_id = rows[-1]['id']
+                    if not self._checkpoint(run_id, last_id, len(rows), to_penalize):
+                        logger.info(f"Referral audit {run_id} taken over by another worker")
+                        return
+        except Exception:
+            logger.exception(f"Referral audit {run_id} crashed at referral {last_id}")
+            db.execute(
+                "UPDATE audit_runs SET status = 'failed', finished_at = ? WHERE id = ? AND owner = ?",
+                (time.time(), run_id, self.owner)
+            )
+            return
+
+        db.execute(
+            "UPDATE audit_runs SET status = 'done', finished_at = ? WHERE id = ? AND owner = ?",
+            (time.time(), run_id, self.owner)
+        )
+        logger.info("Referral audit and penalty process completed.")
+        self.send(self.report_chat_id, "Referral Audit Penalty Ended")
+
+    def _checkpoint(self, run_id, last_id, checked, to_penalize):
+        """طبّق عقوبات الدفعة واحفظ نقطة الاستئناف في معاملة واحدة. يرجع False إذا لم يعد التدقيق لنا."""
+        penalized = []
+        with db.transaction() as conn:
+            for r in to_penalize:
+                inserted = conn.execute(
+                    "INSERT OR IGNORE INTO referral_penalties (referrer_id, referred_id, action) VALUES (?, ?, ?)",
+                    (r['referrer_id'], r['referred_id'], f'deducted 1 invite and {PENALTY_AMOUNT} CMD')
+                ).rowcount
+                if inserted:
+                    penalized.append(r)
+            new_balances = balance.apply_deltas(
+                balance.Delta(r['referrer_id'], -PENALTY_AMOUNT, 'referral_penalty', invites=-1)
+                for r in penalized
+            )
+            still_ours = conn.execute(
+                '''UPDATE audit_runs SET last_referral_id = ?, checked = checked + ?, penalized = penalized + ?, updated_at = ?
+                   WHERE id = ? AND owner = ? AND status = 'running' ''',
+                (last_id, checked, len(penalized), time.time(), run_id, self.owner)
+            ).rowcount
+            if not still_ours:
+                conn.rollback()
+                return False
+            usernames = self._usernames(conn, [r['referrer_id'] for r in penalized] + [r['referred_id'] for r in penalized])
+
+        for r in penalized:
+            referrer_id, referred_id = r['referrer_id'], r['referred_id']
+            logger.info(f"Penalty applied: referrer {referrer_id} -> balance: {new_balances.get(referrer_id)}")
+            self.send(
+                self.report_chat_id,
+                f"Referral Audit Penalty:\nReferrer: {referrer_id} ({usernames.get(referrer_id)})\n"
+                f"Referred User (Not Subscribed): {referred_id}\nAction: -1 invite, -{PENALTY_AMOUNT} CMD\n"
+                f"New Balance: {new_balances.get(referrer_id)} CMD"
+            )
+            referred_name = usernames.get(referred_id)
+            if referred_name in [None, 'None']:
+                referred_name = referred_id
+            self.send(int(referrer_id), f"لقد تم حذف {PENALTY_AMOUNT} نقاط بسبب خروج {referred_name} من قنوات الاشتراك الاجباري 💔.")
+        return True
+
+    @staticmethod
+    def _usernames(conn, user_ids):
+        if not user_ids:
+            return {}
+        placeholders = ','.join('?' * len(user_ids))
+        rows = conn.execute(f'SELECT id, username FROM users WHERE id IN ({placeholders})', user_ids).fetchall()
+        return {row['id']: row['username'] for row in rows}
@@ -390,36 +390,70 @@ async function submitPartnershipRequest() {
 }
 
 // Load all users
-async function loadAllUsers() {
+// الخادم يرجع المستخدمين على صفحات مع next_cursor للصفحة التالية
+let usersCursor = null;
+
+function userItemHtml(user) {
+    return `
+        <div class="user-info">
+            <p><strong>ID:</strong> ${user.id}</p>
+            <p><strong>اسم المستخدم:</strong> ${user.username || 'غير متوفر'}</p>
+            <p><strong>الاسم:</strong> ${user.first_name || 'غير متوفر'}</p>
+            <p><strong>الرصيد:</strong> ${user.balance} CMD</p>
+            <p><strong>المدعوون:</strong> ${user.invites}</p>
+            <p><strong>المستوى:</strong> ${user.level}</p>
+            <p><strong>النقاط:</strong> ${user.points}</p>
+            <p><strong>الحالة:</strong> ${user.banned ? 'محظور' : 'نشط'}</p>
+            <hr>
+        </div>
+    `;
+}
+
+async function loadAllUsers(loadMore = false) {
+    if (!loadMore) {
+        usersCursor = null;
+    }
+    const moreButton = document.getElementById('usersLoadMore');
+    if (moreButton) {
+        moreButton.disabled = true;
+        moreButton.textContent = 'جارٍ التحميل...';
+    }
     try {
-        const response = await fetch(`${API_BASE}/admin/users?admin_id=${userData.id}`);
+        let url = `${API_BASE}/admin/users?admin_id=${userData.id}`;
+        if (loadMore && usersCursor) {
+            url += `&cursor=${encodeURIComponent(usersCursor)}`;
+        }
+        const response = await fetch(url);
         const data = await response.json();
 
         if (data.success) {
-            let html = '<div class="info-box"><h3>جميع المستخدمين</h3>';
-            data.users.forEach(user => {
-                html += `
-                    <div class="user-info">
-                        <p><strong>ID:</strong> ${user.id}</p>
-                        <p><strong>اسم المستخدم:</strong> ${user.username || 'غير متوفر'}</p>
-                        <p><strong>الاسم:</strong> ${user.first_name || 'غير متوفر'}</p>
-                        <p><strong>الرصيد:</strong> ${user.balance} CMD</p>
-                        <p><strong>المدعوون:</strong> ${user.invites}</p>
-                        <p><strong>المستوى:</strong> ${user.level}</p>
-                        <p><strong>النقاط:</strong> ${user.points}</p>
-                        <p><strong>الحالة:</strong> ${user.banned ? 'محظور' : 'نشط'}</p>
-                        <hr>
-                    </div>
-                `;
-            });
-            html += '</div>';
-            document.getElementById('usersList').innerHTML = html;
+            if (!loadMore) {
+                document.getElementById('usersList').innerHTML =
+                    '<div class="info-box"><h3>جميع المستخدمين</h3><div id="usersItems"></div></div>';
+            }
+            document.getElementById('usersItems').insertAdjacentHTML(
+                'beforeend', data.users.map(userItemHtml).join('')
+            );
+            usersCursor = data.next_cursor;
+            if (moreButton) {
+                moreButton.remove();
+            }
+            if (usersCursor) {
+                document.getElementById('usersList').insertAdjacentHTML('beforeend',
+                    '<button id="usersLoadMore" class="btn btn-primary" style="margin-top: 10px; width: 100%;" onclick="loadAllUsers(true)">عرض المزيد</button>');
+            }
         } else {
             showMessage(data.error, 'error');
         }
     } catch (err) {
         console.error('Error loading users:', err);
         showMessage('حدث خطأ أثناء تحميل المستخدمين', 'error');
+    } finally {
+        const button = document.getElementById('usersLoadMore');
+        if (button) {
+            button.disabled = false;
+            button.textContent = 'عرض المزيد';
+        }
     }
 }
 
@@ -602,34 +636,73 @@ function showMessage(text, type) {
 }
 
 // ✅ دالة جديدة: تحميل وعرض قائمة الإحالات
-async function loadReferrals() {
+// الخادم يرجع الإحالات على صفحات (الأحدث أولاً) مع next_cursor للصفحة التالية
+let referralsCursor = null;
+
+function referralItemHtml(referral) {
+    return `
+        <li style="padding: 12px 0; border-bottom: 1px solid var(--card-border-light); display: flex; justify-content: space-between; align-items: center;">
+            <span><strong>ID:</strong> ${referral.id} | <strong>Username:</strong> ${referral.username || '---'}</span>
+            <span style="color: var(--gold); font-weight: bold;">+3 CMD</span>
+        </li>
+    `;
+}
+
+async function loadReferrals(loadMore = false) {
     const container = document.getElementById('referralsList');
-    container.innerHTML = '<div style="text-align: center; color: var(--light-text); padding: 20px;">جارٍ تحميل قائمة الإحالات...</div>';
+    if (!loadMore) {
+        referralsCursor = null;
+        container.innerHTML = '<div style="text-align: center; color: var(--light-text); padding: 20px;">جارٍ تحميل قائمة الإحالات...</div>';
+    }
+    const moreButton = document.getElementById('referralsLoadMore');
+    if (moreButton) {
+        moreButton.disabled = true;
+        moreButton.textContent = 'جارٍ التحميل...';
+    }
     try {
-        const response = await fetch(`${API_BASE}/get_referrals?user_id=${userData.id}`);
+        let url = `${API_BASE}/get_referrals?user_id=${userData.id}`;
+        if (loadMore && referralsCursor) {
+            url += `&cursor=${encodeURIComponent(referralsCursor)}`;
+        }
+        const response = await fetch(url);
         const data = await response.json();
         if (data.success) {
-            if (data.referrals.length === 0) {
+            if (!loadMore && data.referrals.length === 0) {
                 container.innerHTML = '<div style="text-align: center; color: var(--light-text); padding: 20px;">لا توجد إحالات حتى الآن. شارك رابطك لبدء كسب المكافآت!</div>';
                 return;
             }
-            let html = '<ul style="list-style: none; padding: 0; margin: 0;">';
-            data.referrals.forEach(referral => {
-                html += `
-                    <li style="padding: 12px 0; border-bottom: 1px solid var(--card-border-light); display: flex; justify-content: space-between; align-items: center;">
-                        <span><strong>ID:</strong> ${referral.id} | <strong>Username:</strong> ${referral.username || '---'}</span>
-                        <span style="color: var(--gold); font-weight: bold;">+3 CMD</span>
-                    </li>
-                `;
-            });
-            html += '</ul>';
-            container.innerHTML = html;
-        } else {
+            if (!loadMore) {
+                container.innerHTML = '<ul id="referralsItems" style="list-style: none; padding: 0; margin: 0;"></ul>';
+            }
+            document.getElementById('referralsItems').insertAdjacentHTML(
+                'beforeend', data.referrals.map(referralItemHtml).join('')
+            );
+            referralsCursor = data.next_cursor;
+            if (moreButton) {
+                moreButton.remove();
+            }
+            if (referralsCursor) {
+                container.insertAdjacentHTML('beforeend',
+                    '<button id="referralsLoadMore" class="btn btn-primary" style="margin-top: 10px; width: 100%;" onclick="loadReferrals(true)">عرض المزيد</button>');
+            }
+        } else if (!loadMore) {
             container.innerHTML = '<div style="text-align: center; color: var(--error); padding: 20px;">❌ ' + (data.error || 'حدث خطأ أثناء تحميل الإحالات') + '</div>';
+        } else {
+            showMessage(data.error || 'حدث خطأ أثناء تحميل الإحالات', 'error');
         }
     } catch (err) {
-        container.innerHTML = '<div style="text-align: center; color: var(--error); padding: 20px;">❌ حدث خطأ في الاتصال بالخادم.</div>';
+        if (!loadMore) {
+            container.innerHTML = '<div style="text-align: center; color: var(--error); padding: 20px;">❌ حدث خطأ في الاتصال بالخادم.</div>';
+        } else {
+            showMessage('حدث خطأ في الاتصال بالخادم.', 'error');
+        }
         console.error('Error loading referrals:', err);
+    } finally {
+        const button = document.getElementById('referralsLoadMore');
+        if (button) {
+            button.disabled = false;
+            button.textContent = 'عرض المزيد';
+        }
     }
 }
 
@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+import static_assets
+
+logger = logging.getLogger(__name__)
+
+# data: نسخة للقراءة فقط من الإعدادات، asset: رد /settings الجاهز (مضغوط + ETag)
+Snapshot = namedtuple('Snapshot', ['data', 'version', 'asset', 'file_id'])
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class SettingsStore:
+    """
+    الإعدادات كـ snapshot ثابت في الذاكرة، يُستبدل كاملاً عند التغيير
+    (القراء لا يرون نصف تحديث ولا يحتاجون قفلاً).
+
+    الكتابة ذرية (ملف مؤقت في نفس المجلد ثم os.replace). كل worker يفحص
+    stat الملف مرة كل check_interval ثانية على الأكثر، فإذا تغير (inode أو
+    mtime أو الحجم) يعيد تحميله؛ هكذا يصل تحديث الأدمن لكل الـ workers.
+    """
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+        self._snapshot = self._load()
+
+    def current(self):
+        if time.monotonic() - self._checked_at >= self.check_interval:
+            self._maybe_reload()
+        return self._snapshot
+
+    def save(self, data):
+        """اكتب الإعدادات بشكل ذري وارجع الـ snapshot الجديد."""
+        directory = os.path.dirname(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.settings-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self._snapshot = self._load()
+            self._checked_at = time.monotonic()
+        return self._snapshot
+
+    # ----- التفاصيل الداخلية -----
+
+    def _maybe_reload(self):
+        with self._lock:
+            if time.monotonic() - self._checked_at < self.check_interval:
+                return
+            self._checked_at = time.monotonic()
+            try:
+                if self._file_id() == self._snapshot.file_id:
+                    return
+                self._snapshot = self._load()
+                logger.info(f"Settings reloaded, version {self._snapshot.version}")
+            except (OSError, ValueError):
+                # ملف ناقص أو غير صالح: نبقي آخر نسخة سليمة
+                logger.exception("Failed to reload settings, keeping previous version")
+
+    def _file_id(self):
+        st = os.stat(self.path)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _load(self):
+        file_id = self._file_id()
+        with open(self.path, 'rb') as f:
+            body = f.read()
+        data = json.loads(body)
+        asset = static_assets.StaticAsset(body, 'application/json; charset=utf-8')
+        return Snapshot(_freeze(data), asset.digest, asset, file_id)
@@ -0,0 +1,67 @@
+import gzip
+import hashlib
+
+from flask import request, Response
+
+try:
+    import brotli
+except ImportError:  # brotli اختياري؛ بدونه نكتفي بـ gzip
+    brotli = None
+
+
+class StaticAsset:
+    """
+    ملف ثابت محمّل في الذاكرة مع نسخه المضغوطة (gzip و brotli إن توفر) و ETag
+    من محتواه. الضغط يتم مرة واحدة عند التشغيل وليس في كل طلب.
+    """
+
+    def __init__(self, body, content_type):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.content_type = content_type
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        # encoding -> (المحتوى، ETag)؛ لكل ترميز ETag مختلف لأن المحتوى المرسل مختلف
+        self.variants = {None: (body, f'"{self.digest}"')}
+        gz = gzip.compress(body, compresslevel=9, mtime=0)
+        if len(gz) < len(body):
+            self.variants['gzip'] = (gz, f'"{self.digest}-gz"')
+        if brotli is not None:
+            br = brotli.compress(body, quality=11)
+            if len(br) < len(body):
+                self.variants['br'] = (br, f'"{self.digest}-br"')
+
+    @classmethod
+    def from_file(cls, path, content_type):
+        with open(path, 'rb') as f:
+            return cls(f.read(), content_type)
+
+    def versioned_url(self, url):
+        """رابط يتغير مع المحتوى، فيمكن تخزينه في المتصفح بدون انتهاء."""
+        return f"{url}?v={self.digest}"
+
+    def response(self, cache_control):
+        """
+        رد للطلب الحالي: 304 إذا طابق If-None-Match أي نسخة، وإلا أفضل ترميز
+        يقبله العميل.
+        """
+        matched = [etag for _, etag in self.variants.values() if request.if_none_match.contains(etag.strip('"'))]
+        if matched:
+            resp = Response(status=304)
+            resp.headers['ETag'] = matched[0]
+        else:
+            encoding = self._negotiate()
+            body, etag = self.variants[encoding]
+            resp = Response(body, content_type=self.content_type)
+            resp.headers['ETag'] = etag
+            if encoding:
+                resp.headers['Content-Encoding'] = encoding
+        resp.headers['Cache-Control'] = cache_control
+        resp.headers['Vary'] = 'Accept-Encoding'
+        return resp
+
+    def _negotiate(self):
+        accepted = request.accept_encodings
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accepted.quality(encoding) > 0:
+                return encoding
+        return None
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta, timezone
+
+import ad_buffer
+import db
+
+# العدادات اليومية في stats_daily (اليوم حسب الطابع الزمني المخزن في الصف)
+DAILY_COUNTERS = ('signups', 'ads', 'active_users')
+
+
+def _signup_day(when=None):
+    # created_at يُكتب بـ CURRENT_TIMESTAMP (UTC)
+    return (when or datetime.now(timezone.utc)).strftime('%Y-%m-%d')
+
+
+def read_stats():
+    """
+    إحصائيات لوحة الأدمن من العدادات المخزنة (تحدّثها triggers مع كل كتابة)،
+    فالتكلفة ثابتة مهما كبر جدول المستخدمين.
+    """
+    conn = db.get_connection()
+    counters = {row['name']: row['value'] for row in conn.execute('SELECT name, value FROM stats_counters')}
+    signup_day, ad_day = _signup_day(), ad_buffer.ad_day()
+    daily = {
+        (row['day'], row['name']): row['value']
+        for row in conn.execute(
+            'SELECT day, name, value FROM stats_daily WHERE day IN (?, ?)', (signup_day, ad_day)
+        )
+    }
+    return {
+        'total_users': int(counters.get('users', 0)),
+        'active_today': int(daily.get((ad_day, 'active_users'), 0)),
+        'total_invites': int(counters.get('invites', 0)),
+        'total_withdrawals': counters.get('withdrawals_completed', 0),
+        'today_ads': int(daily.get((ad_day, 'ads'), 0)),
+        'today_signups': int(daily.get((signup_day, 'signups'), 0)),
+        'total_balance': counters.get('balance', 0),
+    }
+
+
+def history(days=30):
+    """الأرقام اليومية لآخر days يوم: [{'day': ..., 'signups': ..., 'ads': ..., 'active_users': ...}]."""
+    since = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    by_day = {}
+    for row in db.get_connection().execute(
+        'SELECT day, name, value FROM stats_daily WHERE day >= ? ORDER BY day', (since,)
+    ):
+        by_day.setdefault(row['day'], {'day': row['day'], **{name: 0 for name in DAILY_COUNTERS}})
+        by_day[row['day']][row['name']] = row['value']
+    return list(by_day.values())
+
+
+def recompute():
+    """
+    أعد حساب العدادات من الجداول (للمطابقة أو بعد تعديل يدوي على القاعدة).
+    التسجيلات اليومية تُحسب لكل الأيام؛ الإعلانات والنشطون لليوم الحالي فقط
+    لأن ads_watched_today يحفظ آخر يوم فقط (ads_day).
+    """
+    with db.transaction() as conn:
+        users, invites, total_balance = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(invites), 0), COALESCE(SUM(balance), 0) FROM users'
+        ).fetchone()
+        withdrawals = conn.execute(
+            "SELECT COALESCE(SUM(amount), 0) FROM withdrawals WHERE status = 'completed'"
+        ).fetchone()[0]
+        conn.executemany(
+            'INSERT OR REPLACE INTO stats_counters (name, value) VALUES (?, ?)',
+            [('users', users), ('invites', invites), ('balance', total_balance),
+             ('withdrawals_completed', withdrawals)]
+        )
+
+        conn.execute("DELETE FROM stats_daily WHERE name = 'signups'")
+        conn.execute(
+            '''INSERT INTO stats_daily (day, name, value)
+               SELECT date(created_at), 'signups', COUNT(*) FROM users
+               WHERE created_at IS NOT NULL GROUP BY date(created_at)'''
+        )
+
+        ad_day = ad_buffer.ad_day()
+        ads = conn.execute(
+            'SELECT COALESCE(SUM(ads_watched_today), 0) FROM users WHERE ads_day = ?', (ad_day,)
+        ).fetchone()[0]
+        active = conn.execute(
+            "SELECT COUNT(*) FROM users WHERE last_ad_watch >= ? AND last_ad_watch < date(?, '+1 day')",
+            (ad_day, ad_day)
+        ).fetchone()[0]
+        conn.executemany(
+            'INSERT OR REPLACE INTO stats_daily (day, name, value) VALUES (?, ?, ?)',
+            [(ad_day, 'ads', ads), (ad_day, 'active_users', active)]
+        )
+    return read_stats()
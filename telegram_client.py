@@ -0,0 +1,145 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+logger = logging.getLogger(__name__)
+
+API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+
+# أقصى انتظار نقبله من retry_after في رد 429 قبل أن نعيد الرد للمستدعي
+MAX_RETRY_AFTER = 5
+
+
+def is_idempotent(method):
+    """
+    طرق القراءة (get*) آمنة للتكرار. غيرها (sendMessage وأمثالها) قد يكون وصل
+    رغم انتهاء مهلة القراءة أو رد 5xx، فتكراره يرسل الرسالة مرتين.
+    """
+    return method.startswith('get')
+
+
+def _not_sent(error):
+    """فشل قبل أن يصل الطلب لتليجرام (مهلة الاتصال أو تعذر فتح الاتصال)."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class RateLimiter:
+    """
+    token bucket يوقف المستدعي حتى يتوفر توكن (rate في الثانية، وحتى burst دفعة واحدة).
+    حدود تليجرام للإرسال ~30 رسالة/ثانية لكل البوت، فيُشارك limiter واحد بين كل المرسلين الجماعيين.
+    """
+
+    def __init__(self, rate=30, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait_for = (1 - self._tokens) / self.rate
+                else:
+                    wait_for = self._paused_until - now
+            time.sleep(wait_for)
+
+    def pause(self, seconds):
+        """أوقف كل المرسلين (مثلاً بعد 429 مع retry_after)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+            self._updated = self._paused_until
+
+
+class TelegramClient:
+    """
+    عميل Bot API واحد مشترك: requests.Session مع pool اتصالات keep-alive
+    (بدلاً من TCP+TLS جديد لكل رسالة)، timeout لكل استدعاء، وإعادة محاولة مع backoff
+    لأخطاء الشبكة و 5xx و 429.
+    """
+
+    def __init__(self, token, base_url=API_URL, pool_size=32, retries=2, backoff=0.5):
+        self.token = token
+        self.base_url = base_url.rstrip('/')
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, payload=None, params=None, timeout=10, retries=None):
+        """
+        استدع method من Bot API وأرجع requests.Response.
+        أخطاء 4xx (غير 429) تُرجع مباشرة بدون إعادة محاولة؛ آخر استثناء شبكة يُرمى للمستدعي.
+        الطرق غير الآمنة للتكرار (انظر is_idempotent) لا تُعاد إلا إذا لم يُرسل الطلب أصلاً أو بعد 429.
+        """
+        url = f"{self.base_url}/bot{self.token}/{method}"
+        retries = self.retries if retries is None else retries
+        idempotent = is_idempotent(method)
+        for attempt in range(retries + 1):
+            try:
+                if payload is not None:
+                    resp = self.session.post(url, json=payload, timeout=timeout)
+                else:
+                    resp = self.session.get(url, params=params, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == retries or not (idempotent or _not_sent(e)):
+                    raise
+                logger.warning(f"Telegram {method} failed ({e}), retry {attempt + 1}/{retries}")
+                self._sleep_backoff(attempt)
+                continue
+
+            if resp.status_code == 429 and attempt < retries:
+                retry_after = self.retry_after(resp)
+                if retry_after is not None and retry_after <= MAX_RETRY_AFTER:
+                    time.sleep(retry_after)
+                    continue
+                return resp
+            if resp.status_code >= 500 and idempotent and attempt < retries:
+                self._sleep_backoff(attempt)
+                continue
+            return resp
+        return resp
+
+    def send_message(self, chat_id, text, parse_mode=None, reply_markup=None, timeout=8, retries=None):
+        payload = {"chat_id": chat_id, "text": text}
+        if parse_mode:
+            payload["parse_mode"] = parse_mode
+        if reply_markup is not None:
+            payload["reply_markup"] = reply_markup
+        return self.request("sendMessage", payload=payload, timeout=timeout, retries=retries)
+
+    def get_chat_member(self, chat_id, user_id, timeout=10, retries=None):
+        return self.request(
+            "getChatMember", params={"chat_id": chat_id, "user_id": user_id}, timeout=timeout, retries=retries
+        )
+
+    def _sleep_backoff(self, attempt):
+        time.sleep(self.backoff * (2 ** attempt) * (0.5 + random.random() / 2))
+
+    @staticmethod
+    def retry_after(resp):
+        """قيمة retry_after (بالثواني) من رد 429، أو None."""
+        try:
+            return resp.json().get("parameters", {}).get("retry_after")
+        except ValueError:
+            return None
@@ -0,0 +1,192 @@
+import atexit
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+import ad_buffer  # noqa: E402
+import db  # noqa: E402
+import migrations  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, **kwargs):
+        self.now += timedelta(**kwargs)
+
+
+@pytest.fixture(autouse=True)
+def fresh_db(tmp_path, monkeypatch):
+    db.close_connection()
+    monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'test.db'))
+    migrations.migrate()
+    yield
+    db.close_connection()
+
+
+@pytest.fixture
+def clock():
+    return FakeClock(datetime(2026, 3, 1, 12, 0, 0))
+
+
+@pytest.fixture
+def make_buffer(tmp_path, clock):
+    buffers = []
+
+    def make(name='worker', **kwargs):
+        kwargs.setdefault('daily_limit', 3)
+        # لا نريد flush من الـ thread في الاختبار؛ نستدعي flush يدوياً
+        buffer = ad_buffer.AdRewardBuffer(
+            reward=0.5, flush_interval_ms=3600 * 1000, max_events=10 ** 6,
+            journal_dir=str(tmp_path / name), clock=clock, **kwargs
+        )
+        buffers.append(buffer)
+        return buffer
+
+    yield make
+    for buffer in buffers:
+        atexit.unregister(buffer.stop)
+        buffer.stop()
+
+
+def add_user(user_id, **columns):
+    columns = {'id': user_id, 'balance': 0, 'points': 0, 'level': 1, **columns}
+    db.execute(
+        f"INSERT INTO users ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+        tuple(columns.values())
+    )
+
+
+def user(user_id):
+    return db.get_connection().execute(
+        'SELECT balance, ads_watched_today, ads_day, points, level, last_ad_watch FROM users WHERE id = ?', (user_id,)
+    ).fetchone()
+
+
+def test_views_are_capped_in_memory_and_flushed_in_one_batch(make_buffer):
+    add_user(1)
+    buffer = make_buffer()
+    assert [buffer.record(1) for _ in range(4)] == [True, True, True, False]
+    # لا شيء في القاعدة قبل الـ flush
+    assert user(1)['ads_watched_today'] == 0
+
+    assert buffer.flush() == 1
+    row = user(1)
+    assert (row['balance'], row['ads_watched_today'], row['ads_day'], row['points']) == (1.5, 3, '2026-03-01', 3)
+    assert row['last_ad_watch'] == '2026-03-01 12:00:00'
+    assert buffer.record(1) is False
+    assert buffer.record(404) is None
+
+
+def test_counter_starts_again_on_a_new_day(make_buffer, clock):
+    add_user(1, ads_watched_today=3, ads_day='2026-02-28')
+    buffer = make_buffer()
+    assert buffer.record(1) is True
+
+    clock.now = datetime(2026, 3, 1, 23, 59, 59)
+    assert [buffer.record(1) for _ in range(3)] == [True, True, False]
+    clock.advance(seconds=1)
+    assert buffer.record(1) is True
+
+    buffer.flush()
+    row = user(1)
+    assert (row['ads_watched_today'], row['ads_day'], row['points']) == (1, '2026-03-02', 4)
+    assert row['last_ad_watch'] == '2026-03-02 00:00:00'
+
+
+def test_level_follows_points(make_buffer):
+    add_user(1, points=98)
+    buffer = make_buffer()
+    buffer.record(1)
+    buffer.flush()
+    assert (user(1)['points'], user(1)['level']) == (99, 1)
+    buffer.record(1)
+    buffer.flush()
+    assert (user(1)['points'], user(1)['level']) == (100, 2)
+
+
+def test_limit_is_enforced_across_workers_at_flush(make_buffer):
+    add_user(1)
+    first, second = make_buffer('first'), make_buffer('second')
+    # كل worker يرى القاعدة فارغة فيقبل مشاهدتين
+    assert [first.record(1), first.record(1)] == [True, True]
+    assert [second.record(1), second.record(1)] == [True, True]
+
+    first.flush()
+    second.flush()
+    row = user(1)
+    assert (row['ads_watched_today'], row['points'], row['balance']) == (3, 3, 1.5)
+    assert second.dropped == 1
+    # الحالة المؤقتة تحدّثت من القاعدة بعد الـ flush
+    assert second.record(1) is False
+
+
+def test_failed_flush_is_retried_and_still_counts_towards_the_limit(make_buffer, monkeypatch):
+    add_user(1)
+    buffer = make_buffer()
+    buffer.record(1)
+    buffer.record(1)
+
+    apply = buffer._apply
+    calls = []
+
+    def failing_apply(batch_id, pending):
+        calls.append(batch_id)
+        if len(calls) == 1:
+            raise db.sqlite3.OperationalError('database is locked')
+        return apply(batch_id, pending)
+
+    monkeypatch.setattr(buffer, '_apply', failing_apply)
+    assert buffer.flush() == 0
+    assert user(1)['ads_watched_today'] == 0
+    assert [buffer.record(1), buffer.record(1)] == [True, False]
+
+    assert buffer.flush() == 2
+    assert (user(1)['ads_watched_today'], user(1)['points']) == (3, 3)
+    assert set(os.listdir(buffer.journal_dir)) == {'.lock', os.path.basename(buffer._journal_path)}
+
+
+def test_idle_users_are_read_again_from_the_database(make_buffer):
+    add_user(1)
+    buffer = make_buffer()
+    [buffer.record(1) for _ in range(3)]
+    buffer.flush()
+    buffer.flush()  # فترة كاملة بلا مشاهدات
+
+    # الأدمن صفّر العداد
+    db.execute('UPDATE users SET ads_watched_today = 0 WHERE id = 1')
+    assert buffer.record(1) is True
+
+
+def test_orphan_journal_is_replayed_once_within_the_limit(make_buffer, tmp_path):
+    add_user(1, ads_watched_today=2, ads_day='2026-03-01')
+    add_user(2)
+    journal_dir = tmp_path / 'restart'
+    journal_dir.mkdir()
+    # journal عملية توقفت: صيغتان للأسطر وسطر أخير ناقص
+    (journal_dir / '999-1-1.log').write_text(
+        '1\t2026-03-01 11:00:00\n'
+        '1\t0\t2026-03-01 11:00:01\n'
+        '2\t2026-03-01 11:00:02\n'
+        '2\t2026-03-01 11:0'
+    )
+
+    buffer = make_buffer('restart')
+    assert buffer.record(2) is True  # أول استخدام يطبق الملفات اليتيمة
+    row = user(1)
+    assert (row['ads_watched_today'], row['points'], row['balance']) == (3, 1, 0.5)
+    assert row['last_ad_watch'] == '2026-03-01 11:00:01'
+    assert user(2)['ads_watched_today'] == 1
+    assert buffer.dropped == 1
+    assert not (journal_dir / '999-1-1.log').exists()
+
+    buffer.flush()
+    assert user(2)['ads_watched_today'] == 2
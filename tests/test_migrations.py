@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+import db  # noqa: E402
+import migrations  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_db(tmp_path, monkeypatch):
+    db.close_connection()
+    monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'test.db'))
+    migrations.migrate()
+    yield
+    db.close_connection()
+
+
+def test_hot_queries_only_search():
+    problems = {name: problems for name, (_, problems) in migrations.check_query_plans().items() if problems}
+    assert problems == {}
+
+
+def test_full_index_walk_is_a_problem():
+    # الشرط القديم لمؤشر الرصيد: يقرأ idx_users_balance من أوله في كل صفحة
+    plan = migrations.explain(
+        db.get_connection(),
+        'SELECT id, username FROM users WHERE (balance < ? OR (balance = ? AND id < ?)) ORDER BY balance DESC, id DESC LIMIT ?',
+        (50.0, 50.0, 1000, 101)
+    )
+    assert migrations._plan_problems(plan) == ['SCAN users USING INDEX idx_users_balance']
+    assert migrations._plan_problems(plan, ('users',)) == []
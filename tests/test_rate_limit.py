@@ -0,0 +1,152 @@
+import json
+import os
+import sys
+
+import pytest
+from flask import Flask, jsonify
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+import db  # noqa: E402
+import migrations  # noqa: E402
+import rate_limit  # noqa: E402
+from rate_limit import Limit  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture(autouse=True)
+def fresh_db(tmp_path, monkeypatch):
+    db.close_connection()
+    monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'test.db'))
+    migrations.migrate()
+    yield
+    db.close_connection()
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def buckets(request, clock):
+    if request.param == 'memory':
+        return rate_limit.MemoryBuckets(clock=clock)
+    return rate_limit.SQLiteBuckets(clock=clock)
+
+
+def test_parse_limit():
+    assert rate_limit.parse_limit('30/60') == Limit(30, 60.0)
+    assert rate_limit.parse_limit('5') == Limit(5, 1.0)
+    assert rate_limit.parse_limit('off') is None
+    assert rate_limit.parse_limit('') is None
+
+
+def test_bucket_refills_at_count_per_period(buckets, clock):
+    limit = Limit(3, 60)  # توكن كل 20 ثانية
+    assert [buckets.take('k', limit) for _ in range(3)] == [0, 0, 0]
+    assert buckets.take('k', limit) == pytest.approx(20)
+
+    clock.advance(15)
+    assert buckets.take('k', limit) == pytest.approx(5)
+    clock.advance(5)
+    assert buckets.take('k', limit) == 0
+    assert buckets.take('other', limit) == 0
+
+
+def test_bucket_never_holds_more_than_count(buckets, clock):
+    limit = Limit(2, 10)
+    buckets.take('k', limit)
+    clock.advance(3600)
+    assert [buckets.take('k', limit) for _ in range(3)] == [0, 0, pytest.approx(5)]
+
+
+def test_requests_at_the_same_instant_are_still_limited(buckets):
+    # ساعة لا تتحرك: القبول لا يُستنتج من updated == now
+    limit = Limit(1, 60)
+    assert buckets.take('k', limit) == 0
+    assert buckets.take('k', limit) == pytest.approx(60)
+    assert buckets.take('k', limit) == pytest.approx(60)
+
+
+def test_memory_buckets_evict_least_recently_used(clock):
+    buckets = rate_limit.MemoryBuckets(maxsize=2, clock=clock)
+    limit = Limit(1, 60)
+    buckets.take('a', limit)
+    buckets.take('b', limit)
+    buckets.take('a', limit)  # a أحدث استخداماً من b
+    buckets.take('c', limit)
+    assert buckets.stats()['evictions'] == 1
+    assert buckets.take('a', limit) > 0
+    # b أُزيل فعاد بدلو ممتلئ
+    assert buckets.take('b', limit) == 0
+
+
+def test_sqlite_buckets_purge_idle_rows(clock):
+    buckets = rate_limit.SQLiteBuckets(idle_ttl=100, purge_interval=50, clock=clock)
+    limit = Limit(5, 60)
+    buckets.take('idle', limit)
+    clock.advance(200)
+    buckets.take('active', limit)
+    keys = [row[0] for row in db.get_connection().execute('SELECT key FROM rate_limit_buckets')]
+    assert keys == ['active']
+
+
+@pytest.fixture
+def client(clock, monkeypatch):
+    app = Flask(__name__)
+    limiter = rate_limit.RouteLimiter(rate_limit.MemoryBuckets(clock=clock), proxy_hops=1)
+
+    @app.route('/plain', methods=['POST'])
+    @limiter.limit('plain', per_user='2/60')
+    def plain():
+        return jsonify({'success': True})
+
+    @app.route('/forced', methods=['POST'])
+    @limiter.limit('forced', per_user='2/60', force_json=True)
+    def forced():
+        return jsonify({'success': True})
+
+    @app.route('/by-ip', methods=['GET'])
+    @limiter.limit('by-ip', per_ip='1/30')
+    def by_ip():
+        return jsonify({'success': True})
+
+    app.limiter = limiter
+    return app.test_client()
+
+
+def test_rejected_request_gets_429_with_retry_after(client, clock):
+    assert client.get('/by-ip').status_code == 200
+    resp = client.get('/by-ip')
+    assert resp.status_code == 429
+    assert resp.json == {'success': False, 'error': 'Too many requests, try again later'}
+    assert resp.headers['Retry-After'] == '30'
+
+    clock.advance(29.5)
+    assert client.get('/by-ip').headers['Retry-After'] == '1'
+    # عنوان العميل هو ما أضافه أقرب proxy
+    assert client.get('/by-ip', headers={'X-Forwarded-For': '10.0.0.1'}).status_code == 200
+
+
+def test_user_limit_reads_json_like_the_view(client):
+    body = json.dumps({'user_id': 7})
+    # بدون Content-Type: get_json(force=True) في المسار يقرأ الجسم، فالحد يقرؤه أيضاً
+    forced = [client.post('/forced', data=body).status_code for _ in range(3)]
+    assert forced == [200, 200, 429]
+    # المسار العادي يقرأ JSON فقط مع Content-Type، فالطلب بدونه لا يحمل معرّف مستخدم
+    plain = [client.post('/plain', data=body).status_code for _ in range(3)]
+    assert plain == [200, 200, 200]
+    assert client.application.limiter.stats()['routes']['forced'] == {
+        'allowed': 2, 'rejected': 1, 'per_user': '2/60', 'per_ip': None,
+    }
@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+import db  # noqa: E402
+import migrations  # noqa: E402
+import update_dedup  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_db(tmp_path, monkeypatch):
+    db.close_connection()
+    monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'test.db'))
+    migrations.migrate()
+    yield
+    db.close_connection()
+
+
+def make_filter(**kwargs):
+    # لا نريد thread المزامنة في الاختبار؛ نستدعي _sync يدوياً
+    return update_dedup.UpdateDeduplicator(flush_interval=3600, **kwargs)
+
+
+def test_redelivered_update_is_dropped_across_workers():
+    first = make_filter()
+    assert first.is_duplicate(500) is False
+    assert first.is_duplicate(500) is True
+    first._sync()
+
+    # worker آخر (أو بعد إعادة التشغيل) يرى الحد المحفوظ
+    second = make_filter()
+    assert second.is_duplicate(500) is True
+    assert second.is_duplicate(501) is False
+
+
+def test_update_id_restart_far_below_floor_is_accepted():
+    old = make_filter()
+    assert old.is_duplicate(5_000_000) is False
+    old._sync()
+
+    restarted = make_filter()
+    assert restarted.is_duplicate(1234) is False
+    assert restarted.is_duplicate(1235) is False
+    assert restarted.is_duplicate(1234) is True
+    assert restarted.stats()['restarts'] == 1
+    restarted._sync()
+
+    # الحد المحفوظ استُبدل بالترقيم الجديد، فالـ workers الجديدة لا تُسقط التحديثات التالية
+    after = make_filter()
+    assert after.is_duplicate(1236) is False
+    assert after.is_duplicate(1235) is True
+
+
+def test_restart_within_window_after_idle_period_is_accepted():
+    old = make_filter()
+    assert old.is_duplicate(5_000_000) is False
+    old._sync()
+    db.execute("UPDATE webhook_state SET value = ? WHERE name = 'last_update_at'", (int(time.time()) - 8 * 86400,))
+
+    # قيمة البداية الجديدة قريبة من الحد القديم (داخل النافذة) لكن بعد أسبوع بلا تحديثات
+    restarted = make_filter()
+    assert restarted.is_duplicate(4_999_990) is False
+    assert restarted.is_duplicate(4_999_991) is False
+
+
+def test_invalid_update_id_is_not_compared():
+    dedup = make_filter()
+    assert dedup.is_duplicate('123') is False
+    assert dedup.is_duplicate(None) is False
+    assert dedup.stats()['invalid'] == 2
+    assert dedup.stats()['received'] == 0
@@ -0,0 +1,156 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# تحت الحد (floor) نعتبر مكرراً فقط ما يقع ضمن هذه النافذة؛ id أقل بكثير يعني أن تليجرام أعاد الترقيم
+DUPLICATE_WINDOW = 100000
+# تليجرام قد يبدأ update_id من قيمة عشوائية بعد أسبوع بدون تحديثات؛ بعد هذه المدة بلا تحديثات
+# نتجاهل الحد المحفوظ (إعادة الإرسال لا تتأخر كل هذا الوقت)
+IDLE_RESET = 86400
+
+
+class UpdateDeduplicator:
+    """
+    يُسقط التحديثات التي يعيد تليجرام إرسالها (نفس update_id) قبل أي عمل.
+
+    طبقتان:
+      - ذاكرة: آخر maxsize من update_id في set (فحص O(1)).
+      - high-water mark محفوظ في webhook_state ومشترك بين كل الـ workers:
+        كل flush_interval يكتب كل worker أكبر id رآه ويقرأ الأكبر عند الجميع.
+        أي id لا يتجاوز الحد (floor) بحدود DUPLICATE_WINDOW يُعتبر مكرراً حتى لو
+        لم يره هذا الـ worker (إعادة إرسال وصلت لـ worker آخر، أو بعد إعادة التشغيل).
+    الحد المطبق متأخر دورة كاملة عن آخر قيمة مقروءة، حتى لا تُسقط تحديثات
+    جديدة وصلت بترتيب مختلف عبر اتصالات webhook المتوازية.
+
+    إذا أعاد تليجرام ترقيم update_id (بعد IDLE_RESET بدون تحديثات، أو id أقل من
+    الحد بأكثر من النافذة) يُنسى الحد ويُستبدل المحفوظ بالقيمة الجديدة، فلا يسكت البوت.
+    """
+
+    def __init__(self, maxsize=10000, flush_interval=2.0, window=DUPLICATE_WINDOW, idle_reset=IDLE_RESET):
+        self.maxsize = maxsize
+        self.flush_interval = flush_interval
+        self.window = window
+        self.idle_reset = idle_reset
+        self._seen = set()
+        self._order = deque()
+        self._lock = threading.Lock()
+        self._max_seen = 0
+        self._flushed = 0
+        self._floor = 0
+        self._next_floor = 0
+        self._last_seen_at = 0.0
+        # بعد إعادة الترقيم: المحفوظ يُستبدل (وليس MAX) في الـ sync التالي
+        self._restarted = False
+        self._pid = None
+        self.received = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.restarts = 0
+
+    def is_duplicate(self, update_id):
+        """يرجع True إذا سبق رؤية update_id، وإلا يسجله ويرجع False. id غير صحيح لا يُفحص (False)."""
+        if not isinstance(update_id, int) or isinstance(update_id, bool):
+            with self._lock:
+                self.invalid += 1
+            logger.warning(f"Webhook update with invalid update_id {update_id!r}, not deduplicated")
+            return False
+        self._ensure_started()
+        now = time.time()
+        with self._lock:
+            self.received += 1
+            if self._floor and (now - self._last_seen_at > self.idle_reset or update_id <= self._floor - self.window):
+                self._restart(update_id)
+            if update_id in self._seen or self._floor - self.window < update_id <= self._floor:
+                self.duplicates += 1
+                return True
+            self._seen.add(update_id)
+            self._order.append(update_id)
+            if len(self._order) > self.maxsize:
+                self._seen.discard(self._order.popleft())
+            if update_id > self._max_seen:
+                self._max_seen = update_id
+            self._last_seen_at = now
+            return False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'received': self.received,
+                'duplicates': self.duplicates,
+                'duplicate_rate': round(self.duplicates / self.received, 4) if self.received else 0.0,
+                'invalid': self.invalid,
+                'restarts': self.restarts,
+                'tracked': len(self._seen),
+                'high_water_mark': self._max_seen,
+                'floor': self._floor,
+            }
+
+    # ----- التفاصيل الداخلية -----
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # ما عولج قبل تشغيل هذه العملية كله مكرر
+            floor, self._last_seen_at = self._load()
+            self._floor = self._next_floor = floor
+            threading.Thread(target=self._run, name='update-dedup', daemon=True).start()
+
+    def _restart(self, update_id):
+        # يُستدعى مع القفل
+        logger.warning(
+            f"Telegram update_id restarted at {update_id} (floor {self._floor}, "
+            f"idle {time.time() - self._last_seen_at:.0f}s), resetting deduplication"
+        )
+        self._seen.clear()
+        self._order.clear()
+        self._floor = self._next_floor = 0
+        self._max_seen = self._flushed = 0
+        self._restarted = True
+        self.restarts += 1
+
+    def _load(self):
+        """(آخر update_id، وقت آخر تحديث) المحفوظان عند كل الـ workers."""
+        state = {row['name']: row['value'] for row in db.get_connection().execute(
+            "SELECT name, value FROM webhook_state WHERE name IN ('last_update_id', 'last_update_at')"
+        )}
+        return state.get('last_update_id') or 0, state.get('last_update_at') or time.time()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self._sync()
+            except Exception:
+                logger.exception("Failed to persist webhook high-water mark")
+
+    def _sync(self):
+        with self._lock:
+            max_seen, last_seen_at, restarted = self._max_seen, int(self._last_seen_at), self._restarted
+            self._restarted = False
+        if restarted or max_seen > self._flushed:
+            # بعد إعادة الترقيم نستبدل القيمة المحفوظة، وإلا نرفعها فقط
+            merge = 'excluded.value' if restarted else 'MAX(value, excluded.value)'
+            with db.transaction() as conn:
+                conn.executemany(
+                    f'''INSERT INTO webhook_state (name, value) VALUES (?, ?)
+                        ON CONFLICT(name) DO UPDATE SET value = {merge}''',
+                    [('last_update_id', max_seen), ('last_update_at', last_seen_at)]
+                )
+            self._flushed = max_seen
+        shared, shared_at = self._load()
+        with self._lock:
+            self._last_seen_at = max(self._last_seen_at, shared_at)
+            if self._restarted:
+                return  # أعاد تليجرام الترقيم أثناء الـ sync؛ shared ما زال الحد القديم
+            self._floor = max(self._floor, self._next_floor)
+            self._next_floor = shared